@@ -11,13 +11,25 @@ Kodi remote controller package based on HTTP transport and JSON.
 
 from .. import rpc
 from .. import echonest
+from .. import store
+from .. import search
+from .. import stats
+from .. import recommend
+from .. import similar
 from progressbar import *
+from multiprocessing.pool import ThreadPool
+import collections
+import threading
+import json
 import pickle
 import time
 import logging
 
 # global constants
 
+LIBRARY_FILE = 'library.db'
+
+# pickle files of the previous versions
 ALBUMS_FILE = 'albums.pickle'
 GENRES_FILE = 'genres.pickle'
 SONGS_FILE = 'songs.pickle'
@@ -29,10 +41,57 @@ SONG = 'songid'
 # Kodi sync parameters
 SONGS_SLICE_SIZE = 20
 ALBUMS_SLICE_SIZE = 20
+SYNC_WORKERS = 4
+
+# incremental sync parameters
+ALBUMS_WATERMARK_FIELDS = ('dateadded', 'lastmodified')
+SONGS_WATERMARK_FIELDS = ('dateadded', 'lastmodified', 'lastplayed')
+WATERMARK_FLOOR = '1970-01-01 00:00:00' # date of the fields never set
+
+# adaptive slice size parameters
+SLICE_SIZE_MIN = 10
+SLICE_SIZE_MAX = 2000
+SLICE_TARGET_TIME = 1.0 # seconds per slice request
+SLICE_TARGET_BYTES = 1000000 # payload per slice
+
+# Kodi playlist parameters
+PLAYLIST_CHUNK_SIZE = 100
+
+# notifications that invalidate the player state
+STATE_NOTIFICATIONS = (
+    'Player.OnPlay',
+    'Player.OnPause',
+    'Player.OnResume',
+    'Player.OnSeek',
+    'Player.OnSpeedChanged',
+    'Player.OnStop',
+    'Playlist.OnAdd',
+    'Playlist.OnRemove',
+    'Playlist.OnClear',
+    'AudioLibrary.OnUpdate'
+)
+
+# search parameters
+SEARCH_FOLD_ACCENTS = False
+FUZZY_LIMIT = 20 # results of the ranked searches
+
+# local recommendations
+PLAYLIST_SIZE = 15 # songs, as the echonest static playlists
+SIMILAR_SIZE = 10 # songs listed as similar
 
 # echonest sync parameters
-SONGS_EN_SLICE_SIZE = 25
-EN_API_WAIT = 0.51 # max 120 api calls per minute
+EN_SYNC_RETRIES = 2 # resubmissions of a slice refused or in error
+EN_TICKET_TIMEOUT = 600 # seconds waiting for the tickets after the last slice
+
+# echonest feedback queue
+FEEDBACK_FLUSH_DELAY = 5.0 # seconds gathering the feedback before a flush
+FEEDBACK_RETRY_WAIT = 30.0 # seconds after a failed flush, doubled each time
+FEEDBACK_RETRY_MAX_WAIT = 900.0 # seconds
+FEEDBACK_ATTEMPTS = 5 # attempts before a feedback in error is dropped
+
+# echonest profile cache
+EN_PROFILE_TTL = 86400 # seconds, profile id
+EN_INFO_TTL = 60 # seconds, profile metadata like the number of items
 
 # global variable
 logger = logging.getLogger(__name__)
@@ -50,6 +109,11 @@ def get_friendly_name(params):
     friendly_name = rpc.system_friendly_name(params)
     return friendly_name
 
+def connections_close():
+    """Close the connections to the Kodi servers"""
+    logger.debug('call function connections_close')
+    rpc.close_clients()
+
 # local files utility
 
 def is_file(fname):
@@ -61,74 +125,265 @@ def is_file(fname):
         return False
     return True
 
+def pickle_read(fname):
+    """Load a pickle file"""
+    logger.debug('call function pickle_read')
+    f = open(fname, 'rb')
+    data = pickle.load(f)
+    f.close()
+    return data
+
+# local library
+
+def library_migrate():
+    """Import the pickle files of the previous versions in the library
+
+    Each dataset is imported only if it is still empty in the library.
+    The pickle files are left untouched.
+    """
+    logger.debug('call function library_migrate')
+    if store.meta_read(LIBRARY_FILE, 'migrated'):
+        return
+    if is_file(ALBUMS_FILE) and not is_local_albums():
+        logger.info('import %s', ALBUMS_FILE)
+        albums_save(pickle_read(ALBUMS_FILE))
+    if is_file(GENRES_FILE) and not store.records_count(LIBRARY_FILE, 'genres'):
+        logger.info('import %s', GENRES_FILE)
+        genres_save(pickle_read(GENRES_FILE))
+    if is_file(SONGS_FILE) and not is_local_songs():
+        logger.info('import %s', SONGS_FILE)
+        songs_save(pickle_read(SONGS_FILE))
+    store.meta_save(LIBRARY_FILE, 'migrated', True)
+
 def is_local_albums():
-    """True if there is a local albums file"""
+    """True if there are albums in the local library"""
     logger.debug('call function is_local_albums')
-    return is_file(ALBUMS_FILE)
+    return store.records_count(LIBRARY_FILE, 'albums') > 0
 
 def is_local_songs():
-    """True if there is a local songs file"""
+    """True if there are songs in the local library"""
     logger.debug('call function is_local_songs')
-    return is_file(SONGS_FILE)
+    return store.records_count(LIBRARY_FILE, 'songs') > 0
 
-def albums_save(albums):
-    """Save albums to local files"""
+def albums_save(albums, albumids=None):
+    """Save albums to the local library, all of them or only albumids"""
     logger.debug('call function save_albums')
-    f = open(ALBUMS_FILE, 'wb')
-    pickle.dump(albums, f)
-    f.close()
+    if albumids is None:
+        store.records_save(LIBRARY_FILE, 'albums', albums)
+    else:
+        store.records_upsert(LIBRARY_FILE, 'albums', albums, albumids)
+    store.keys_save(LIBRARY_FILE, 'albums',
+        records_keys(albums, albumids), albumids)
 
 def genres_save(genres):
-    """Save genres to local files"""
+    """Save genres to the local library"""
     logger.debug('call function save_genres')
-    f = open(GENRES_FILE, 'wb')
-    pickle.dump(genres, f)
-    f.close()
+    records = dict((genreid, {'label': genres[genreid]}) for genreid in genres)
+    store.records_save(LIBRARY_FILE, 'genres', records)
 
-def songs_save(songs):
-    """Save songs to local files"""
+def songs_save(songs, songids=None):
+    """Save songs to the local library, all of them or only songids"""
     logger.debug('call function save_songs')
-    f = open(SONGS_FILE, 'wb')
-    pickle.dump(songs, f)
-    f.close()
+    if songids is None:
+        store.records_save(LIBRARY_FILE, 'songs', songs)
+    else:
+        store.records_upsert(LIBRARY_FILE, 'songs', songs, songids)
+    store.keys_save(LIBRARY_FILE, 'songs',
+        records_keys(songs, songids), songids)
+
+def watermark_read(name):
+    """Return the watermark of the last sync of a dataset"""
+    return store.meta_read(LIBRARY_FILE, 'watermark_' + name, {})
+
+def watermark_save(name, watermark):
+    """Save the watermark of the last sync of a dataset"""
+    logger.debug('call function watermark_save')
+    store.meta_save(LIBRARY_FILE, 'watermark_' + name, watermark)
+
+def watermark_floor(watermark, fields):
+    """Set the fields missing in the watermark to WATERMARK_FLOOR
+
+    A field empty in all the items synced so far would otherwise be left
+    out of the changed filter, e.g. lastplayed before any song is played.
+    """
+    for field in fields:
+        watermark.setdefault(field, WATERMARK_FLOOR)
 
-def albums_read_from_file():
-    """Load albums from pickle file"""
+def watermark_update(watermark, items, fields):
+    """Raise the watermark to the most recent dates of the items"""
+    watermark_floor(watermark, fields)
+    for item in items:
+        for field in fields:
+            if item.get(field) and item[field] > watermark.get(field, ''):
+                watermark[field] = item[field]
+
+def albums_read_from_file(albumids=None):
+    """Load albums from the local library, all of them or only albumids"""
     logger.debug('call function albums_read_from_file')
-    f = open(ALBUMS_FILE, 'rb')
-    albums = pickle.load(f)
-    f.close()
+    albums = store.records_read(LIBRARY_FILE, 'albums', albumids)
     return albums
 
 def genres_read_from_file():
-    """Load genres from pickle file"""
+    """Load genres from the local library"""
     logger.debug('call function genres_read_from_file')
-    f = open(GENRES_FILE, 'rb')
-    genres = pickle.load(f)
-    f.close()
+    records = store.records_read(LIBRARY_FILE, 'genres')
+    genres = dict((genreid, records[genreid]['label']) for genreid in records)
     return genres
 
-def songs_read_from_file():
-    """Load songs from pickle file"""
+def songs_read_from_file(songids=None):
+    """Load songs from the local library, all of them or only songids"""
     logger.debug('call function songs_read_from_file')
-    f = open(SONGS_FILE, 'rb')
-    songs = pickle.load(f)
-    f.close()
+    songs = store.records_read(LIBRARY_FILE, 'songs', songids)
     return songs
 
 # sync processes
 
-def albums_sync(params, albums, p_bar):
-    """Sync library albums to local"""
+class SliceSizer(object):
+    """Adapt the slice size to the server response time and payload
+
+    The size doubles while full slices come back well under the targets,
+    it is halved when a slice is too slow, too large or fails.
+    """
+
+    def __init__(self, size):
+        self.size = max(min(size, SLICE_SIZE_MAX), SLICE_SIZE_MIN)
+
+    def feed(self, nb_items, duration, payload):
+        """Update the size with the measures of a fetched slice"""
+        if duration > SLICE_TARGET_TIME or payload > SLICE_TARGET_BYTES:
+            self.shrink()
+        elif nb_items >= self.size and duration < SLICE_TARGET_TIME / 2 \
+                and payload < SLICE_TARGET_BYTES / 2:
+            self.size = min(self.size * 2, SLICE_SIZE_MAX)
+            logger.debug('slice size increased to %i', self.size)
+
+    def shrink(self):
+        """Reduce the size after a slow or failed slice"""
+        self.size = max(self.size // 2, SLICE_SIZE_MIN)
+        logger.debug('slice size reduced to %i', self.size)
+
+def slice_size_save(params, name, size):
+    """Remember the slice size of a request type for this server"""
+    logger.debug('call function slice_size_save')
+    slice_sizes = store.meta_read(LIBRARY_FILE, 'slice_sizes', {})
+    server = params['ip'] + ':' + str(params['port'])
+    slice_sizes.setdefault(server, {})[name] = size
+    store.meta_save(LIBRARY_FILE, 'slice_sizes', slice_sizes)
+
+def slice_size_read(params, name, default):
+    """Return the slice size remembered for this server"""
+    slice_sizes = store.meta_read(LIBRARY_FILE, 'slice_sizes', {})
+    server = params['ip'] + ':' + str(params['port'])
+    return slice_sizes.get(server, {}).get(name, default)
+
+def slice_fetch_timed(fetch, params, start, end):
+    """Fetch a slice, return the items, the duration and the payload size"""
+    fetch_start = time.time()
+    items = fetch(params, start, end)
+    duration = time.time() - fetch_start
+    return items, duration, len(json.dumps(items))
+
+def slices_fetch(params, fetch, nb_items, slice_size):
+    """Fetch items by slices with concurrent requests
+
+    Call fetch(params, start, end) for each slice and yield the slices
+    (start, end, items) in the library order. The number of concurrent
+    requests is set by the 'sync_workers' param. The slice size starts
+    from the size remembered for this server and request type, or from
+    slice_size, and is adapted to the server response times.
+    """
+    logger.debug('call function slices_fetch')
+    workers = params.get('sync_workers', SYNC_WORKERS)
+    sizer = SliceSizer(slice_size_read(params, fetch.__name__, slice_size))
+    pool = ThreadPool(workers)
+    # keep the workers busy while the oldest slice is awaited
+    pending = collections.deque()
+    start = 0
+    try:
+        while start < nb_items or pending:
+            while start < nb_items and len(pending) < 2 * workers:
+                end = min(start + sizer.size, nb_items)
+                logger.info(
+                    'processing slice (items %i to %i in %i)',
+                    start,
+                    end,
+                    nb_items)
+                result = pool.apply_async(
+                    slice_fetch_timed, (fetch, params, start, end))
+                pending.append((start, end, result))
+                start = end
+            slice_start, slice_end, result = pending.popleft()
+            try:
+                items, duration, payload = result.get()
+            except Exception:
+                if sizer.size == SLICE_SIZE_MIN:
+                    raise
+                logger.warning(
+                    'slice %i to %i failed, retry with smaller slices',
+                    slice_start,
+                    slice_end)
+                sizer.shrink()
+                items = []
+                for sub_start in range(slice_start, slice_end, sizer.size):
+                    sub_end = min(sub_start + sizer.size, slice_end)
+                    items += fetch(params, sub_start, sub_end)
+            else:
+                sizer.feed(slice_end - slice_start, duration, payload)
+            yield slice_start, slice_end, items
+    finally:
+        pool.terminate()
+    slice_size_save(params, fetch.__name__, sizer.size)
+
+def albums_changed_fetch(params, watermark):
+    """Fetch the albums added or modified after the watermark"""
+    logger.debug('call function albums_changed_fetch')
+    loop_albums = []
+    start = 0
+    while True:
+        page = rpc.audiolibrary_get_albums_changed(
+            params, watermark, start, start + SLICE_SIZE_MAX)
+        loop_albums += page
+        if len(page) < SLICE_SIZE_MAX:
+            break
+        start += SLICE_SIZE_MAX
+    return loop_albums
+
+def album_merge(albums, loop_album):
+    """Merge an album fetched from Kodi, return True for a new album"""
+    albumid = loop_album['albumid']
+    is_new = not albumid in albums
+    albums[albumid] = store.Album(loop_album)
+    return is_new
+
+def albums_sync(params, albums, p_bar, changes=None):
+    """Sync library albums to local
+
+    The first sync is a full scan. The next ones only fetch the albums
+    added or modified since the watermark of the last sync, update the
+    ratings and drop the albums removed from the library. If a changes
+    dict is given, it is filled with the 'added', 'modified' and 'removed'
+    albumids.
+    """
     logger.debug('call function albums_sync')
     assert is_reachable(params)
-    # get the number of songs
+    # get the number of albums
     limits = rpc.audiolibrary_get_albums_limits(params, 0, 1)
     nb_albums = limits['total']
     if nb_albums == 0:
         logger.info('no albums in this library!')
         return
     logger.debug('total number of albums: %i', nb_albums)
+    # select sync type
+    watermark = watermark_read('albums')
+    full_scan = not (albums and watermark)
+    if not full_scan:
+        watermark_floor(watermark, ALBUMS_WATERMARK_FIELDS)
+        try:
+            loop_albums = albums_changed_fetch(params, watermark)
+        except KeyError:
+            logger.warning('incremental sync rejected by the server')
+            full_scan = True
+    logger.info('full scan: %s', full_scan)
     if p_bar:
         widgets = [
             'Albums: ', Percentage(),
@@ -137,50 +392,147 @@ def albums_sync(params, albums, p_bar):
             ETA()]
         pbar = ProgressBar(widgets=widgets, maxval=nb_albums)
         pbar.start()
-    # slicing and loop
-    slice = 0
-    while True:
-        start = slice * ALBUMS_SLICE_SIZE
-        end = (slice + 1) * ALBUMS_SLICE_SIZE
-        if end > nb_albums:
-            end = nb_albums
-        logger.info(
-            'processing slice %i (songs %i to %i in %i)',
-            slice,
-            start,
-            end,
-            nb_albums)
+    added_albumids = set()
+    modified_albumids = set()
+    albumids = set()
+    # slicing and loop, only the albumids and ratings are listed for a
+    # delta sync, a rating change does not move any date in Kodi
+    if full_scan:
+        watermark = {}
+        fetch = rpc.audiolibrary_get_albums
+    else:
+        delta_albums = []
+        fetch = rpc.audiolibrary_get_albums_delta
+    for start, end, loop_items in slices_fetch(
+            params, fetch, nb_albums, ALBUMS_SLICE_SIZE):
+        if full_scan:
+            for loop_album in loop_items:
+                albumids.add(loop_album['albumid'])
+                if album_merge(albums, loop_album):
+                    added_albumids.add(loop_album['albumid'])
+                else:
+                    modified_albumids.add(loop_album['albumid'])
+            watermark_update(watermark, loop_items, ALBUMS_WATERMARK_FIELDS)
+        else:
+            albumids.update([loop_album['albumid'] for loop_album in loop_items])
+            delta_albums += loop_items
         if p_bar:
-            pbar.update(start)
-        # fetch songs slice data
-        loop_albums = rpc.audiolibrary_get_albums(params, start, end)
-        # update songs dataset
+            pbar.update(end)
+    if not full_scan:
+        # new albums not caught by the watermark
+        missing_albumids = albumids.difference(albums).difference(
+            [loop_album['albumid'] for loop_album in loop_albums])
+        loop_albums += rpc.audiolibrary_get_albums_details(
+            params, sorted(missing_albumids))
         for loop_album in loop_albums:
-            albums[loop_album['albumid']] = loop_album.copy()
-            del albums[loop_album['albumid']]['albumid']
-        if end == nb_albums:
-            break
-        slice += 1
+            if album_merge(albums, loop_album):
+                added_albumids.add(loop_album['albumid'])
+            else:
+                modified_albumids.add(loop_album['albumid'])
+        watermark_update(watermark, loop_albums, ALBUMS_WATERMARK_FIELDS)
+        # rating changes of the albums not fetched
+        fetched_albumids = set(
+            [loop_album['albumid'] for loop_album in loop_albums])
+        for loop_album in delta_albums:
+            albumid = loop_album['albumid']
+            if albumid in fetched_albumids or not albumid in albums:
+                continue
+            if not albums[albumid]['rating'] == loop_album['rating']:
+                logger.info('rating updated for album: %i', albumid)
+                albums[albumid]['rating'] = loop_album['rating']
+                modified_albumids.add(albumid)
+    # the id sets diff gives the removed albums
+    removed_albumids = set(albums).difference(albumids)
+    for albumid in removed_albumids:
+        logger.info('album removed: %i', albumid)
+        del albums[albumid]
     if p_bar:
         pbar.finish()
-    # persist albums dataset
-    albums_save(albums)
-
-def genres_extract(albums, genres):
-    """Extract the genres entity from albums"""
-    logger.debug('call function genres_extract')
-    for album in albums:
-        if not albums[album]['genreid']:
-            continue
-        for i, genreid in enumerate(albums[album]['genreid']):
-            if genreid in genres:
-                continue
-            if i < len(albums[album]['genre']):
-                genres[genreid] = albums[album]['genre'][i]
+    if changes is not None:
+        changes['added'] = added_albumids
+        changes['modified'] = modified_albumids
+        changes['removed'] = removed_albumids
+    # persist albums dataset and watermark
+    if full_scan:
+        albums_save(albums)
+    else:
+        albums_save(albums, added_albumids | modified_albumids | removed_albumids)
+    watermark_save('albums', watermark)
+
+def genres_sync(params, genres):
+    """Sync library genres to local, save the genres file on change"""
+    logger.debug('call function genres_sync')
+    loop_genres = rpc.audiolibrary_get_genres(params)
+    library_genres = dict(
+        (loop_genre['genreid'], loop_genre['label']) for loop_genre in loop_genres)
+    if library_genres == genres:
+        logger.info('genres up to date')
+        return
+    genres.clear()
+    genres.update(library_genres)
     genres_save(genres)
 
-def songs_sync(params, songs, p_bar):
-    """Sync library songs to local"""
+def songs_changed_fetch(params, watermark):
+    """Fetch the songs added, modified or played after the watermark"""
+    logger.debug('call function songs_changed_fetch')
+    loop_songs = []
+    start = 0
+    while True:
+        page = rpc.audiolibrary_get_songs_changed(
+            params, watermark, start, start + SLICE_SIZE_MAX)
+        loop_songs += page
+        if len(page) < SLICE_SIZE_MAX:
+            break
+        start += SLICE_SIZE_MAX
+    return loop_songs
+
+def song_merge(songs, loop_song, rating_up_songids, playcount_up_songids):
+    """Merge a song fetched from Kodi, return True for a new song"""
+    songid = loop_song['songid']
+    song = store.Song(loop_song)
+    if not songid in songs:
+        song['rating_en'] = 0
+        song['playcount_en'] = 0
+        songs[songid] = song
+        return True
+    # keep the echonest sync status of known songs
+    song['rating_en'] = songs[songid].get('rating_en', 0)
+    song['playcount_en'] = songs[songid].get('playcount_en', 0)
+    if not songs[songid]['rating'] == song['rating']:
+        logger.info('rating updated for song: %i', songid)
+        rating_up_songids.append(songid)
+    if not songs[songid]['playcount'] == song['playcount']:
+        logger.info('playcount updated for song: %i', songid)
+        playcount_up_songids.append(songid)
+    songs[songid] = song
+    return False
+
+def song_delta_merge(songs, loop_song, rating_up_songids, playcount_up_songids):
+    """Merge the rating and play count of a known song, True on change"""
+    songid = loop_song['songid']
+    song = songs[songid]
+    is_changed = False
+    if not song['rating'] == loop_song['rating']:
+        logger.info('rating updated for song: %i', songid)
+        song['rating'] = loop_song['rating']
+        rating_up_songids.append(songid)
+        is_changed = True
+    if not song['playcount'] == loop_song['playcount']:
+        logger.info('playcount updated for song: %i', songid)
+        song['playcount'] = loop_song['playcount']
+        playcount_up_songids.append(songid)
+        is_changed = True
+    return is_changed
+
+def songs_sync(params, songs, p_bar, changes=None):
+    """Sync library songs to local
+
+    The first sync is a full scan. The next ones only fetch the songs
+    added, modified or played since the watermark of the last sync,
+    update the ratings and play counts and drop the songs removed from
+    the library. If a changes dict is given, it is filled with the
+    'added', 'modified' and 'removed' songids.
+    """
     logger.debug('call function songs_sync')
     assert is_reachable(params)
     # get the number of songs
@@ -191,10 +543,15 @@ def songs_sync(params, songs, p_bar):
         return
     logger.debug('total number of songs: %i', nb_songs)
     # select sync type
-    if len(songs) == nb_songs:
-        full_scan = False
-    else:
-        full_scan = True
+    watermark = watermark_read('songs')
+    full_scan = not (songs and watermark)
+    if not full_scan:
+        watermark_floor(watermark, SONGS_WATERMARK_FIELDS)
+        try:
+            loop_songs = songs_changed_fetch(params, watermark)
+        except KeyError:
+            logger.warning('incremental sync rejected by the server')
+            full_scan = True
     logger.info('full scan: %s', full_scan)
     if p_bar:
         widgets = [
@@ -204,151 +561,369 @@ def songs_sync(params, songs, p_bar):
             ETA()]
         pbar = ProgressBar(widgets=widgets, maxval=nb_songs)
         pbar.start()
-    # dicts for delta sync
+    # lists for delta sync
     rating_up_songids = []
     playcount_up_songids = []
-    # slicing and loop
-    slice = 0
-    while True:
-        start = slice * SONGS_SLICE_SIZE
-        end = (slice + 1) * SONGS_SLICE_SIZE
-        if end > nb_songs:
-            end = nb_songs
-        logger.info(
-            'processing slice %i (songs %i to %i in %i)',
-            slice,
-            start,
-            end,
-            nb_songs)
-        if p_bar:
-            pbar.update(start)
-        # fetch songs slice data
+    added_songids = set()
+    modified_songids = set()
+    songids = set()
+    # slicing and loop, only the songids, ratings and play counts are
+    # listed for a delta sync, a rating change does not move any date in
+    # Kodi
+    if full_scan:
+        watermark = {}
+        fetch = rpc.audiolibrary_get_songs_full
+    else:
+        delta_songs = []
+        fetch = rpc.audiolibrary_get_songs_delta
+    for start, end, loop_items in slices_fetch(
+            params, fetch, nb_songs, SONGS_SLICE_SIZE):
         if full_scan:
-            loop_songs = rpc.audiolibrary_get_songs_full(params, start, end)
+            for loop_song in loop_items:
+                songids.add(loop_song['songid'])
+                if song_merge(songs, loop_song, rating_up_songids, playcount_up_songids):
+                    added_songids.add(loop_song['songid'])
+                else:
+                    modified_songids.add(loop_song['songid'])
+            watermark_update(watermark, loop_items, SONGS_WATERMARK_FIELDS)
         else:
-            loop_songs = rpc.audiolibrary_get_songs_delta(params, start, end)
-        # update songs dataset
+            songids.update([loop_song['songid'] for loop_song in loop_items])
+            delta_songs += loop_items
+        if p_bar:
+            pbar.update(end)
+    if not full_scan:
+        # new songs not caught by the watermark, e.g. old files
+        missing_songids = songids.difference(songs).difference(
+            [loop_song['songid'] for loop_song in loop_songs])
+        loop_songs += rpc.audiolibrary_get_songs_details(
+            params, sorted(missing_songids))
         for loop_song in loop_songs:
-            if full_scan:
-                songs[loop_song['songid']] = loop_song.copy()
-                del songs[loop_song['songid']]['songid']
-                songs[loop_song['songid']]['rating_en'] = 0
-                songs[loop_song['songid']]['playcount_en'] = 0
+            if song_merge(songs, loop_song, rating_up_songids, playcount_up_songids):
+                added_songids.add(loop_song['songid'])
             else:
-                if not songs[loop_song['songid']]['rating'] == loop_song['rating']:
-                    songs[loop_song['songid']]['rating'] = loop_song['rating']
-                    logger.info('rating updated for song: %i', loop_song['songid'])
-                    rating_up_songids.append(loop_song['songid'])
-                if not songs[loop_song['songid']]['playcount'] == loop_song['playcount']:
-                    songs[loop_song['songid']]['playcount'] = loop_song['playcount']
-                    logger.info('playcount updated for song: %i', loop_song['songid'])
-                    playcount_up_songids.append(loop_song['songid'])
-        if end == nb_songs:
-            break
-        slice += 1
+                modified_songids.add(loop_song['songid'])
+        watermark_update(watermark, loop_songs, SONGS_WATERMARK_FIELDS)
+        # rating and play count changes of the songs not fetched
+        fetched_songids = set([loop_song['songid'] for loop_song in loop_songs])
+        for loop_song in delta_songs:
+            if loop_song['songid'] in fetched_songids \
+                    or not loop_song['songid'] in songs:
+                continue
+            if song_delta_merge(songs, loop_song, rating_up_songids,
+                    playcount_up_songids):
+                modified_songids.add(loop_song['songid'])
+    # the id sets diff gives the removed songs
+    removed_songids = set(songs).difference(songids)
+    for songid in removed_songids:
+        logger.info('song removed: %i', songid)
+        del songs[songid]
     if p_bar:
         pbar.finish()
-    # persist songs dataset
-    songs_save(songs)
+    if changes is not None:
+        changes['added'] = added_songids
+        changes['modified'] = modified_songids
+        changes['removed'] = removed_songids
+    # persist songs dataset, echonest journal and watermark
+    if full_scan:
+        songs_save(songs)
+    else:
+        songs_save(songs, added_songids | modified_songids | removed_songids)
+    store.dirty_add(LIBRARY_FILE,
+        added_songids.union(rating_up_songids, playcount_up_songids))
+    store.dirty_delete(LIBRARY_FILE, removed_songids)
+    if full_scan:
+        songs_ids_save(songs)
+    else:
+        songs_ids_save(songs, added_songids | modified_songids | removed_songids)
+    watermark_save('songs', watermark)
     return full_scan, rating_up_songids, playcount_up_songids
 
 # search
 
-def albums_search(albums, search_string):
-    """Search a string in albums"""
+def record_fields(record):
+    """Return the text fields searched in an album or a song"""
+    return [record['title'], u"/".join(record['artist'])]
+
+def records_keys(records, record_ids=None):
+    """Compute the search keys of the records, all of them or only ids"""
+    if record_ids is None:
+        record_ids = records.keys()
+    return dict((record_id, search.search_keys(record_fields(records[record_id])))
+        for record_id in record_ids if record_id in records)
+
+def records_keys_read(table, records, record_ids, fold_accents):
+    """Read the search keys of the records from the local library
+
+    The keys missing in the library, e.g. saved by a previous version, are
+    computed and saved.
+    """
+    logger.debug('call function records_keys_read')
+    keys = store.keys_read(LIBRARY_FILE, table, record_ids, fold_accents)
+    missing_ids = [record_id for record_id in
+        (records.keys() if record_ids is None else record_ids)
+        if record_id in records and not record_id in keys]
+    if missing_ids:
+        logger.info('compute %i missing search keys', len(missing_ids))
+        missing_keys = records_keys(records, missing_ids)
+        store.keys_save(LIBRARY_FILE, table, missing_keys, missing_ids)
+        for record_id in missing_ids:
+            keys[record_id] = missing_keys[record_id][1 if fold_accents else 0]
+    return keys
+
+def records_index_update(index, table, records, record_ids):
+    """Update the search index for the given records ids"""
+    keys = records_keys_read(table, records, record_ids, index['fold_accents'])
+    for record_id in record_ids:
+        search.index_remove(index, record_id)
+        if record_id in records:
+            search.index_add(index, record_id, keys[record_id])
+
+def records_index_build(table, records, fold_accents):
+    """Build the search index of the records from their search keys"""
+    index = search.index_create(fold_accents)
+    keys = records_keys_read(table, records, None, fold_accents)
+    for record_id in records.keys():
+        search.index_add(index, record_id, keys[record_id])
+    return index
+
+def albums_index_build(albums, fold_accents=SEARCH_FOLD_ACCENTS):
+    """Build the search index of the albums"""
+    logger.debug('call function albums_index_build')
+    return records_index_build('albums', albums, fold_accents)
+
+def albums_index_update(index, albums, albumids):
+    """Update the search index of the albums for the given ids"""
+    logger.debug('call function albums_index_update')
+    records_index_update(index, 'albums', albums, albumids)
+
+def albums_search(albums, search_string, index=None,
+        fold_accents=SEARCH_FOLD_ACCENTS):
+    """Search a string in albums, with the search index if given
+
+    Without index, the search keys are computed as the index does, the
+    accents being ignored if fold_accents.
+    """
     logger.debug('call function albums_search')
+    if index is not None:
+        return search.index_search(index, search_string)
+    search_string = search.query_key(search_string, fold_accents)
     search_result_title = []
     search_result_artist = []
     for albumid in albums.keys():
-        if search_string in albums[albumid]['title'].encode('utf-8').lower():
+        title, artist = record_fields(albums[albumid])
+        if search_string in search.search_key(title, fold_accents):
             search_result_title.append(albumid)
-        if search_string in "/".join(albums[albumid]['artist']).encode('utf-8').lower():
+        if search_string in search.search_key(artist, fold_accents):
             search_result_artist.append(albumid)
     logger.debug('search result by title: %s', search_result_title)
     logger.debug('search result by artist: %s', search_result_artist)
     return sorted(list(set(search_result_title + search_result_artist)))
 
-def genres_search(genres, search_string):
-    """Search a string in genres"""
+def albums_fuzzy(albums, search_string, index=None, limit=FUZZY_LIMIT):
+    """Ranked search of a string in albums, tolerant to typos"""
+    logger.debug('call function albums_fuzzy')
+    if index is None:
+        index = albums_index_build(albums)
+    return search.index_fuzzy(index, search_string, limit)
+
+def genres_index_build(genres, fold_accents=SEARCH_FOLD_ACCENTS):
+    """Build the search index of the genres"""
+    logger.debug('call function genres_index_build')
+    index = search.index_create(fold_accents)
+    for genreid in genres.keys():
+        search.index_add(index, genreid,
+            [search.search_key(genres[genreid], fold_accents)])
+    return index
+
+def genres_search(genres, search_string, index=None,
+        fold_accents=SEARCH_FOLD_ACCENTS):
+    """Search a string in genres, with the search index if given
+
+    Without index, the search keys are computed as the index does, the
+    accents being ignored if fold_accents.
+    """
     logger.debug('call function genres_search')
+    if index is not None:
+        return search.index_search(index, search_string)
+    search_string = search.query_key(search_string, fold_accents)
     search_result = []
     for genreid in genres.keys():
-        if search_string in genres[genreid].encode('utf-8').lower():
+        if search_string in search.search_key(genres[genreid], fold_accents):
             search_result.append(genreid)
     logger.debug('search result: %s', search_result)
     return sorted(search_result)
 
-def songs_search(songs, search_string):
-    """Search a string in songs"""
+def genres_fuzzy(genres, search_string, index=None, limit=FUZZY_LIMIT):
+    """Ranked search of a string in genres, tolerant to typos"""
+    logger.debug('call function genres_fuzzy')
+    if index is None:
+        index = genres_index_build(genres)
+    return search.index_fuzzy(index, search_string, limit)
+
+def songs_index_build(songs, fold_accents=SEARCH_FOLD_ACCENTS):
+    """Build the search index of the songs"""
+    logger.debug('call function songs_index_build')
+    return records_index_build('songs', songs, fold_accents)
+
+def songs_index_update(index, songs, songids):
+    """Update the search index of the songs for the given ids"""
+    logger.debug('call function songs_index_update')
+    records_index_update(index, 'songs', songs, songids)
+
+def songs_search(songs, search_string, index=None,
+        fold_accents=SEARCH_FOLD_ACCENTS):
+    """Search a string in songs, with the search index if given
+
+    Without index, the search keys are computed as the index does, the
+    accents being ignored if fold_accents.
+    """
     logger.debug('call function songs_search')
+    if index is not None:
+        return search.index_search(index, search_string)
+    search_string = search.query_key(search_string, fold_accents)
     search_result_title = []
     search_result_artist = []
     for songid in songs.keys():
-        if search_string in songs[songid]['title'].encode('utf-8').lower():
+        title, artist = record_fields(songs[songid])
+        if search_string in search.search_key(title, fold_accents):
             search_result_title.append(songid)
-        if search_string in "/".join(songs[songid]['artist']).encode('utf-8').lower():
+        if search_string in search.search_key(artist, fold_accents):
             search_result_artist.append(songid)
     logger.debug('search result by title: %s', search_result_title)
     logger.debug('search result by artist: %s', search_result_artist)
     return sorted(list(set(search_result_title + search_result_artist)))
 
-# playlist
+def songs_fuzzy(songs, search_string, index=None, limit=FUZZY_LIMIT):
+    """Ranked search of a string in songs, tolerant to typos"""
+    logger.debug('call function songs_fuzzy')
+    if index is None:
+        index = songs_index_build(songs)
+    return search.index_fuzzy(index, search_string, limit)
 
-def playlist_items(params):
-    """Return items playlist"""
-    logger.debug('call playlist_items')
-    items = rpc.playlist_get_items(params)
-    return items
-
-def playlist_songids(params):
-    """Fetch playlist items"""
-    logger.debug('call playlist_songids')
-    items = rpc.playlist_get_items(params)
-    songids = [item['id'] for item in items]
-    return songids
+# playlist
 
 def playlist_clear(params):
     """Clear the audio playlist"""
     rpc.playlist_clear(params)
 
+def playlist_add_items(params, item_type, item_ids):
+    """Add items to the playlist by chunks, return the ids that failed
+
+    The chunk size can be set with the 'playlist_chunk_size' param.
+    """
+    logger.debug('call playlist_add_items')
+    chunk_size = params.get('playlist_chunk_size', PLAYLIST_CHUNK_SIZE)
+    failed_ids = []
+    for start in range(0, len(item_ids), chunk_size):
+        chunk = item_ids[start:start + chunk_size]
+        rets = rpc.playlist_add_batch(params, item_type, chunk)
+        for item_id, ret in zip(chunk, rets):
+            if 'error' in ret:
+                failed_ids.append(item_id)
+    logger.debug('items not added: %s', failed_ids)
+    return failed_ids
+
 def playlist_add_albums(params, albumids):
     """Add albumids list to the playlist"""
     logger.debug('call playlist_add_albums')
-    for albumid in albumids:
-        rpc.playlist_add(params, ALBUM, albumid)
+    return playlist_add_items(params, ALBUM, albumids)
 
 def playlist_add_genres(params, genreids):
     """Add genreids list to the playlist"""
     logger.debug('call playlist_add_genres')
-    for genreid in genreids:
-        rpc.playlist_add(params, GENRE, genreid)
+    return playlist_add_items(params, GENRE, genreids)
 
 def playlist_add_songs(params, songids):
     """Add songids list to the playlist"""
     logger.debug('call playlist_add_songs')
-    for songid in songids:
-        rpc.playlist_add(params, SONG, songid)
+    return playlist_add_items(params, SONG, songids)
 
 
-# player
+# player state
+
+def state_listen(params, state):
+    """Maintain the player state from the Kodi notifications
+
+    The state dict caches the result of player_status. It is dropped by
+    the notifications that change the player or the playlist, so it is
+    only fetched again after a change. Requires the TCP interface.
+    """
+    logger.debug('call function state_listen')
+    state['status'] = None
+    state['generation'] = 0
+    def on_notification(method, data):
+        if method in STATE_NOTIFICATIONS:
+            logger.debug('player state invalidated by %s', method)
+            state['generation'] += 1
+            state['status'] = None
+    rpc.notifications_listen(params, on_notification)
+    state['params'] = params
+    state['listener'] = on_notification
+    state['listening'] = True
+
+def state_unlisten(state):
+    """Stop maintaining a player state, e.g. before a new one"""
+    logger.debug('call function state_unlisten')
+    if state.get('listening'):
+        rpc.notifications_unlisten(state['params'], state['listener'])
+    state['listening'] = False
+    state['status'] = None
+
+def time_seconds(kodi_time):
+    """Convert a Kodi time dict to seconds"""
+    return kodi_time['hours'] * 3600 + kodi_time['minutes'] * 60 + \
+        kodi_time['seconds'] + kodi_time.get('milliseconds', 0) / 1000.0
+
+def time_kodi(seconds):
+    """Convert seconds to a Kodi time dict"""
+    return {
+        'hours': int(seconds // 3600),
+        'minutes': int(seconds % 3600 // 60),
+        'seconds': int(seconds % 60),
+        'milliseconds': int(seconds * 1000 % 1000)
+    }
 
-def player_properties(params):
-    """Return the played time of the current song"""
-    logger.debug('call player_properties')
-    properties = rpc.player_get_properties(params)
+def player_properties_now(properties, fetch_time):
+    """Extrapolate the played time since the properties were fetched"""
+    if not properties.get('speed'):
+        return properties
+    total = time_seconds(properties['totaltime'])
+    played = time_seconds(properties['time']) + \
+        (time.time() - fetch_time) * properties['speed']
+    played = max(min(played, total), 0)
+    properties = dict(properties)
+    properties['time'] = time_kodi(played)
+    if total:
+        properties['percentage'] = 100.0 * played / total
     return properties
 
-def player_position(params):
-    """Return the current playing item in the playlist"""
-    logger.debug('call player_position')
-    properties = rpc.player_get_properties(params)
-    return properties['position']
+# player
 
-def player_item(params):
-    """Return the played time of the current song"""
-    logger.debug('call player_properties')
-    item = rpc.player_get_item(params)
-    return item
+def player_status(params, state=None):
+    """Return playlist items, played item and properties in one call
+
+    With a state maintained by state_listen, the status is answered
+    locally until a notification reports a change.
+    """
+    logger.debug('call player_status')
+    if not (state and state.get('listening')):
+        items, item, properties = rpc.player_get_status(params)
+        return items, item, properties
+    if not rpc.notifications_connected(params):
+        state['status'] = None
+    status = state['status']
+    if status is None:
+        generation = state['generation']
+        fetch_time = time.time()
+        items, item, properties = rpc.player_get_status(params)
+        status = (items, item, properties, fetch_time)
+        # keep the status only if nothing changed in the meantime
+        if generation == state['generation']:
+            state['status'] = status
+    else:
+        logger.debug('player status from state')
+    items, item, properties, fetch_time = status
+    return items, item, player_properties_now(properties, fetch_time)
 
 def player_songid(params):
     """Return the currently played item"""
@@ -381,6 +956,97 @@ def playback_stop(params):
     if rpc.player_get_active(params):
         rpc.player_stop(params)
 
+# library statistics
+
+def songs_columns(songs):
+    """Build the columnar view of the songs for the statistics"""
+    logger.debug('call function songs_columns')
+    return stats.columns_build(songs)
+
+def library_stats(columns, year_from=None, year_to=None):
+    """Compute the totals and histograms of the songs
+
+    The songs can be restricted to a range of release years. Genres are
+    sorted by number of songs, each song counting for its first genre.
+    """
+    logger.debug('call function library_stats')
+    by_year = columns['by_year']
+    start, end = stats.between(by_year['year'], year_from, year_to)
+    playcounts = by_year['playcount'][start:end]
+    ratings = by_year['rating'][start:end]
+    # songs without year are not in the decades
+    dated_start, dated_end = stats.between(by_year['year'], 1, None, start, end)
+    genres = []
+    by_genre = columns['by_genre']
+    for code, run_start, run_end in stats.runs(by_genre['genre']):
+        run_start, run_end = stats.between(
+            by_genre['year'], year_from, year_to, run_start, run_end)
+        if run_start == run_end:
+            continue
+        genres.append((
+            columns['genres'][code] if code >= 0 else None,
+            run_end - run_start,
+            sum(by_genre['duration'][run_start:run_end])
+        ))
+    genres.sort(key=lambda genre: genre[1], reverse=True)
+    return {
+        'songs': end - start,
+        'duration': sum(by_year['duration'][start:end]),
+        'playcount': sum(playcounts),
+        'played': stats.count_nonzero(playcounts),
+        'rated': stats.count_nonzero(ratings),
+        'decades': stats.histogram_buckets(
+            by_year['year'], 10, dated_start, dated_end),
+        'ratings': stats.histogram(ratings),
+        'genres': genres
+    }
+
+# local recommendations
+
+def recommend_model(songs):
+    """Build the local recommendation model of the songs"""
+    logger.debug('call function recommend_model')
+    return recommend.model_build(songs)
+
+def local_playlist(model, size=PLAYLIST_SIZE):
+    """Create a playlist from the local taste"""
+    logger.debug('call function local_playlist')
+    return recommend.playlist(model, size)
+
+def local_playlist_seed_song(model, songid, size=PLAYLIST_SIZE):
+    """Create a playlist from the local taste seeded by a song"""
+    logger.debug('call function local_playlist_seed_song')
+    return recommend.playlist_seed_song(model, songid, size)
+
+def local_playlist_seed_song_type(model, song_type, size=PLAYLIST_SIZE):
+    """Create a playlist from the local taste seeded by a song type"""
+    logger.debug('call function local_playlist_seed_song_type')
+    return recommend.playlist_song_type(model, song_type, size)
+
+def similar_index_build(songs):
+    """Build the similar songs index, None without NumPy"""
+    logger.debug('call function similar_index_build')
+    if not similar.available():
+        logger.info('NumPy not installed, no similar songs index')
+        return None
+    return similar.index_build(songs)
+
+def similar_index_update(index, songs, songids):
+    """Update the similar songs index with the songids changed"""
+    logger.debug('call function similar_index_update')
+    similar.index_update(index, songs, songids)
+
+def songs_similar(index, model, songid, size=SIMILAR_SIZE):
+    """Return the songids of the songs most similar to songid
+
+    The similar songs index is used if any, the recommendation model
+    otherwise.
+    """
+    logger.debug('call function songs_similar')
+    if index is not None:
+        return similar.knn(index, [songid], size)[0]
+    return recommend.similar(model, songid, size)
+
 # volume
 
 def volume_set(params, volume):
@@ -388,17 +1054,117 @@ def volume_set(params, volume):
     logger.debug('call function volume_set')
     rpc.application_set_volume(params, volume)
 
-# echonest
+# id maps
+
+def en_foreign_id(profile_id, songid):
+    """Return the foreign id of a song uploaded to the echonest profile"""
+    return profile_id + ':song:' + str(songid)
+
+def id_maps_create():
+    """Return empty id maps
+
+    mbid: the MusicBrainz ID of each songid
+    mbid_songid: the songid of each MusicBrainz ID
+    foreign_id: the echonest foreign id of each songid uploaded
+    foreign_id_songid: the songid of each echonest foreign id
+    """
+    return {'mbid': {}, 'mbid_songid': {}, 'foreign_id': {}, 'foreign_id_songid': {}}
+
+def id_maps_remove(maps, songid):
+    """Remove a songid from the id maps"""
+    for name in ('mbid', 'foreign_id'):
+        value = maps[name].pop(songid, None)
+        if value is not None and maps[name + '_songid'].get(value) == songid:
+            del maps[name + '_songid'][value]
+
+def id_maps_set(maps, songid, mbid, foreign_id):
+    """Set the ids of a songid in the id maps"""
+    id_maps_remove(maps, songid)
+    if mbid:
+        maps['mbid'][songid] = mbid
+        maps['mbid_songid'][mbid] = songid
+    if foreign_id:
+        maps['foreign_id'][songid] = foreign_id
+        maps['foreign_id_songid'][foreign_id] = songid
+
+def songs_ids_save(songs, songids=None, profile_id=None, maps=None):
+    """Save the ids of songids, all the songs if None
+
+    The MusicBrainz IDs are read from songs. The foreign ids are set for
+    profile_id if given, the known ones are kept otherwise. The removed
+    songs are deleted. The maps, if given, are updated too.
+    """
+    logger.debug('call function songs_ids_save')
+    known = store.ids_read(LIBRARY_FILE, songids)
+    rows = {}
+    for songid in songs if songids is None else songids:
+        if not songid in songs:
+            continue
+        mbid = songs[songid]['musicbrainztrackid'] or None
+        if profile_id and mbid:
+            foreign_id = en_foreign_id(profile_id, songid)
+        else:
+            foreign_id = known.get(songid, (None, None))[1]
+        rows[songid] = (mbid, foreign_id)
+    store.ids_save(LIBRARY_FILE, rows, songids)
+    if maps is not None:
+        if songids is None:
+            maps.update(id_maps_create())
+            songids = rows
+        for songid in songids:
+            if songid in rows:
+                id_maps_set(maps, songid, *rows[songid])
+            else:
+                id_maps_remove(maps, songid)
+    return rows
 
-def en_ban(api_key, profile_id, songid):
-    """Toggle ban flag in echonest"""
-    logger.debug('call function en_ban')
-    echonest.tasteprofile_ban(api_key, profile_id, str(songid))
+def id_maps_read(songs, profile_id):
+    """Return the id maps of the library
 
-def en_delete(api_key, profile_id):
-    """Delete the echonest tasteprofile"""
+    The maps are built from the songs at the first call, their foreign
+    ids are set for profile_id as the songs synced before had no maps.
+    """
+    logger.debug('call function id_maps_read')
+    if store.meta_read(LIBRARY_FILE, 'songs_ids', False):
+        rows = store.ids_read(LIBRARY_FILE)
+    else:
+        rows = songs_ids_save(songs, None, profile_id)
+        store.meta_save(LIBRARY_FILE, 'songs_ids', True)
+    maps = id_maps_create()
+    for songid, (mbid, foreign_id) in rows.iteritems():
+        id_maps_set(maps, songid, mbid, foreign_id)
+    return maps
+
+def en_songids(maps, en_songs):
+    """Return the songids of the echonest songs still in the library"""
+    songids = []
+    for en_song in en_songs:
+        for foreign_id in en_song.get('foreign_ids', []):
+            songid = maps['foreign_id_songid'].get(foreign_id['foreign_id'])
+            if songid is not None:
+                songids.append(songid)
+                break
+        else:
+            logger.info('song %s not in the library', en_song.get('id'))
+    return songids
+
+def en_song_id(maps, songid):
+    """Return the echonest id of a songid, None if unknown to echonest"""
+    if songid in maps['foreign_id']:
+        return maps['foreign_id'][songid]
+    if songid in maps['mbid']:
+        return echonest.mbid_song_id(maps['mbid'][songid])
+    return None
+
+# echonest
+
+def en_delete(api_key, profile_id, cache=None):
+    """Delete the echonest tasteprofile, forget the cached profile and ids"""
     logger.debug('call en_delete')
     echonest.tasteprofile_delete(api_key, profile_id)
+    store.ids_foreign_clear(LIBRARY_FILE)
+    if cache is not None:
+        cache.clear()
 
 def en_display(api_key, profile_id, songid):
     """Display song detail from tasteprofile"""
@@ -406,122 +1172,211 @@ def en_display(api_key, profile_id, songid):
     item = echonest.tasteprofile_read(str(songid), api_key, profile_id)
     return item
 
-def en_favorite(api_key, profile_id, songid):
-    """Toggle favorite flag in echonest"""
-    logger.debug('call function en_favorite')
-    echonest.tasteprofile_favorite(api_key, profile_id, str(songid))
-
-def en_info(api_key, profile_id):
-    """Fetch echonest taste profile info"""
+def en_info(api_key, profile_id, cache=None):
+    """Fetch echonest taste profile info, from the cache if fresh"""
     logger.debug('call en_info')
+    if (cache is not None and cache.get('id') == profile_id
+            and time.time() - cache.get('info_time', 0) < EN_INFO_TTL):
+        logger.debug('profile info from cache')
+        return cache['info']
     en_info = echonest.tasteprofile_profile_id(api_key, profile_id)
+    if cache is not None and cache.get('id') == profile_id:
+        cache['info'] = en_info
+        cache['info_time'] = time.time()
     return en_info
 
-def en_sync(api_key, profile_id, songs, p_bar):
-    """Sync songs with echonest tasteprofile"""
+def en_sync_songids(songs, songids, full, progress):
+    """Yield the songids to sync, all of them if full or the changed ones
+
+    The songs without MusicBrainz ID are unknown to echonest and skipped,
+    as the songids not in songs. The number of songids scanned is kept in
+    progress.
+    """
+    for songid in songids:
+        progress['scanned'] += 1
+        song = songs.get(songid)
+        if song is None:
+            continue
+        if not song['musicbrainztrackid']:
+            logger.debug('song %i skipped, no MusicBrainz ID', songid)
+            continue
+        if full or not (song['rating'] == song['rating_en']
+                and song['playcount'] == song['playcount_en']):
+            yield songid
+
+def en_sync_items(songs, songids):
+    """Yield the update commands of songids, keyed by the values sent"""
+    for songid in songids:
+        song = songs[songid]
+        yield (songid, song['rating'], song['playcount']), echonest.song_item(
+            str(songid),
+            song['musicbrainztrackid'],
+            rating=song['rating'],
+            play_count=song['playcount'])
+
+def en_sync_submit(api_key, profile_id, batch, tracker, attempt=0):
+    """Submit a batch of updates, return False if refused
+
+    The batch is (sent, data), sent being the songids with the values in
+    data, they are the sync markers of the songs once the ticket of the
+    batch is complete.
+    """
+    logger.debug('call function en_sync_submit')
+    sent, data = batch
+    while True:
+        ticket = echonest.tasteprofile_update(data, api_key, profile_id)
+        if ticket is not None:
+            tracker.add(ticket, (batch, attempt))
+            return True
+        if attempt >= EN_SYNC_RETRIES:
+            return False
+        attempt += 1
+        logger.info('update refused, attempt %i', attempt)
+
+def en_sync_confirm(api_key, profile_id, songs, finished, tracker,
+        synced, failed, id_maps=None):
+    """Commit the sync markers and the foreign ids of the complete tickets
+
+    The batches of the tickets in error are resubmitted up to
+    EN_SYNC_RETRIES times. The songids are added to synced or failed.
+    """
+    logger.debug('call function en_sync_confirm')
+    for ticket, (batch, attempt), status in finished:
+        sent = batch[0]
+        if status['ticket_status'] == 'complete':
+            for songid, (rating, playcount) in sent.iteritems():
+                songs[songid]['rating_en'] = rating
+                songs[songid]['playcount_en'] = playcount
+            songs_save(songs, sent.keys())
+            store.dirty_delete(LIBRARY_FILE, sent.keys())
+            songs_ids_save(songs, sent.keys(), profile_id, id_maps)
+            synced.extend(sent)
+        elif attempt < EN_SYNC_RETRIES:
+            logger.info('ticket %s in error, batch resubmitted', ticket)
+            if not en_sync_submit(api_key, profile_id, batch, tracker,
+                    attempt + 1):
+                failed.extend(sent)
+        else:
+            logger.info('ticket %s in error, batch dropped', ticket)
+            failed.extend(sent)
+
+def en_sync(api_key, profile_id, songs, p_bar, cache=None, id_maps=None):
+    """Sync songs with echonest tasteprofile, return synced and failed songids
+
+    The songs to sync are streamed into batches packed by size, each
+    batch is submitted while the tickets of the previous ones are polled
+    in the background. The sync markers rating_en and playcount_en are
+    only saved for the complete tickets, the songs failing or still
+    pending after EN_TICKET_TIMEOUT are left for the next sync.
+
+    A delta sync only checks the songs of the journal written by
+    songs_sync, they are cleared from it once uploaded. The whole library
+    is scanned by the first sync of the journal. The id maps, if given,
+    get the foreign ids of the uploaded songs. The cached profile
+    metadata, if any, is outdated by the sync.
+    """
+    if cache is not None:
+        cache.pop('info_time', None)
     en_info = echonest.tasteprofile_profile_id(api_key, profile_id)
-    if en_info['total'] == 0:
-        logger.info("full sync")
-        songids = songs.keys()
+    full = en_info['total'] == 0
+    logger.info("full sync" if full else "delta sync")
+    journal = store.dirty_read(LIBRARY_FILE)
+    scan = full or not store.meta_read(LIBRARY_FILE, 'songs_dirty', False)
+    if scan:
+        candidates = songs.keys()
     else:
-        logger.info("delta sync")
-        songids = []
-        for songid in songs:
-            if not (songs[songid]['rating'] == songs[songid]['rating_en']
-                    and songs[songid]['playcount'] == songs[songid]['playcount_en']):
-                songids.append(songid)
-        logger.debug("songs to sync: %s", songids)
-    nb_songs = len(songids)
-    logger.debug("numer of songs to sync: %s", nb_songs)
-    if nb_songs == 0:
-        logger.debug("no songs to sync")
-        return songids
+        candidates = sorted(journal)
+    logger.debug('songs checked: %i', len(candidates))
+    progress = {'scanned': 0}
+    songids = en_sync_songids(songs, candidates, full, progress)
     if p_bar:
+        # the progress is the part of the songs checked
         widgets = [
             'Songs: ', Percentage(),
             ' ', Bar(marker='#',left='[',right=']'),
-            ' (', Counter(), ' in ' + str(nb_songs) + ') ',
+            ' (', Counter(), ' in ' + str(len(candidates)) + ') ',
             ETA()
         ]
-        pbar = ProgressBar(widgets=widgets, maxval=nb_songs)
+        pbar = ProgressBar(widgets=widgets, maxval=len(candidates))
         pbar.start()
-    # slicing and loop
-    slice = 0
-    while True:
-        start = slice * SONGS_EN_SLICE_SIZE
-        end = (slice + 1) * SONGS_EN_SLICE_SIZE
-        if end > nb_songs:
-            end = nb_songs
-        logger.info(
-            'processing slice %i (songs %i to %i in %i)',
-            slice,
-            start,
-            end,
-            nb_songs)
-        if p_bar:
-            pbar.update(start)
-        items = {}
-        for song_index in range(start, end):
-            songid = songids[song_index]
-            mb_song_id = 'musicbrainz:song:' + songs[songid]['musicbrainztrackid']
-            items[str(songid)] = {}
-            items[str(songid)]['song_id'] = mb_song_id
-            items[str(songid)]['rating'] = songs[songid]['rating']
-            items[str(songid)]['play_count'] = songs[songid]['playcount']
-            songs[songid]['rating_en'] = songs[songid]['rating']
-            songs[songid]['playcount_en'] = songs[songid]['playcount']
-        echonest.tasteprofile_update(items, api_key, profile_id)
-        if end == nb_songs:
-            break
-        slice +=1
-        time.sleep(EN_API_WAIT)
+    submitted = []
+    synced = []
+    failed = []
+    nb_batches = 0
+    tracker = echonest.TicketTracker(api_key)
+    try:
+        # batches loop, the tickets are confirmed along
+        for keys, data in echonest.update_batches(en_sync_items(songs, songids)):
+            logger.info('processing batch %i (%i songs, %i bytes)',
+                nb_batches, len(keys), len(data))
+            sent = dict((songid, (rating, playcount))
+                for songid, rating, playcount in keys)
+            submitted.extend(sent)
+            if not en_sync_submit(api_key, profile_id, (sent, data), tracker):
+                failed.extend(sent)
+            nb_batches += 1
+            en_sync_confirm(api_key, profile_id, songs, tracker.done(),
+                tracker, synced, failed, id_maps)
+            if p_bar:
+                pbar.update(progress['scanned'])
+        # remaining tickets
+        deadline = time.time() + EN_TICKET_TIMEOUT
+        while len(tracker) and time.time() < deadline:
+            en_sync_confirm(api_key, profile_id, songs,
+                tracker.wait(deadline - time.time()), tracker, synced, failed,
+                id_maps)
+    finally:
+        tracker.close()
+    if len(tracker):
+        logger.info('%i tickets still pending', len(tracker))
+    # the songs not uploaded stay in the journal, the others had no change
+    submitted = set(submitted)
+    store.dirty_add(LIBRARY_FILE, submitted.difference(synced))
+    store.dirty_delete(LIBRARY_FILE, journal.difference(submitted))
+    store.meta_save(LIBRARY_FILE, 'songs_dirty', True)
     if p_bar:
         pbar.finish()
-    songs_save(songs)
-    return songids
+    return synced, failed
 
 def en_status(api_key, ticket):
-    """Check ticket status"""
+    """Return the status of an update ticket"""
     logger.debug('call en_status')
-    echonest.tasteprofile_status(ticket, api_key)
+    return echonest.tasteprofile_status(ticket, api_key)
 
-def en_playlist(api_key, profile_id):
+def en_playlist(api_key, profile_id, id_maps):
     """Create a static playlist"""
     logger.debug('call en_playlist')
     en_songs = echonest.playlist_static(api_key, profile_id)
-    songids = []
-    for en_song in en_songs:
-        en_id = en_song['foreign_ids'][0]['foreign_id']
-        songid = int(en_id.replace(profile_id + ':song:', ""))
-        songids.append(songid)
-    return songids
+    return en_songids(id_maps, en_songs)
 
-def en_playlist_seed_song(api_key, profile_id, songid):
+def en_playlist_seed_song(api_key, profile_id, songid, id_maps):
     """Create a static playlist with a seed song"""
     logger.debug('call en_playlist_seed_song')
-    song_id = profile_id + ':song:' + str(songid)
+    song_id = en_song_id(id_maps, songid)
+    if song_id is None:
+        logger.info('song %i unknown to echonest', songid)
+        return []
     en_songs = echonest.playlist_static_seed_song(song_id, api_key, profile_id)
-    songids = []
-    for en_song in en_songs:
-        en_id = en_song['foreign_ids'][0]['foreign_id']
-        songid = int(en_id.replace(profile_id + ':song:', ""))
-        songids.append(songid)
-    return songids
+    return en_songids(id_maps, en_songs)
 
-def en_playlist_seed_song_type(api_key, profile_id, song_type):
+def en_playlist_seed_song_type(api_key, profile_id, song_type, id_maps):
     """Create a static playlist with a seed song type"""
     logger.debug('call en_playlist_seed_song_type')
     en_songs = echonest.playlist_static_seed_type(song_type, api_key, profile_id)
-    songids = []
-    for en_song in en_songs:
-        en_id = en_song['foreign_ids'][0]['foreign_id']
-        songid = int(en_id.replace(profile_id + ':song:', ""))
-        songids.append(songid)
-    return songids
+    return en_songids(id_maps, en_songs)
+
+def en_profile_id(api_key, cache=None):
+    """Get echonest profile profile ID
 
-def en_profile_id(api_key):
-    """Get echonest profile profile ID"""
+    If a cache dict is given, the ID is read from it while fresh for this
+    API key, otherwise it is fetched and stored in the cache with the
+    profile metadata. The caller persists the cache.
+    """
     logger.debug('call get_profile_id')
+    if (cache is not None and cache.get('api_key') == api_key
+            and time.time() - cache.get('time', 0) < EN_PROFILE_TTL):
+        logger.debug('profile id from cache: %s', cache['id'])
+        return cache['id']
     ret = echonest.tasteprofile_profile_name(api_key)
     if not 'catalog' in ret:
         logger.info('no taste profile found, will create one')
@@ -529,9 +1384,131 @@ def en_profile_id(api_key):
         ret = echonest.tasteprofile_profile_name(api_key)
     profile_id = ret['catalog']['id']
     logger.debug('profile id: %s', profile_id)
+    if cache is not None:
+        cache.clear()
+        cache.update({
+            'api_key': api_key,
+            'id': profile_id,
+            'time': time.time(),
+            'info': ret['catalog'],
+            'info_time': time.time()
+        })
     return profile_id
 
-def en_skip(api_key, profile_id, songid):
-    """Toggle favorite flag in echonest"""
-    logger.debug('call function en_skip')
-    echonest.tasteprofile_skip(api_key, profile_id, str(songid))
+# echonest feedback queue
+
+def en_feedback(songid, action, worker=None):
+    """Queue a ban, favorite or skip feedback, flushed by the worker"""
+    logger.debug('call function en_feedback')
+    store.feedback_add(LIBRARY_FILE, songid, action)
+    if worker is not None:
+        worker.notify()
+
+def en_feedback_count():
+    """Return the number of feedback waiting for the worker"""
+    return store.feedback_count(LIBRARY_FILE)
+
+def en_feedback_confirm(tickets, failed):
+    """Delete the feedback of the complete tickets, add the others to failed"""
+    for ticket, ids, status in tickets:
+        if status['ticket_status'] == 'complete':
+            store.feedback_delete(LIBRARY_FILE, ids)
+        else:
+            failed.extend(ids)
+
+def en_feedback_flush(api_key, profile_id):
+    """Send the queued feedback in update batches, return True if all sent
+
+    The feedback is deleted from the queue once its ticket is complete,
+    an attempt is counted otherwise, also for the tickets still pending
+    after EN_TICKET_TIMEOUT.
+    """
+    logger.debug('call function en_feedback_flush')
+    entries = store.feedback_read(LIBRARY_FILE)
+    if not entries:
+        return True
+    items = ((entry['id'], echonest.feedback_item(
+        str(entry['songid']), entry['action'])) for entry in entries)
+    failed = []
+    tracker = echonest.TicketTracker(api_key)
+    try:
+        for ids, data in echonest.update_batches(items):
+            logger.info('feedback batch of %i actions', len(ids))
+            ticket = echonest.tasteprofile_update(data, api_key, profile_id)
+            if ticket is None:
+                failed.extend(ids)
+            else:
+                tracker.add(ticket, ids)
+        deadline = time.time() + EN_TICKET_TIMEOUT
+        while len(tracker) and time.time() < deadline:
+            en_feedback_confirm(tracker.wait(deadline - time.time()), failed)
+    finally:
+        tracker.close()
+        en_feedback_confirm(tracker.done(), failed)
+        # the feedback of the pending tickets is sent again by the next
+        # flush, so that an update never confirmed is not sent forever
+        for ids in tracker.pending_data():
+            logger.info('feedback ticket still pending, %i actions', len(ids))
+            failed.extend(ids)
+        if failed:
+            dropped = store.feedback_failed(
+                LIBRARY_FILE, failed, FEEDBACK_ATTEMPTS)
+            if dropped:
+                logger.info('%i feedback dropped after %i attempts',
+                    dropped, FEEDBACK_ATTEMPTS)
+    return store.feedback_count(LIBRARY_FILE) == 0
+
+class FeedbackWorker(object):
+    """Flush the echonest feedback queue in a background thread
+
+    The queue is flushed at start, then FEEDBACK_FLUSH_DELAY after each
+    notification so that close feedback share a batch. A failed flush is
+    retried with an exponential backoff, the queue being on disk the
+    feedback is also kept for the next session. profile_id is the echonest
+    profile ID, resolved by the caller: while it is None, the queue is kept
+    and the flush retried. It can be set at any time.
+    """
+
+    def __init__(self, api_key, profile_id):
+        self.api_key = api_key
+        self.profile_id = profile_id
+        self.pending = threading.Event()
+        self.closed = threading.Event()
+        self.pending.set()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def notify(self):
+        """Signal new feedback in the queue"""
+        self.pending.set()
+
+    def close(self, timeout=None):
+        """Stop the worker, the queue is kept for the next start"""
+        self.closed.set()
+        self.pending.set()
+        self.thread.join(timeout)
+
+    def run(self):
+        retry_wait = FEEDBACK_RETRY_WAIT
+        while True:
+            self.pending.wait()
+            self.closed.wait(FEEDBACK_FLUSH_DELAY)
+            if self.closed.is_set():
+                return
+            self.pending.clear()
+            profile_id = self.profile_id
+            try:
+                flushed = en_feedback_count() == 0 or (profile_id is not None
+                    and en_feedback_flush(self.api_key, profile_id))
+            except Exception as e:
+                # the queue is on disk, the worker outlives any failure
+                logger.info('feedback flush failed: %s', e)
+                flushed = False
+            if flushed:
+                retry_wait = FEEDBACK_RETRY_WAIT
+                continue
+            logger.info('feedback flush retried in %i seconds', retry_wait)
+            self.closed.wait(retry_wait)
+            retry_wait = min(retry_wait * 2, FEEDBACK_RETRY_MAX_WAIT)
+            self.pending.set()
@@ -116,6 +116,41 @@ def songs_info(songs):
     duration_str = str(datetime.timedelta(seconds=total_duration))
     print "   Total duration: {}".format(duration_str)
 
+def songs_stats(stats, nb_genres):
+    """Display the totals and histograms of the songs library"""
+    logger.debug('call function songs_stats')
+    print
+    print "   Songs:           {}".format(stats['songs'])
+    print "   Total duration:  {}".format(
+        datetime.timedelta(seconds=stats['duration']))
+    print "   Total plays:     {}".format(stats['playcount'])
+    print "   Played songs:    {}".format(stats['played'])
+    print "   Rated songs:     {}".format(stats['rated'])
+    print
+    print "   By decade:"
+    for decade, nb_songs in stats['decades']:
+        print "      {}s  {:>7}  {}".format(
+            decade, nb_songs, histogram_bar(nb_songs, stats['songs']))
+    print
+    print "   By rating:"
+    for rating, nb_songs in stats['ratings']:
+        print "      {:>5g}  {:>7}  {}".format(
+            rating, nb_songs, histogram_bar(nb_songs, stats['songs']))
+    print
+    print "   By genre (songs, duration):"
+    for genre, nb_songs, duration in stats['genres'][:nb_genres]:
+        print "      {:<20} {:>7}  {}".format(
+            (genre or '-').encode('UTF-8')[:20],
+            nb_songs,
+            datetime.timedelta(seconds=duration)
+        )
+
+def histogram_bar(value, total, width=40):
+    """Return a bar of width proportional to value out of total"""
+    if not total:
+        return ''
+    return '#' * int(round(float(width) * value / total))
+
 def songs_sync(f_scan, ru_songsids, pcu_songids):
     """Display result of the songs sync process"""
     logger.debug('call function songs_sync')
@@ -150,6 +185,17 @@ def playlist_show(position, songids, songs):
     else:
         print "   [playlist empty]"
 
+def playlist_add_failed(item_ids):
+    """Display the items that could not be added to the playlist"""
+    logger.debug('call function playlist_add_failed')
+    if not item_ids:
+        return
+    print
+    print "   {} item(s) could not be added to the playlist: {}".format(
+        len(item_ids),
+        ", ".join([str(item_id) for item_id in item_ids])
+    )
+
 def playlist_now_playing(items, item, properties):
     """Display what is playing"""
     logger.debug('call function playlist_now_playing')
@@ -243,14 +289,35 @@ def play_skip(songid, songs):
 
 # echonest
 
-def en_sync(songids):
+def en_sync(songids, failed_songids):
     """Display echonest sync results"""
     logger.debug('call function en_sync')
-    if len(songids) == 0:
+    if len(songids) == 0 and len(failed_songids) == 0:
         print "   Echonest tasteprofile up to date."
     else:
         print
         print "   {} song(s) have been updated.".format(len(songids))
+    if len(failed_songids) > 0:
+        print "   {} song(s) failed, retried at the next sync.".format(
+            len(failed_songids))
+
+def en_status(status):
+    """Display echonest update ticket status"""
+    logger.debug('call function en_status')
+    print
+    if not 'ticket_status' in status:
+        print "   Unknown ticket: {}".format(
+            status.get('status', {}).get('message', ''))
+        return
+    print "   Ticket status:        {}".format(status['ticket_status'])
+    if 'percent_complete' in status:
+        print "   Percent complete:     {}".format(status['percent_complete'])
+    if 'details' in status:
+        print "   Details:              {}".format(status['details'])
+    for info in status.get('update_info', []):
+        print "   Item {}: {}".format(
+            info.get('item_id', ''),
+            info.get('info', ''))
 
 def en_display(song):
     """Display echonest song data"""
@@ -286,8 +353,8 @@ def en_display(song):
     print "   Artist hotttnesss:   {}".format(song['artist_hotttnesss'])
     print "   Artist discovery:    {}".format(song['artist_discovery'])
 
-def en_info(catalog):
-    """Display echnonest tasteprofile info"""
+def en_info(catalog, nb_feedback=0):
+    """Display echnonest tasteprofile info and the queued feedback"""
     logger.debug('call function en_info')
     print
     print "   Songs resolved/total: {} / {}".format(catalog['resolved'], catalog['total'])
@@ -296,6 +363,7 @@ def en_info(catalog):
     print "   Pending tickets:      {}".format(" / ".join(
         [pending_ticket['ticket_id'] for pending_ticket in catalog['pending_tickets']])
     )
+    print "   Queued feedback:      {}".format(nb_feedback)
 
 def en_sure_delete_tasteprofile(api_key, profile_id):
     """Warning before taste profile deletion."""
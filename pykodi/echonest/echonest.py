@@ -10,37 +10,255 @@ Module of functions for echonest API management.
 """
 
 import requests
+import threading
+import time
 import json
 import logging
 
 # global constants
 PROFILE_NAME = 'PyKodi library'
+API_URL = 'http://developer.echonest.com/api/v4/'
+API_TIMEOUT = 10.0 # seconds, to connect and between bytes of the response
+
+# rate limit, adapted to the X-RateLimit-* headers of the responses
+RATE_LIMIT = 120 # calls per period
+RATE_PERIOD = 60.0 # seconds
+RATE_BURST = 10 # calls allowed at once
+RATE_RETRIES = 3 # retries of a call refused with the 429 status
+RATE_RETRY_WAIT = 5.0 # seconds, without Retry-After header
+
+# update tickets polling, with an exponential backoff
+TICKET_POLL_WAIT = 1.0 # seconds before the first poll
+TICKET_POLL_MAX_WAIT = 30.0 # seconds between polls
+TICKET_DONE = ('complete', 'error')
+
+# update batches, packed by size of the JSON data
+UPDATE_MAX_SIZE = 500000 # bytes
+
+# item flags set by the feedback actions, skip is an action of its own
+FEEDBACK_FLAGS = {'ban': 'banned', 'favorite': 'favorite'}
 
 # global variable
 logger = logging.getLogger(__name__)
 
+# rate limit
+
+class TokenBucket(object):
+    """Token bucket shared by the calls to the API
+
+    Tokens are added at the allowed rate up to the burst size, each call
+    takes one and waits for it if the bucket is empty. When the server
+    reports no remaining call, the calls wait for the end of its window,
+    estimated to start with the first response of a new window. The clock
+    and the sleep functions can be replaced, e.g. by a fake clock.
+    """
+
+    def __init__(self, limit=RATE_LIMIT, period=RATE_PERIOD, burst=RATE_BURST,
+            clock=time.time, sleep=time.sleep):
+        self.rate = float(limit) / period
+        self.period = period
+        self.burst = burst
+        self.tokens = float(burst)
+        self.clock = clock
+        self.sleep = sleep
+        self.last = clock()
+        self.remaining = None # calls remaining in the server window
+        self.window = None # start of the server window
+        self.hold = 0 # no call before this time
+        self.lock = threading.Lock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def acquire(self):
+        """Take a token, wait until one is available
+
+        The token is taken at once, the wait is done out of the lock.
+        """
+        with self.lock:
+            self.refill()
+            self.tokens -= 1
+            wait = max(-self.tokens / self.rate, self.hold - self.last)
+        if wait > 0:
+            logger.debug('rate limit, wait %.2fs', wait)
+            self.sleep(wait)
+
+    def adapt(self, limit=None, remaining=None):
+        """Follow the limit and the remaining calls given by the server"""
+        with self.lock:
+            if limit:
+                self.rate = float(limit) / self.period
+            if remaining is not None:
+                self.refill()
+                if self.remaining is None or remaining > self.remaining:
+                    # a new server window, started at the latest now
+                    self.window = self.last
+                self.remaining = remaining
+                self.tokens = min(self.tokens, remaining)
+                if remaining == 0:
+                    self.hold = max(self.hold, self.window + self.period)
+
+    def empty(self):
+        """Drop the tokens, e.g. when a call has been refused"""
+        with self.lock:
+            self.refill()
+            self.tokens = min(self.tokens, 0)
+
+bucket = TokenBucket()
+
+def header_int(headers, name):
+    """Return an integer header, None if missing or invalid"""
+    try:
+        return int(headers[name])
+    except (KeyError, ValueError):
+        return None
+
+def api_request(method, url, **kwargs):
+    """Send a request to the API within the rate limit
+
+    The calls refused with the 429 status are retried after the delay
+    given by the server. The calls time out after API_TIMEOUT by default.
+    """
+    kwargs.setdefault('timeout', API_TIMEOUT)
+    for attempt in range(RATE_RETRIES + 1):
+        bucket.acquire()
+        r = requests.request(method, url, **kwargs)
+        logger.debug('URL: %s', r.url)
+        logger.debug('return: %s', r.text)
+        bucket.adapt(
+            header_int(r.headers, 'X-RateLimit-Limit'),
+            header_int(r.headers, 'X-RateLimit-Remaining'))
+        if r.status_code != 429 or attempt == RATE_RETRIES:
+            return r
+        wait = header_int(r.headers, 'Retry-After') or RATE_RETRY_WAIT
+        logger.info('rate limit exceeded, retry in %is', wait)
+        bucket.empty()
+        bucket.sleep(wait)
+
+# tickets
+
+class TicketTracker(object):
+    """Poll the status of the update tickets in a background thread
+
+    Each ticket is polled with an exponential backoff until its status is
+    complete or error. The finished tickets are returned by done() and
+    wait() as (ticket, data, status), data being given when the ticket is
+    added.
+    """
+
+    def __init__(self, api_key, poll_wait=TICKET_POLL_WAIT,
+            poll_max_wait=TICKET_POLL_MAX_WAIT):
+        self.api_key = api_key
+        self.poll_wait = poll_wait
+        self.poll_max_wait = poll_max_wait
+        self.pending = [] # [next poll time, wait, ticket, data]
+        self.finished = []
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __len__(self):
+        """Number of tickets not returned yet"""
+        with self.condition:
+            return len(self.pending) + len(self.finished)
+
+    def add(self, ticket, data=None):
+        """Track a ticket"""
+        with self.condition:
+            self.pending.append(
+                [time.time() + self.poll_wait, self.poll_wait, ticket, data])
+            self.condition.notify_all()
+
+    def done(self):
+        """Return the finished tickets"""
+        with self.condition:
+            finished, self.finished = self.finished, []
+        return finished
+
+    def wait(self, timeout=None):
+        """Wait for a finished ticket, return the finished tickets"""
+        with self.condition:
+            if not self.finished and self.pending:
+                self.condition.wait(timeout)
+        return self.done()
+
+    def close(self):
+        """Stop the polling, the pending tickets are dropped"""
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
+
+    def pending_data(self):
+        """Return the data of the tickets not finished yet"""
+        with self.condition:
+            return [entry[3] for entry in self.pending]
+
+    def poll(self, entry):
+        """Poll a ticket, return True when finished"""
+        next_poll, wait, ticket, data = entry
+        try:
+            status = tasteprofile_status(ticket, self.api_key)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logger.info('ticket %s status failed: %s', ticket, e)
+            status = {}
+        if not 'ticket_status' in status and \
+                status.get('status', {}).get('code', 0) != 0:
+            # unknown ticket
+            status['ticket_status'] = 'error'
+        logger.debug('ticket %s status: %s', ticket, status.get('ticket_status'))
+        if status.get('ticket_status') in TICKET_DONE:
+            with self.condition:
+                self.pending.remove(entry)
+                self.finished.append((ticket, data, status))
+                self.condition.notify_all()
+            return True
+        entry[1] = min(wait * 2, self.poll_max_wait)
+        entry[0] = time.time() + entry[1]
+        return False
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.closed:
+                    now = time.time()
+                    due = [entry for entry in self.pending if entry[0] <= now]
+                    if due:
+                        break
+                    if self.pending:
+                        self.condition.wait(
+                            min(entry[0] for entry in self.pending) - now)
+                    else:
+                        self.condition.wait()
+                if self.closed:
+                    return
+            for entry in due:
+                self.poll(entry)
+
 # playlist
 
 def playlist_static(api_key, profile_id):
     """Create a static playlist"""
     logger.debug('call function playlist_static')
-    url = 'http://developer.echonest.com/api/v4/playlist/static'
+    url = API_URL + 'playlist/static'
     payload = {
         'api_key': api_key,
         'type': 'catalog',
         'seed_catalog': profile_id,
         'bucket': 'id:' + profile_id
     }
-    r = requests.get(url, params=payload)
-    logger.debug('URL: %s', r.url)
-    logger.debug('return: %s', r.text)
+    r = api_request('get', url, params=payload)
     ret = r.json()
     return ret['response']['songs']
 
 def playlist_static_seed_song(song_id, api_key, profile_id):
     """Create a static playlist with a seed song"""
     logger.debug('call function playlist_static_seed_song')
-    url = 'http://developer.echonest.com/api/v4/playlist/static'
+    url = API_URL + 'playlist/static'
     payload = {
         'api_key': api_key,
         'type': 'catalog',
@@ -48,16 +266,14 @@ def playlist_static_seed_song(song_id, api_key, profile_id):
         'song_id': song_id,
         'bucket': 'id:' + profile_id
     }
-    r = requests.get(url, params=payload)
-    logger.debug('URL: %s', r.url)
-    logger.debug('return: %s', r.text)
+    r = api_request('get', url, params=payload)
     ret = r.json()
     return ret['response']['songs']
 
 def playlist_static_seed_type(song_type, api_key, profile_id):
     """Create a static playlist with a seed song type"""
     logger.debug('call function playlist_static_seed_type')
-    url = 'http://developer.echonest.com/api/v4/playlist/static'
+    url = API_URL + 'playlist/static'
     payload = {
         'api_key': api_key,
         'type': 'catalog',
@@ -65,99 +281,136 @@ def playlist_static_seed_type(song_type, api_key, profile_id):
         'song_type': song_type,
         'bucket': 'id:' + profile_id
     }
-    r = requests.get(url, params=payload)
-    logger.debug('URL: %s', r.url)
-    logger.debug('return: %s', r.text)
+    r = api_request('get', url, params=payload)
     ret = r.json()
     return ret['response']['songs']
 
+# update commands
+
+def mbid_song_id(mbid):
+    """Return the echonest song id of a MusicBrainz ID"""
+    return 'musicbrainz:song:' + mbid
+
+def song_item(item_id, mbid, **fields):
+    """Return the update command of a song identified by its MusicBrainz ID
+
+    The fields are the item values like rating, play_count, favorite,
+    banned or skip.
+    """
+    item = {
+        'item_id': item_id,
+        'song_id': mbid_song_id(mbid)
+    }
+    item.update(fields)
+    return {'action': 'update', 'item': item}
+
+def feedback_item(item_id, action):
+    """Return the update command of a ban, favorite or skip feedback"""
+    if action == 'skip':
+        return {'action': 'skip', 'item': {'item_id': item_id}}
+    return {
+        'action': 'update',
+        'item': {'item_id': item_id, FEEDBACK_FLAGS[action]: True}
+    }
+
+def update_batches(items, max_size=UPDATE_MAX_SIZE):
+    """Pack the update commands in batches, yield (keys, data)
+
+    items is an iterable of (key, command), consumed lazily. Each command
+    is serialized once and data, the JSON list of the commands of the
+    batch, stays under max_size bytes. keys are the keys of the batch.
+    """
+    keys = []
+    commands = []
+    size = 2
+    for key, command in items:
+        command = json.dumps(command)
+        if commands and size + len(command) + 2 > max_size:
+            yield keys, '[' + ', '.join(commands) + ']'
+            keys = []
+            commands = []
+            size = 2
+        keys.append(key)
+        commands.append(command)
+        size += len(command) + 2
+    if commands:
+        yield keys, '[' + ', '.join(commands) + ']'
+
 # tasteprofile
 
 def tasteprofile_ban(api_key, profile_id, item):
     """Ban a song  in echonest taste profile"""
     logger.debug('call function tasteprofile_skip')
-    url = 'http://developer.echonest.com/api/v4/tasteprofile/ban'
+    url = API_URL + 'tasteprofile/ban'
     payload = {
         'api_key': api_key,
         'id': profile_id,
         'item': item
     }
-    r = requests.get(url, params=payload)
-    logger.debug('URL: %s', r.url)
-    logger.debug('return: %s', r.text)
+    r = api_request('get', url, params=payload)
 
 def tasteprofile_create(api_key):
     """Create an echonest tasteprofile"""
     logger.debug('call function tasteprofile_create')
-    url = 'http://developer.echonest.com/api/v4/tasteprofile/create'
+    url = API_URL + 'tasteprofile/create'
     headers = {'content-type': 'multipart/form-data'}
     payload = {
         'api_key': api_key,
         'name': PROFILE_NAME,
         'type': 'general'
     }
-    r = requests.post(url, headers=headers, params=payload)
-    logger.debug('URL: %s', r.url)
-    logger.debug('return: %s', r.text)
+    r = api_request('post', url, headers=headers, params=payload)
 
 def tasteprofile_delete(api_key, profile_id):
     """Delete echonest tasteprofile"""
     logger.debug('call tasteprofile_delete')
-    url = 'http://developer.echonest.com/api/v4/tasteprofile/delete'
+    url = API_URL + 'tasteprofile/delete'
     headers = {'content-type': 'multipart/form-data'}
     payload = {
         'api_key': api_key,
         'id': profile_id
     }
-    r = requests.post(url, headers=headers, params=payload)
-    logger.debug('URL: %s', r.url)
-    logger.debug('return: %s', r.text)
+    r = api_request('post', url, headers=headers, params=payload)
 
 def tasteprofile_favorite(api_key, profile_id, item):
     """Make a song favorite in echonest tasteprofile"""
     logger.debug('call tasteprofile_favorite')
-    url = 'http://developer.echonest.com/api/v4/tasteprofile/favorite'
+    url = API_URL + 'tasteprofile/favorite'
     payload = {
         'api_key': api_key,
         'id': profile_id,
         'item': item
     }
-    r = requests.get(url, params=payload)
-    logger.debug('URL: %s', r.url)
-    logger.debug('return: %s', r.text)
+    r = api_request('get', url, params=payload)
 
 def tasteprofile_profile_name(api_key):
     """Get profile info by name"""
     logger.debug('call tasteprofile_profile_name')
-    url = 'http://developer.echonest.com/api/v4/tasteprofile/profile'
+    url = API_URL + 'tasteprofile/profile'
     payload = {
         'api_key': api_key,
         'name': PROFILE_NAME
     }
-    r = requests.get(url, params=payload)
-    logger.debug('URL: %s', r.url)
-    logger.debug('return: %s', r.text)
+    r = api_request('get', url, params=payload)
     ret = r.json()
     return ret['response']
 
 def tasteprofile_profile_id(api_key, profile_id):
     """Get profile info by id"""
     logger.debug('call tasteprofile_profile_id')
-    url = 'http://developer.echonest.com/api/v4/tasteprofile/profile'
+    url = API_URL + 'tasteprofile/profile'
     payload = {
         'api_key': api_key,
         'id': profile_id
     }
-    r = requests.get(url, params=payload)
-    logger.debug('URL: %s', r.url)
-    logger.debug('return: %s', r.text)
+    r = api_request('get', url, params=payload)
     ret = r.json()
     return ret['response']['catalog']
 
 def tasteprofile_read(item_id, api_key, profile_id):
     """Display dat about a given item"""
     logger.debug('call echonest_read')
-    url = 'http://developer.echonest.com/api/v4/tasteprofile/read'
+    url = API_URL + 'tasteprofile/read'
     payload = {
         'api_key': api_key,
         'id': profile_id,
@@ -171,59 +424,51 @@ def tasteprofile_read(item_id, api_key, profile_id):
             'song_type',
         ]
     }
-    r = requests.get(url, params=payload)
-    logger.debug('URL: %s', r.url)
-    logger.debug('return: %s', r.text)
+    r = api_request('get', url, params=payload)
     ret = r.json()
     return ret['response']['catalog']['items'][0]
 
 def tasteprofile_status(ticket, api_key):
     """Check tasteprofile status update"""
-    logger.debug('call tasteprofile_profile_id')
-    url = 'http://developer.echonest.com/api/v4/tasteprofile/status'
+    logger.debug('call tasteprofile_status')
+    url = API_URL + 'tasteprofile/status'
     payload = {
         'api_key': api_key,
         'ticket': ticket
     }
-    r = requests.get(url, params=payload)
-    logger.debug('URL: %s', r.url)
-    logger.debug('return: %s', r.text)
+    r = api_request('get', url, params=payload)
+    ret = r.json()
+    return ret['response']
+
+def tasteprofile_update(data, api_key, profile_id):
+    """Batch update of items, return the ticket or None if refused
 
-def tasteprofile_update(items, api_key, profile_id):
-    """Batch update of items"""
+    data is the JSON list of the update commands, see update_batches.
+    """
     logger.debug('call tasteprofile_update')
-    # crunch items into a single command
-    command = []
-    for item_id in items:
-        command.append({
-            'action': 'update',
-            'item': {
-                'item_id': item_id,
-                'song_id': items[item_id]['song_id'],
-                'rating': items[item_id]['rating'],
-                'play_count': items[item_id]['play_count']
-            }
-        })
-    url = 'http://developer.echonest.com/api/v4/tasteprofile/update'
-    headers = {'content-type': 'multipart/form-data'}
-    payload = {
+    url = API_URL + 'tasteprofile/update'
+    params = {
         'api_key': api_key,
-        'id': profile_id,
-        'data': json.dumps(command)
+        'id': profile_id
+    }
+    payload = {
+        'data_type': 'json',
+        'data': data
     }
-    r = requests.post(url, headers=headers, params=payload)
-    logger.debug('URL: %s', r.url)
-    logger.debug('return: %s', r.text)
+    r = api_request('post', url, params=params, data=payload)
+    try:
+        return r.json()['response'].get('ticket')
+    except (ValueError, KeyError):
+        logger.info('update refused: %s', r.text)
+        return None
 
 def tasteprofile_skip(api_key, profile_id, item):
     """Skip a song in echonest taste profile"""
     logger.debug('call tasteprofile_skip')
-    url = 'http://developer.echonest.com/api/v4/tasteprofile/skip'
+    url = API_URL + 'tasteprofile/skip'
     payload = {
         'api_key': api_key,
         'id': profile_id,
         'item': item
     }
-    r = requests.get(url, params=payload)
-    logger.debug('URL: %s', r.url)
-    logger.debug('return: %s', r.text)
\ No newline at end of file
+    r = api_request('get', url, params=payload)
\ No newline at end of file
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+"""
+Module of functions for the local recommendations, without network.
+
+The model holds the features of the songs, a row per song sorted by
+songid: the taste score from the rating and the play count, the year,
+the album, the artist and genre codes. The rows of each artist, genre
+and album are indexed, the genre and song type lists sorted by taste,
+so that a seeded playlist only scores the songs close to the seed. The
+playlists are sampled from the best scores, weighted by the score, to
+vary from one call to the next.
+"""
+
+from array import array
+import math
+import heapq
+import random
+import re
+import logging
+
+# global constants
+
+# taste score of a song, from 0 to 1
+WEIGHT_RATING = 0.6
+WEIGHT_PLAYCOUNT = 0.4
+
+# similarity with the seed song
+WEIGHT_ARTIST = 1.0
+WEIGHT_ALBUM = 0.5
+WEIGHT_GENRE = 0.8
+WEIGHT_YEAR = 0.4
+WEIGHT_TASTE = 0.5
+YEAR_SCALE = 10.0 # years between two songs halving their year similarity
+
+# candidates of a seeded playlist taken from each genre, by taste
+GENRE_CANDIDATES = 2000
+
+# songs sampled from the best ones, per song of the playlist
+POOL_FACTOR = 4
+
+# song types: words of the titles or the genres
+SONG_TYPES = {
+    'christmas': (u'christmas', u'xmas', u'noel', u'noël', u'navidad',
+        u'weihnachten'),
+    'live': (u'live', u'concert', u'unplugged')
+}
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+
+# global variable
+logger = logging.getLogger(__name__)
+
+# model
+
+def model_build(songs):
+    """Return the recommendation model of the songs"""
+    logger.debug('call function model_build')
+    model = {
+        'songids': array('l'),
+        'rows': {},
+        'taste': array('d'),
+        'year': array('l'),
+        'albumid': array('l'),
+        'artists': [],
+        'genres': [],
+        'by_artist': {},
+        'by_album': {},
+        'by_genre': {},
+        'types': dict((song_type, []) for song_type in SONG_TYPES)
+    }
+    artist_codes = {}
+    genre_codes = {}
+    max_rating = max(
+        [song.get('rating') or 0 for song in songs.itervalues()] or [0])
+    max_playcount = max(
+        [song.get('playcount') or 0 for song in songs.itervalues()] or [0])
+    for row, songid in enumerate(sorted(songs)):
+        song = songs[songid]
+        model['songids'].append(songid)
+        model['rows'][songid] = row
+        model['taste'].append(taste(song, max_rating, max_playcount))
+        model['year'].append(song.get('year') or 0)
+        model['albumid'].append(song.get('albumid') or 0)
+        artists = tuple(artist_codes.setdefault(artist, len(artist_codes))
+            for artist in song.get('artist') or [])
+        genres = tuple(genre_codes.setdefault(genre, len(genre_codes))
+            for genre in song.get('genre') or [])
+        model['artists'].append(artists)
+        model['genres'].append(genres)
+        for artist in artists:
+            model['by_artist'].setdefault(artist, []).append(row)
+        for genre in genres:
+            model['by_genre'].setdefault(genre, []).append(row)
+        if song.get('albumid'):
+            model['by_album'].setdefault(song['albumid'], []).append(row)
+        words = set(TOKEN.findall(u' '.join(
+            [song.get('title') or u''] + (song.get('genre') or [])).lower()))
+        for song_type, type_words in SONG_TYPES.iteritems():
+            if words.intersection(type_words):
+                model['types'][song_type].append(row)
+    song_taste = model['taste']
+    for rows in model['by_genre'].values() + model['types'].values():
+        rows.sort(key=song_taste.__getitem__, reverse=True)
+    model['by_taste'] = array('l', sorted(range(len(song_taste)),
+        key=song_taste.__getitem__, reverse=True))
+    return model
+
+def taste(song, max_rating, max_playcount):
+    """Return the taste score of a song from its rating and play count"""
+    score = 0.0
+    if max_rating:
+        score += WEIGHT_RATING * (song.get('rating') or 0) / max_rating
+    if max_playcount:
+        score += WEIGHT_PLAYCOUNT * math.log1p(song.get('playcount') or 0) \
+            / math.log1p(max_playcount)
+    return score
+
+# playlists
+
+def sample(scores, size, rand=random):
+    """Return size rows of the (score, row), drawn with weights the scores"""
+    keys = [(rand.random() ** (1.0 / (score + 1e-6)), row)
+        for score, row in scores]
+    return [row for key, row in heapq.nlargest(size, keys)]
+
+def playlist(model, size, rand=random):
+    """Return the songids of a playlist from the best taste scores"""
+    logger.debug('call function playlist')
+    song_taste = model['taste']
+    pool = model['by_taste'][:size * POOL_FACTOR]
+    rows = sample([(song_taste[row], row) for row in pool], size, rand)
+    return [model['songids'][row] for row in rows]
+
+def playlist_seed_song(model, songid, size, rand=random):
+    """Return the songids of a playlist of songs similar to songid
+
+    The seed song comes first, the candidates are scored by similarity
+    and taste.
+    """
+    logger.debug('call function playlist_seed_song')
+    seed = model['rows'].get(songid)
+    if seed is None:
+        logger.info('song %i not in the model', songid)
+        return []
+    scores = similarities(model, seed, candidates(model, seed))
+    pool = heapq.nlargest((size - 1) * POOL_FACTOR, scores)
+    rows = [seed] + sample(pool, size - 1, rand)
+    return [model['songids'][row] for row in rows]
+
+def similar(model, songid, size):
+    """Return the songids of the songs most similar to songid, best first"""
+    logger.debug('call function similar')
+    seed = model['rows'].get(songid)
+    if seed is None:
+        logger.info('song %i not in the model', songid)
+        return []
+    scores = heapq.nlargest(size,
+        similarities(model, seed, candidates(model, seed)))
+    return [model['songids'][row] for score, row in scores]
+
+def candidates(model, seed):
+    """Return the rows sharing an artist, the album or a genre with seed
+
+    Only the GENRE_CANDIDATES best songs of each genre are taken.
+    """
+    rows = set()
+    for artist in model['artists'][seed]:
+        rows.update(model['by_artist'][artist])
+    for genre in model['genres'][seed]:
+        rows.update(model['by_genre'][genre][:GENRE_CANDIDATES])
+    rows.update(model['by_album'].get(model['albumid'][seed], ()))
+    rows.discard(seed)
+    return rows
+
+def similarities(model, seed, rows):
+    """Return the (score, row) of the rows compared with the seed row
+
+    The rows are the songs close to the seed only, a loop is fast enough.
+    """
+    seed_artists = set(model['artists'][seed])
+    seed_genres = set(model['genres'][seed])
+    seed_year = model['year'][seed]
+    seed_albumid = model['albumid'][seed]
+    artists = model['artists']
+    genres = model['genres']
+    years = model['year']
+    albumids = model['albumid']
+    song_taste = model['taste']
+    scores = []
+    for row in rows:
+        score = WEIGHT_TASTE * song_taste[row]
+        if seed_artists:
+            score += WEIGHT_ARTIST * len(seed_artists.intersection(
+                artists[row])) / len(seed_artists)
+        if seed_genres and genres[row]:
+            shared = len(seed_genres.intersection(genres[row]))
+            score += WEIGHT_GENRE * shared / \
+                (len(seed_genres) + len(genres[row]) - shared)
+        if seed_albumid and albumids[row] == seed_albumid:
+            score += WEIGHT_ALBUM
+        if seed_year and years[row]:
+            score += WEIGHT_YEAR / \
+                (1 + abs(years[row] - seed_year) / YEAR_SCALE)
+        scores.append((score, row))
+    return scores
+
+def playlist_song_type(model, song_type, size, rand=random):
+    """Return the songids of a playlist of a song type, by taste
+
+    The types are christmas and live, from the words of the titles and
+    the genres. The studio type is the songs not live.
+    """
+    logger.debug('call function playlist_song_type')
+    song_taste = model['taste']
+    if song_type == 'studio':
+        live = set(model['types']['live'])
+        rows = [row for row in model['by_taste'][:size * POOL_FACTOR * 2]
+            if not row in live]
+    else:
+        rows = model['types'].get(song_type, [])
+    pool = [(song_taste[row], row) for row in rows[:size * POOL_FACTOR]]
+    return [model['songids'][row] for row in sample(pool, size, rand)]
@@ -10,37 +10,375 @@ Module of functions for Kodi API management.
 """
 
 import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+import codecs
+import itertools
 import json
 import logging
+import re
+import socket
+import threading
+
+# global constants
+
+HTTP_POOL_SIZE = 4
+HTTP_RETRIES = 3
+HTTP_BACKOFF = 0.2
+API_TIMEOUT = 10
+
+TCP_PORT = 9090
+TCP_BUFFER_SIZE = 65536
+
+HTTP = 'http'
+TCP = 'tcp'
+
+ALBUM_PROPERTIES = [
+    'title',
+    'artist',
+    'year',
+    'rating',
+    'musicbrainzalbumid',
+    'genreid',
+    'genre',
+    'dateadded',
+    'lastmodified'
+]
+
+SONG_PROPERTIES = [
+    'title',
+    'artist',
+    'year',
+    'duration',
+    'rating',
+    'playcount',
+    'musicbrainztrackid',
+    'genre',
+    'albumid',
+    'track',
+    'dateadded',
+    'lastmodified',
+    'lastplayed'
+]
 
 # global variable
 logger = logging.getLogger(__name__)
+clients = {}
+clients_lock = threading.Lock()
+command_ids = itertools.count(1)
 
 # api call management
 
+class HttpClient(object):
+    """Keep-alive HTTP connection pool to a Kodi server
+
+    The optional server params 'pool_size', 'retries' and 'timeout'
+    override the module defaults. Retries only apply to connection
+    errors, so a command is never sent twice to the server.
+    """
+
+    def __init__(self, server_params):
+        self.url = 'http://' + server_params['ip'] + ':' + \
+            str(server_params['port']) + '/jsonrpc'
+        self.timeout = server_params.get('timeout', API_TIMEOUT)
+        pool_size = server_params.get('pool_size', HTTP_POOL_SIZE)
+        retries = server_params.get('retries', HTTP_RETRIES)
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=Retry(
+                total=retries,
+                connect=retries,
+                read=0,
+                status=0,
+                backoff_factor=HTTP_BACKOFF))
+        self.session = requests.Session()
+        self.session.mount('http://', adapter)
+        self.session.auth = (server_params['user'], server_params['password'])
+        self.session.headers.update({'Content-Type': 'application/json'})
+
+    def call(self, command):
+        r = self.session.post(
+                self.url,
+                data=json.dumps(command),
+                timeout=self.timeout)
+        logger.debug('url: %s', r.url)
+        logger.debug('status code: %s', r.status_code)
+        logger.debug('text: %s', r.text)
+        return r.json()
+
+    def close(self):
+        self.session.close()
+
+class JsonStream(object):
+    """Split a byte stream into the concatenated JSON values it carries
+
+    Only the brackets outside of strings are tracked, the values are
+    decoded once complete.
+    """
+
+    structure = re.compile(r'[][{}"]')
+    string_end = re.compile(r'["\\]')
+
+    def __init__(self):
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buffer = u''
+        self.pos = 0
+        self.depth = 0
+        self.in_string = False
+
+    def feed(self, data):
+        """Add received data, return the list of complete values"""
+        values = []
+        buf = self.buffer + self.utf8.decode(data)
+        start = 0
+        while True:
+            if self.in_string:
+                m = self.string_end.search(buf, self.pos)
+                if not m:
+                    break
+                if m.group() == '\\':
+                    # skip the escaped character
+                    self.pos = m.end() + 1
+                else:
+                    self.in_string = False
+                    self.pos = m.end()
+            else:
+                m = self.structure.search(buf, self.pos)
+                if not m:
+                    break
+                self.pos = m.end()
+                c = m.group()
+                if c == '"':
+                    self.in_string = True
+                elif c in '[{':
+                    self.depth += 1
+                else:
+                    self.depth -= 1
+                    if self.depth == 0:
+                        values.append(json.loads(buf[start:self.pos]))
+                        start = self.pos
+        self.buffer = buf[start:]
+        self.pos -= start
+        return values
+
+class TcpClient(object):
+    """Persistent raw JSON-RPC connection to a Kodi server
+
+    The server port is read from the optional 'tcp_port' server param. A
+    reader thread decodes the stream, hands the responses to the waiting
+    callers by id and the notifications to the listeners.
+    """
+
+    def __init__(self, server_params):
+        self.address = (
+            server_params['ip'],
+            int(server_params.get('tcp_port', TCP_PORT)))
+        self.timeout = server_params.get('timeout', API_TIMEOUT)
+        self.sock = None
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.listeners = []
+
+    def connect(self):
+        logger.info('connect to %s:%s', self.address[0], self.address[1])
+        sock = socket.create_connection(self.address, self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(None)
+        self.sock = sock
+        reader = threading.Thread(target=self.read_loop, args=(sock,))
+        reader.daemon = True
+        reader.start()
+
+    def call(self, command):
+        # ids are replaced by unique ones, the callers ids are restored
+        # in the responses
+        commands = command if isinstance(command, list) else [command]
+        slot = {'event': threading.Event(), 'ids': {}}
+        request = []
+        for command_item in commands:
+            command_item = dict(command_item)
+            request_id = next(command_ids)
+            slot['ids'][request_id] = command_item.get('id')
+            command_item['id'] = request_id
+            request.append(command_item)
+        for request_id in slot['ids']:
+            self.pending[request_id] = slot
+        try:
+            with self.lock:
+                if self.sock is None:
+                    self.connect()
+                data = request if isinstance(command, list) else request[0]
+                self.sock.sendall(json.dumps(data).encode('utf-8'))
+            if not slot['event'].wait(self.timeout):
+                raise socket.timeout('no response from Kodi')
+        finally:
+            for request_id in slot['ids']:
+                self.pending.pop(request_id, None)
+        if 'error' in slot:
+            raise slot['error']
+        ret = slot['response']
+        for response in (ret if isinstance(ret, list) else [ret]):
+            if response.get('id') in slot['ids']:
+                response['id'] = slot['ids'][response['id']]
+        return ret
+
+    def read_loop(self, sock):
+        stream = JsonStream()
+        while True:
+            try:
+                data = sock.recv(TCP_BUFFER_SIZE)
+            except socket.error as e:
+                logger.error('connection error: %s', e)
+                break
+            if not data:
+                break
+            for value in stream.feed(data):
+                self.dispatch(value)
+        self.disconnect(sock)
+
+    def dispatch(self, value):
+        responses = value if isinstance(value, list) else [value]
+        for response in responses:
+            if response.get('id') in self.pending:
+                slot = self.pending[response['id']]
+                slot['response'] = value
+                slot['event'].set()
+                return
+        if isinstance(value, dict) and 'method' in value:
+            logger.debug('notification: %s', value['method'])
+            for listener in list(self.listeners):
+                try:
+                    listener(value['method'], value.get('params', {}))
+                except Exception:
+                    logger.exception('notification listener failed')
+        else:
+            logger.debug('unexpected message: %s', value)
+
+    def disconnect(self, sock):
+        logger.info('disconnected from %s:%s', self.address[0], self.address[1])
+        with self.lock:
+            if self.sock is sock:
+                self.sock = None
+        sock.close()
+        for slot in list(self.pending.values()):
+            slot['error'] = socket.error('connection to Kodi closed')
+            slot['event'].set()
+
+    def add_listener(self, listener):
+        """Register a callback(method, params) for the notifications"""
+        self.listeners.append(listener)
+        with self.lock:
+            if self.sock is None:
+                self.connect()
+
+    def remove_listener(self, listener):
+        """Unregister a notifications callback"""
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def close(self):
+        with self.lock:
+            sock = self.sock
+            self.sock = None
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+            sock.close()
+
+def server_key(server_params):
+    """Return the key identifying a Kodi server in the clients cache"""
+    return (
+        server_params['ip'],
+        str(server_params['port']),
+        server_params['user'],
+        server_params['password'])
+
+def get_client(server_params, transport=HTTP):
+    """Return the cached client of a Kodi server, create it if needed"""
+    key = (transport,) + server_key(server_params)
+    with clients_lock:
+        if not key in clients:
+            logger.info('new %s client for server %s:%s', transport, key[1], key[2])
+            if transport == TCP:
+                clients[key] = TcpClient(server_params)
+            else:
+                clients[key] = HttpClient(server_params)
+        return clients[key]
+
+def close_clients():
+    """Close all the cached clients"""
+    logger.debug('call function close_clients')
+    with clients_lock:
+        for key in list(clients):
+            clients.pop(key).close()
+
 def call_api_http(server_params, command):
     logger.debug('call function call_api_http')
     logger.info('command: %s', command)
-    kodi_url = 'http://' + server_params['ip'] +  ':' + str(server_params['port']) + '/jsonrpc'
-    headers = {'Content-Type': 'application/json'}
-    r = requests.post(
-            kodi_url,
-            data=json.dumps(command),
-            headers=headers,
-            auth=(server_params['user'], server_params['password']))
-    ret = r.json()
-    logger.debug('url: %s', r.url)
-    logger.debug('status code: %s', r.status_code)
-    logger.debug('text: %s', r.text)
+    ret = get_client(server_params, HTTP).call(command)
+    return ret
+
+def call_api_tcp(server_params, command):
+    logger.debug('call function call_api_tcp')
+    logger.info('command: %s', command)
+    ret = get_client(server_params, TCP).call(command)
     return ret
 
 def call_api(server_params, command):
     logger.debug('call function call_api')
-    # wrapper for api calls
-    # could be used for both HTTP and TCP
-    ret = call_api_http(server_params, command)
+    # wrapper for api calls, the transport is selected in the
+    # server params and is HTTP by default
+    if server_params.get('transport', HTTP) == TCP:
+        ret = call_api_tcp(server_params, command)
+    else:
+        ret = call_api_http(server_params, command)
     return ret
 
+def notifications_listen(server_params, listener):
+    """Call listener(method, params) on each Kodi notification"""
+    logger.debug('call function notifications_listen')
+    get_client(server_params, TCP).add_listener(listener)
+
+def notifications_unlisten(server_params, listener):
+    """Stop calling listener on the Kodi notifications"""
+    logger.debug('call function notifications_unlisten')
+    get_client(server_params, TCP).remove_listener(listener)
+
+def notifications_connected(server_params):
+    """True if the notifications connection is open, try to reopen it"""
+    client = get_client(server_params, TCP)
+    with client.lock:
+        if client.sock is not None:
+            return True
+        try:
+            client.connect()
+        except socket.error:
+            pass
+    # notifications may have been missed while disconnected
+    return False
+
+def call_api_batch(server_params, commands):
+    """Send several commands in a single JSON-RPC batch
+
+    Each command gets a unique id, the responses are matched back by id
+    and returned in the order of the commands.
+    """
+    logger.debug('call function call_api_batch')
+    if not commands:
+        return []
+    batch = []
+    for command in commands:
+        command = dict(command)
+        command['id'] = next(command_ids)
+        batch.append(command)
+    ret = call_api(server_params, batch)
+    if isinstance(ret, dict):
+        # the whole batch has been rejected
+        return [ret] * len(batch)
+    responses = dict((response.get('id'), response) for response in ret)
+    missing = {'error': {'message': 'no response in batch'}}
+    return [responses.get(command['id'], missing) for command in batch]
+
 def display_result(ret):
     """Display command result for simple methods"""
     logger.debug('call function display_result')
@@ -52,6 +390,19 @@ def display_result(ret):
 
 # audiolibrary
 
+def changed_filter(watermark):
+    """Filter on the items with a date after the watermark"""
+    return {
+        'or': [
+            {
+                'field': field,
+                'operator': 'after',
+                'value': watermark[field]
+            } for field in sorted(watermark)
+        ]
+    }
+
+
 def audiolibrary_get_albums_limits(server_params, songid_start, songid_end):
     """Retrieve all albums whithin limits"""
     command = {
@@ -73,15 +424,7 @@ def audiolibrary_get_albums(server_params, albumid_start, albumid_end):
         'jsonrpc': '2.0',
         'method': 'AudioLibrary.GetAlbums',
         'params': {
-        'properties': [
-            'title',
-            'artist',
-            'year',
-            'rating',
-            'musicbrainzalbumid',
-            'genreid',
-            'genre'
-        ],
+        'properties': ALBUM_PROPERTIES,
         'limits': {
             'start': albumid_start,
             'end': albumid_end }
@@ -92,24 +435,83 @@ def audiolibrary_get_albums(server_params, albumid_start, albumid_end):
     display_result(ret)
     return ret['result']['albums']
 
+def audiolibrary_get_albums_changed(server_params, watermark, albumid_start, albumid_end):
+    """Retrieve the albums added or modified after the watermark"""
+    command = {
+        'jsonrpc': '2.0',
+        'method': 'AudioLibrary.GetAlbums',
+        'params': {
+            'properties': ALBUM_PROPERTIES,
+            'filter': changed_filter(watermark),
+            'limits': {
+                'start': albumid_start,
+                'end': albumid_end }
+        },
+        'id': 1
+    }
+    ret = call_api(server_params, command)
+    display_result(ret)
+    return ret['result'].get('albums', [])
+
+def audiolibrary_get_album_details_command(albumid):
+    """Command to retrieve the details of an album"""
+    command = {
+        'jsonrpc': '2.0',
+        'method': 'AudioLibrary.GetAlbumDetails',
+        'params': {
+            'albumid': albumid,
+            'properties': ALBUM_PROPERTIES
+        },
+        'id': 1
+    }
+    return command
+
+def audiolibrary_get_albums_details(server_params, albumids):
+    """Retrieve the details of several albums in one batch"""
+    commands = [audiolibrary_get_album_details_command(albumid) for albumid in albumids]
+    rets = call_api_batch(server_params, commands)
+    albums = []
+    for ret in rets:
+        display_result(ret)
+        if 'result' in ret:
+            albums.append(ret['result']['albumdetails'])
+    return albums
+
+def audiolibrary_get_albums_delta(server_params, albumid_start, albumid_end):
+    """Retrieve the albumids and ratings whithin limits"""
+    command = {
+        'jsonrpc': '2.0',
+        'method': 'AudioLibrary.GetAlbums',
+        'params': {
+            'properties': ['rating'],
+        'limits': {
+            'start': albumid_start,
+            'end': albumid_end }
+        },
+        'id': 1
+    }
+    ret = call_api(server_params, command)
+    display_result(ret)
+    return ret['result'].get('albums', [])
+
+def audiolibrary_get_genres(server_params):
+    """Retrieve all the music genres"""
+    command = {
+        'jsonrpc': '2.0',
+        'method': 'AudioLibrary.GetGenres',
+        'id': 1
+    }
+    ret = call_api(server_params, command)
+    display_result(ret)
+    return ret['result'].get('genres', [])
+
 def audiolibrary_get_songs_full(server_params, songid_start, songid_end):
     """Retrieve all songs whithin limits"""
     command = {
         'jsonrpc': '2.0',
         'method': 'AudioLibrary.GetSongs',
         'params': {
-        'properties': [
-            'title',
-            'artist',
-            'year',
-            'duration',
-            'rating',
-            'playcount',
-            'musicbrainztrackid',
-            'genre',
-            'albumid',
-            'track'
-        ],
+        'properties': SONG_PROPERTIES,
         'limits': {
             'start': songid_start,
             'end': songid_end }
@@ -120,8 +522,50 @@ def audiolibrary_get_songs_full(server_params, songid_start, songid_end):
     display_result(ret)
     return ret['result']['songs']
 
+def audiolibrary_get_songs_changed(server_params, watermark, songid_start, songid_end):
+    """Retrieve the songs added, modified or played after the watermark"""
+    command = {
+        'jsonrpc': '2.0',
+        'method': 'AudioLibrary.GetSongs',
+        'params': {
+            'properties': SONG_PROPERTIES,
+            'filter': changed_filter(watermark),
+            'limits': {
+                'start': songid_start,
+                'end': songid_end }
+        },
+        'id': 1
+    }
+    ret = call_api(server_params, command)
+    display_result(ret)
+    return ret['result'].get('songs', [])
+
+def audiolibrary_get_song_details_command(songid):
+    """Command to retrieve the details of a song"""
+    command = {
+        'jsonrpc': '2.0',
+        'method': 'AudioLibrary.GetSongDetails',
+        'params': {
+            'songid': songid,
+            'properties': SONG_PROPERTIES
+        },
+        'id': 1
+    }
+    return command
+
+def audiolibrary_get_songs_details(server_params, songids):
+    """Retrieve the details of several songs in one batch"""
+    commands = [audiolibrary_get_song_details_command(songid) for songid in songids]
+    rets = call_api_batch(server_params, commands)
+    songs = []
+    for ret in rets:
+        display_result(ret)
+        if 'result' in ret:
+            songs.append(ret['result']['songdetails'])
+    return songs
+
 def audiolibrary_get_songs_delta(server_params, songid_start, songid_end):
-    """Retrieve all songs whithin limits"""
+    """Retrieve the songids, ratings and play counts whithin limits"""
     command = {
         'jsonrpc': '2.0',
         'method': 'AudioLibrary.GetSongs',
@@ -138,7 +582,7 @@ def audiolibrary_get_songs_delta(server_params, songid_start, songid_end):
     }
     ret = call_api(server_params, command)
     display_result(ret)
-    return ret['result']['songs']
+    return ret['result'].get('songs', [])
 
 def audiolibrary_get_songs_limits(server_params, songid_start, songid_end):
     """Retrieve all songs whithin limits"""
@@ -158,9 +602,8 @@ def audiolibrary_get_songs_limits(server_params, songid_start, songid_end):
 
 # playlist
 
-def playlist_add(server_params, item_type, item_id):
-    """Add an item to the audio playlist"""
-    logger.debug('call function playlist_add')
+def playlist_add_command(item_type, item_id):
+    """Command to add an item to the audio playlist"""
     command = {
         'jsonrpc': '2.0',
         'method': 'Playlist.Add',
@@ -171,8 +614,19 @@ def playlist_add(server_params, item_type, item_id):
         },
         'id': 1
     }
-    ret = call_api(server_params, command)
-    display_result(ret)
+    return command
+
+def playlist_add_batch(server_params, item_type, item_ids):
+    """Add several items to the audio playlist in one batch"""
+    logger.debug('call function playlist_add_batch')
+    commands = [playlist_add_command(item_type, item_id) for item_id in item_ids]
+    rets = call_api_batch(server_params, commands)
+    # only log failed items, a batch can hold hundreds of items
+    for ret in rets:
+        if 'error' in ret:
+            display_result(ret)
+    logger.info('%i item(s) sent to the playlist', len(rets))
+    return rets
 
 def playlist_clear(server_params):
     """Clear the audio playlist"""
@@ -188,9 +642,8 @@ def playlist_clear(server_params):
     ret = call_api(server_params, command)
     display_result(ret)
 
-def playlist_get_items(server_params):
-    """Get all songids from the audio playlist"""
-    logger.debug('call playlist_get_items')
+def playlist_get_items_command():
+    """Command to get all items from the audio playlist"""
     command = {
         'jsonrpc': '2.0',
         'method': 'Playlist.GetItems',
@@ -202,9 +655,7 @@ def playlist_get_items(server_params):
         },
         'id': 1
     }
-    ret = call_api(server_params, command)
-    display_result(ret)
-    return ret['result'].get('items', [])
+    return command
 
 # player
 
@@ -219,8 +670,8 @@ def player_get_active(server_params):
     display_result(ret)
     return not len(ret['result']) == 0
 
-def player_get_item(server_params):
-    """Get the current played item"""
+def player_get_item_command():
+    """Command to get the current played item"""
     command = {
         'jsonrpc': '2.0',
         'method': 'Player.GetItem',
@@ -235,12 +686,17 @@ def player_get_item(server_params):
         },
         'id': 1
     }
+    return command
+
+def player_get_item(server_params):
+    """Get the current played item"""
+    command = player_get_item_command()
     ret = call_api(server_params, command)
     display_result(ret)
     return ret['result']['item']
 
-def player_get_properties(server_params):
-    """Get properties of the played item"""
+def player_get_properties_command():
+    """Command to get properties of the played item"""
     command = {
         'jsonrpc': '2.0',
         'method': 'Player.GetProperties',
@@ -250,14 +706,28 @@ def player_get_properties(server_params):
                 'time',
                 'totaltime',
                 'percentage',
-                'position'
+                'position',
+                'speed'
             ]
         },
         'id': 1
     }
-    ret = call_api(server_params, command)
-    display_result(ret)
-    return ret['result']
+    return command
+
+def player_get_status(server_params):
+    """Get playlist items, played item and properties in one batch"""
+    logger.debug('call function player_get_status')
+    rets = call_api_batch(server_params, [
+        playlist_get_items_command(),
+        player_get_item_command(),
+        player_get_properties_command()
+    ])
+    for ret in rets:
+        display_result(ret)
+    items = rets[0]['result'].get('items', [])
+    item = rets[1]['result']['item']
+    properties = rets[2]['result']
+    return items, item, properties
 
 def player_goto_next(server_params):
     """Go to the next item"""
@@ -370,5 +840,5 @@ def jsonrpc_ping(server_params):
         ret = call_api(server_params, command)
         display_result(ret)
         return True
-    except requests.exceptions.ConnectionError:
+    except (requests.exceptions.ConnectionError, socket.error):
         return False
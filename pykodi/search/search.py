@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+"""
+Module of functions for the local library search indexes.
+"""
+
+import re
+import unicodedata
+import heapq
+import logging
+
+# global constants
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+
+# length of the n-grams indexing the tokens, shorter terms scan the tokens
+GRAM_SIZE = 3
+
+# the tokens are padded for their n-grams to cover the edges
+GRAM_START = u'\x02'
+GRAM_END = u'\x03'
+
+# fuzzy search: (min term length, max edit distance), by decreasing length
+FUZZY_DISTANCES = ((7, 2), (4, 1), (0, 0))
+
+# global variable
+logger = logging.getLogger(__name__)
+
+# search keys
+
+def search_key(text, fold_accents=False):
+    """Return the string used to search in a text field
+
+    The text is lower cased and, if fold_accents, decomposed without its
+    combining characters, so that 'Björk' is found with 'bjork'.
+    """
+    key = text.lower()
+    if fold_accents:
+        key = u''.join(char for char in unicodedata.normalize('NFKD', key)
+            if not unicodedata.combining(char))
+    return key
+
+def search_keys(fields):
+    """Return the search keys of the text fields, without and with accents"""
+    return (
+        [search_key(field) for field in fields],
+        [search_key(field, True) for field in fields]
+    )
+
+def query_key(search_string, fold_accents=False):
+    """Return the search key of a search string, decoded if UTF-8
+
+    The bytes not valid in UTF-8 are replaced by U+FFFD, which is in no
+    search key, so that such a search finds nothing instead of failing.
+    """
+    if isinstance(search_string, str):
+        search_string = search_string.decode('utf-8', 'replace')
+    return search_key(search_string, fold_accents)
+
+# inverted index
+
+def grams(text, padded=False):
+    """Return the set of n-grams of a text
+
+    The n-grams of a padded text are a superset of the plain ones, they
+    also give the edges of the text some weight in the fuzzy search.
+    """
+    if padded:
+        text = GRAM_START * (GRAM_SIZE - 1) + text + GRAM_END * (GRAM_SIZE - 1)
+    return set(text[start:start + GRAM_SIZE]
+        for start in range(len(text) - GRAM_SIZE + 1))
+
+def index_create(fold_accents=False):
+    """Return an empty index
+
+    keys: the search keys of each record id
+    postings: the record ids of each token
+    grams: the tokens of each n-gram
+    fold_accents: the accents are removed from the keys and the queries
+    """
+    return {'keys': {}, 'postings': {}, 'grams': {}, 'fold_accents': fold_accents}
+
+def index_add(index, record_id, keys):
+    """Add a record to the index from its search keys"""
+    index['keys'][record_id] = keys
+    for key in keys:
+        for token in TOKEN.findall(key):
+            if not token in index['postings']:
+                index['postings'][token] = set()
+                for gram in grams(token, True):
+                    index['grams'].setdefault(gram, set()).add(token)
+            index['postings'][token].add(record_id)
+
+def index_remove(index, record_id):
+    """Remove a record from the index"""
+    keys = index['keys'].pop(record_id, [])
+    for key in keys:
+        for token in TOKEN.findall(key):
+            postings = index['postings'].get(token)
+            if postings is None:
+                continue
+            postings.discard(record_id)
+            if not postings:
+                del index['postings'][token]
+                for gram in grams(token, True):
+                    index['grams'][gram].discard(token)
+                    if not index['grams'][gram]:
+                        del index['grams'][gram]
+
+def index_tokens(index, term):
+    """Return the tokens containing the term
+
+    The tokens sharing all the n-grams of the term are checked, terms
+    shorter than a n-gram are checked against all the tokens.
+    """
+    if len(term) < GRAM_SIZE:
+        return [token for token in index['postings'] if term in token]
+    candidates = sorted([index['grams'].get(gram, set())
+        for gram in grams(term)], key=len)
+    tokens = candidates[0].intersection(*candidates[1:])
+    return [token for token in tokens if term in token]
+
+def index_term(index, term):
+    """Return the ids of the records with a token containing the term"""
+    record_ids = set()
+    for token in index_tokens(index, term):
+        record_ids.update(index['postings'][token])
+    return record_ids
+
+def index_scan(index, search_string, record_ids):
+    """Return the record ids with a key containing the search string"""
+    return [record_id for record_id in record_ids
+            if any(search_string in key for key in index['keys'][record_id])]
+
+def index_search(index, search_string):
+    """Return the sorted ids of the records containing the search string
+
+    Each word of the search string is part of a token of the matching
+    records, the intersection of the records with such tokens is checked
+    against the search keys. Words shorter than a n-gram select too many
+    records and are skipped when there are longer ones. Search strings
+    without any word are checked against all the search keys.
+    """
+    logger.debug('call function index_search')
+    search_string = query_key(search_string, index['fold_accents'])
+    terms = set(TOKEN.findall(search_string))
+    if not terms:
+        return sorted(index_scan(index, search_string, index['keys']))
+    long_terms = set(term for term in terms if len(term) >= GRAM_SIZE)
+    if long_terms:
+        terms = long_terms
+    candidates = sorted([index_term(index, term) for term in terms], key=len)
+    record_ids = candidates[0].intersection(*candidates[1:])
+    return sorted(index_scan(index, search_string, record_ids))
+
+# fuzzy search
+
+def edit_distance(text_a, text_b, max_distance):
+    """Return the edit distance between two texts, up to max_distance + 1
+
+    Insertions, deletions, substitutions and transpositions of adjacent
+    characters count as one edit. Only the cells within max_distance of
+    the diagonal are computed, the others are beyond the bound anyway.
+    """
+    beyond = max_distance + 1
+    if abs(len(text_a) - len(text_b)) > max_distance:
+        return beyond
+    row_before = None
+    row_previous = None
+    row = [j if j <= max_distance else beyond for j in range(len(text_b) + 1)]
+    for i in range(1, len(text_a) + 1):
+        row_before, row_previous = row_previous, row
+        row = [beyond] * (len(text_b) + 1)
+        if i <= max_distance:
+            row[0] = i
+        for j in range(max(1, i - max_distance),
+                min(len(text_b), i + max_distance) + 1):
+            cost = 0 if text_a[i - 1] == text_b[j - 1] else 1
+            row[j] = min(row_previous[j] + 1, row[j - 1] + 1,
+                row_previous[j - 1] + cost)
+            if (i > 1 and j > 1 and text_a[i - 1] == text_b[j - 2]
+                    and text_a[i - 2] == text_b[j - 1]):
+                row[j] = min(row[j], row_before[j - 2] + 1)
+        if min(row) > max_distance:
+            return beyond
+    return min(row[-1], beyond)
+
+def fuzzy_distance(term):
+    """Return the max edit distance allowed for a term"""
+    for length, distance in FUZZY_DISTANCES:
+        if len(term) >= length:
+            return distance
+
+def fuzzy_tokens(index, term):
+    """Return the score of the tokens matching a term, from 0 to 1
+
+    The exact token scores 1, then the tokens starting with the term or
+    containing it, scaled by the part of the token covered by the term,
+    then the tokens within the edit distance of the term. The candidates
+    for the edit distance share enough padded n-grams with the term, each
+    edit changing at most GRAM_SIZE + 1 of them (a transposition).
+    """
+    scores = {}
+    if len(term) < GRAM_SIZE:
+        # the padded n-gram starting the tokens with the term
+        start = (GRAM_START * (GRAM_SIZE - 1) + term)[-GRAM_SIZE:]
+        tokens = [token for token in index['grams'].get(start, ())
+            if token.startswith(term)]
+    else:
+        tokens = index_tokens(index, term)
+    for token in tokens:
+        coverage = float(len(term)) / len(token)
+        if token.startswith(term):
+            scores[token] = 0.5 + 0.5 * coverage
+        else:
+            scores[token] = 0.25 + 0.5 * coverage
+    max_distance = fuzzy_distance(term)
+    if not max_distance:
+        return scores
+    term_grams = grams(term, True)
+    counts = {}
+    for gram in term_grams:
+        for token in index['grams'].get(gram, ()):
+            counts[token] = counts.get(token, 0) + 1
+    min_count = len(term_grams) - (GRAM_SIZE + 1) * max_distance
+    # each edit drops at most one of the characters of the term
+    term_chars = set(term)
+    for token, count in counts.iteritems():
+        if (count < min_count or token in scores
+                or abs(len(token) - len(term)) > max_distance
+                or len(term_chars.difference(token)) > max_distance):
+            continue
+        distance = edit_distance(term, token, max_distance)
+        if distance <= max_distance:
+            scores[token] = 0.9 * (1 - float(distance) / len(term))
+    return scores
+
+def index_fuzzy(index, search_string, limit):
+    """Return the ids of the records best matching the search string
+
+    Each word of the search string scores the best matching token of each
+    record, the records are ranked by the sum of the scores of the words,
+    then by id. At most limit ids are returned.
+    """
+    logger.debug('call function index_fuzzy')
+    search_string = query_key(search_string, index['fold_accents'])
+    totals = {}
+    for term in set(TOKEN.findall(search_string)):
+        term_scores = {}
+        for token, score in fuzzy_tokens(index, term).iteritems():
+            for record_id in index['postings'][token]:
+                if score > term_scores.get(record_id, 0):
+                    term_scores[record_id] = score
+        for record_id, score in term_scores.iteritems():
+            totals[record_id] = totals.get(record_id, 0) + score
+    ranked = heapq.nlargest(limit, totals.iteritems(),
+        key=lambda item: (item[1], -item[0]))
+    return [record_id for record_id, score in ranked]
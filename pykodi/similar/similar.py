@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+"""
+Module of functions for the similar songs index, with NumPy.
+
+Each song is a feature vector: the one-hot codes of its first genre, its
+first artist and its album, its year spread over the two closest
+decades, and its normalized rating and play count. The one-hot blocks
+are kept as code columns, the dot product of two songs on a block being
+the weight of the block when their codes are equal, the other features
+are a small dense matrix. The cosine similarity of a batch of seeds with
+all the songs is then a few vectorized comparisons and one matrix
+product.
+
+The approximate index only scores the songs sharing the genre, the
+artist or the album of the seed, found by bisection in the code columns
+sorted once. It is used from APPROXIMATE_MIN_SONGS songs.
+"""
+
+import math
+import logging
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# global constants
+
+# weight of each feature in the vectors
+WEIGHT_GENRE = 1.0
+WEIGHT_ARTIST = 1.0
+WEIGHT_ALBUM = 0.7
+WEIGHT_YEAR = 0.8
+WEIGHT_RATING = 0.3
+WEIGHT_PLAYCOUNT = 0.3
+
+# code columns: (name, song field, weight)
+CODES = (
+    ('genre', 'genre', WEIGHT_GENRE),
+    ('artist', 'artist', WEIGHT_ARTIST),
+    ('album', 'albumid', WEIGHT_ALBUM)
+)
+
+# decades of the year features
+YEAR_FIRST = 1925 # center of the first decade
+YEAR_WIDTH = 10
+YEAR_DECADES = 11
+
+# songs from which the approximate index is used
+APPROXIMATE_MIN_SONGS = 100000
+
+# part of the rows removed before the arrays are compacted
+COMPACT_RATIO = 0.25
+
+# global variable
+logger = logging.getLogger(__name__)
+
+# index
+
+def available():
+    """True if NumPy is installed"""
+    return numpy is not None
+
+def index_build(songs, approximate=None):
+    """Return the similar songs index of the songs
+
+    The approximate index is used from APPROXIMATE_MIN_SONGS songs, if
+    approximate is None.
+    """
+    logger.debug('call function index_build')
+    songids = sorted(songs)
+    ratings = [songs[songid].get('rating') or 0 for songid in songids]
+    playcounts = [songs[songid].get('playcount') or 0 for songid in songids]
+    index = {
+        'songids': numpy.array(songids, dtype=numpy.int64),
+        'rows': dict((songid, row) for row, songid in enumerate(songids)),
+        'valid': numpy.ones(len(songids), dtype=bool),
+        'values': dict((name, {}) for name, field, weight in CODES),
+        'rating_max': float(max(ratings + [1])),
+        'playcount_max': math.log1p(max(playcounts + [1])),
+        'approximate': len(songids) >= APPROXIMATE_MIN_SONGS
+            if approximate is None else approximate
+    }
+    for name, field, weight in CODES:
+        index[name] = codes(index, name, field,
+            [songs[songid] for songid in songids])
+    index['dense'] = dense(index, ratings, playcounts,
+        [songs[songid].get('year') or 0 for songid in songids])
+    index_finish(index)
+    return index
+
+def codes(index, name, field, songs):
+    """Return the code column of a feature, -1 for the songs without"""
+    values = index['values'][name]
+    column = numpy.empty(len(songs), dtype=numpy.int32)
+    for row, song in enumerate(songs):
+        value = song.get(field)
+        if isinstance(value, list):
+            value = value[0] if value else None
+        if not value:
+            column[row] = -1
+            continue
+        column[row] = values.setdefault(value, len(values))
+    return column
+
+def dense(index, ratings, playcounts, years):
+    """Return the dense features: year decades, rating and play count"""
+    years = numpy.array(years, dtype=numpy.float32)
+    centers = YEAR_FIRST + YEAR_WIDTH * numpy.arange(YEAR_DECADES,
+        dtype=numpy.float32)
+    features = numpy.empty((len(years), YEAR_DECADES + 2), dtype=numpy.float32)
+    # each year is split between the two closest decades, none if unknown
+    decades = numpy.clip(1 - numpy.abs(years[:, None] - centers) / YEAR_WIDTH,
+        0, 1)
+    decades[years == 0] = 0
+    features[:, :YEAR_DECADES] = WEIGHT_YEAR * decades
+    features[:, YEAR_DECADES] = WEIGHT_RATING * numpy.minimum(
+        numpy.array(ratings, dtype=numpy.float32) / index['rating_max'], 1)
+    features[:, YEAR_DECADES + 1] = WEIGHT_PLAYCOUNT * numpy.minimum(
+        numpy.log1p(numpy.array(playcounts, dtype=numpy.float32))
+        / index['playcount_max'], 1)
+    return features
+
+def index_finish(index):
+    """Compute the norms and the sorted code columns of the index"""
+    norms = (index['dense'] ** 2).sum(axis=1)
+    for name, field, weight in CODES:
+        norms += weight ** 2 * (index[name] >= 0)
+    index['norm'] = numpy.sqrt(norms)
+    index['norm'][index['norm'] == 0] = 1
+    if index['approximate']:
+        for name, field, weight in CODES:
+            order = numpy.argsort(index[name], kind='mergesort')
+            index[name + '_order'] = order
+            index[name + '_sorted'] = index[name][order]
+
+def index_update(index, songs, songids):
+    """Update the index with the songs added, modified or removed
+
+    The rows of the removed songs are invalidated, the arrays compacted
+    when they are more than COMPACT_RATIO of the rows.
+    """
+    logger.debug('call function index_update')
+    songids = list(songids)
+    removed = [songid for songid in songids
+        if not songid in songs and songid in index['rows']]
+    for songid in removed:
+        index['valid'][index['rows'].pop(songid)] = False
+    updated = [songid for songid in songids if songid in songs]
+    added = [songid for songid in updated if not songid in index['rows']]
+    if added:
+        start = len(index['songids'])
+        for offset, songid in enumerate(added):
+            index['rows'][songid] = start + offset
+        index['songids'] = numpy.concatenate(
+            [index['songids'], numpy.array(added, dtype=numpy.int64)])
+        index['valid'] = numpy.concatenate(
+            [index['valid'], numpy.ones(len(added), dtype=bool)])
+        for name in [name for name, field, weight in CODES] + ['dense']:
+            index[name] = numpy.concatenate([index[name],
+                numpy.zeros((len(added),) + index[name].shape[1:],
+                    dtype=index[name].dtype)])
+    if updated:
+        rows = numpy.array([index['rows'][songid] for songid in updated])
+        records = [songs[songid] for songid in updated]
+        for name, field, weight in CODES:
+            index[name][rows] = codes(index, name, field, records)
+        index['dense'][rows] = dense(index,
+            [song.get('rating') or 0 for song in records],
+            [song.get('playcount') or 0 for song in records],
+            [song.get('year') or 0 for song in records])
+    if (~index['valid']).sum() > COMPACT_RATIO * len(index['valid']):
+        index_compact(index)
+    if updated or removed:
+        index_finish(index)
+
+def index_compact(index):
+    """Drop the rows of the removed songs"""
+    logger.debug('call function index_compact')
+    valid = index['valid']
+    for name in ['songids'] + [name for name, field, weight in CODES] + ['dense']:
+        index[name] = index[name][valid]
+    index['valid'] = numpy.ones(len(index['songids']), dtype=bool)
+    index['rows'] = dict((songid, row)
+        for row, songid in enumerate(index['songids'].tolist()))
+
+# queries
+
+def similarities(index, seeds, rows=None):
+    """Return the cosine similarities of the seed rows with the rows
+
+    The result has a line per seed, the rows are all of them if None.
+    """
+    if rows is None:
+        scores = numpy.dot(index['dense'][seeds], index['dense'].T)
+        norm = index['norm']
+    else:
+        scores = numpy.dot(index['dense'][seeds], index['dense'][rows].T)
+        norm = index['norm'][rows]
+    for name, field, weight in CODES:
+        column = index[name] if rows is None else index[name][rows]
+        seed_codes = index[name][seeds][:, None]
+        scores += weight ** 2 * ((column == seed_codes) & (seed_codes >= 0))
+    scores /= index['norm'][seeds][:, None]
+    scores /= norm
+    return scores
+
+def top(scores, k):
+    """Return the columns of the k best scores of each line, best first"""
+    k = min(k, scores.shape[1])
+    if k == 0:
+        return numpy.zeros((scores.shape[0], 0), dtype=numpy.int64)
+    lines = numpy.arange(scores.shape[0])[:, None]
+    best = numpy.argpartition(-scores, k - 1, axis=1)[:, :k]
+    return best[lines, numpy.argsort(-scores[lines, best], axis=1)]
+
+def candidates(index, seed):
+    """Return the rows sharing the genre, the artist or the album of seed"""
+    rows = []
+    for name, field, weight in CODES:
+        code = index[name][seed]
+        if code < 0:
+            continue
+        start, end = numpy.searchsorted(index[name + '_sorted'], [code, code + 1])
+        rows.append(index[name + '_order'][start:end])
+    if not rows:
+        return numpy.zeros(0, dtype=numpy.int64)
+    return numpy.unique(numpy.concatenate(rows))
+
+def knn(index, songids, k):
+    """Return the k songids most similar to each of the songids
+
+    The songids not in the index get an empty list.
+    """
+    logger.debug('call function knn')
+    seeds = [index['rows'][songid] for songid in songids if songid in index['rows']]
+    results = dict((songid, []) for songid in songids)
+    if not seeds:
+        return [results[songid] for songid in songids]
+    if index['approximate']:
+        for seed in seeds:
+            rows = candidates(index, seed)
+            rows = rows[index['valid'][rows] & (rows != seed)]
+            if len(rows) < k:
+                # too few songs share a feature with the seed
+                results[int(index['songids'][seed])] = knn_exact(
+                    index, [seed], k)[0]
+                continue
+            best = top(similarities(index, [seed], rows), k)[0]
+            results[int(index['songids'][seed])] = \
+                index['songids'][rows[best]].tolist()
+    else:
+        for seed, similar_songids in zip(seeds, knn_exact(index, seeds, k)):
+            results[int(index['songids'][seed])] = similar_songids
+    return [results[songid] for songid in songids]
+
+def knn_exact(index, seeds, k):
+    """Return the k songids most similar to each seed row, over all rows"""
+    scores = similarities(index, seeds)
+    scores[:, ~index['valid']] = -numpy.inf
+    scores[numpy.arange(len(seeds)), seeds] = -numpy.inf
+    best = top(scores, k)
+    return [index['songids'][line[numpy.isfinite(line_scores[line])]].tolist()
+        for line, line_scores in zip(best, scores)]
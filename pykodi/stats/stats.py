@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+"""
+Module of functions for the columnar view of the songs library.
+
+The view holds one array per numeric column, a row per song sorted by
+songid, and copies of the columns with the rows sorted by year and by
+genre then year. Filters on the year are bisections and slices of the
+sorted columns, group-bys are the runs of the sorted columns, and the
+aggregates run in C on the slices.
+"""
+
+from array import array
+import bisect
+import operator
+import logging
+
+# global constants
+
+# column name: array type code
+COLUMNS = (
+    ('songid', 'l'),
+    ('albumid', 'l'),
+    ('year', 'l'),
+    ('duration', 'l'),
+    ('rating', 'd'),
+    ('playcount', 'l')
+)
+
+# global variable
+logger = logging.getLogger(__name__)
+
+# view
+
+def columns_build(songs):
+    """Return the columnar view of the songs
+
+    The genre column holds the code of the first genre of each song, an
+    index in the genres list of the view, -1 for the songs without genre.
+    """
+    logger.debug('call function columns_build')
+    columns = dict((name, array(typecode)) for name, typecode in COLUMNS)
+    columns['genre'] = array('l')
+    columns['genres'] = []
+    genre_codes = {}
+    for songid in sorted(songs):
+        song = songs[songid]
+        columns['songid'].append(songid)
+        for name, typecode in COLUMNS[1:]:
+            columns[name].append(song.get(name) or 0)
+        genres = song.get('genre')
+        if not genres:
+            columns['genre'].append(-1)
+            continue
+        if not genres[0] in genre_codes:
+            genre_codes[genres[0]] = len(columns['genres'])
+            columns['genres'].append(genres[0])
+        columns['genre'].append(genre_codes[genres[0]])
+    rows = range(len(columns['songid']))
+    year = columns['year']
+    genre = columns['genre']
+    columns['by_year'] = columns_sort(columns,
+        sorted(rows, key=year.__getitem__))
+    columns['by_genre'] = columns_sort(columns,
+        sorted(rows, key=lambda row: (genre[row], year[row])))
+    return columns
+
+def columns_sort(columns, rows):
+    """Return a copy of the columns with the rows in the given order"""
+    names = [name for name, typecode in COLUMNS] + ['genre']
+    return dict((name, array(columns[name].typecode,
+        map(columns[name].__getitem__, rows))) for name in names)
+
+# sorted values
+
+def between(values, low=None, high=None, start=0, end=None):
+    """Return the (start, end) positions of low <= value <= high
+
+    The values are sorted, the search can be limited to start:end.
+    """
+    if end is None:
+        end = len(values)
+    if low is not None:
+        start = bisect.bisect_left(values, low, start, end)
+    if high is not None:
+        end = bisect.bisect_right(values, high, start, end)
+    return start, end
+
+def runs(values, start=0, end=None):
+    """Return the (value, start, end) of each run of equal sorted values"""
+    if end is None:
+        end = len(values)
+    result = []
+    while start < end:
+        run_end = bisect.bisect_right(values, values[start], start, end)
+        result.append((values[start], start, run_end))
+        start = run_end
+    return result
+
+def histogram(values):
+    """Return the sorted (value, number of values) of an array"""
+    return [(value, values.count(value)) for value in sorted(set(values))]
+
+def count_nonzero(values):
+    """Return the number of values of an array different from 0"""
+    return len(values) - values.count(0)
+
+def histogram_buckets(values, width, start=0, end=None):
+    """Return the (bucket, number of values) of the sorted values
+
+    The buckets are the values rounded down to multiples of width, e.g.
+    the decades of the years.
+    """
+    if end is None:
+        end = len(values)
+    result = []
+    while start < end:
+        bucket = values[start] // width * width
+        bucket_end = bisect.bisect_left(values, bucket + width, start, end)
+        result.append((bucket, bucket_end - start))
+        start = bucket_end
+    return result
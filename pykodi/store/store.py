@@ -0,0 +1,615 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+"""
+Module of functions for the local library storage in SQLite.
+"""
+
+import sqlite3
+import threading
+import sys
+import json
+import time
+import logging
+
+# global constants
+
+# table: (id column, columns, list columns indexed in a link table)
+TABLES = {
+    'albums': (
+        'albumid',
+        [
+            'label',
+            'title',
+            'artist',
+            'year',
+            'rating',
+            'musicbrainzalbumid',
+            'genreid',
+            'genre',
+            'dateadded',
+            'lastmodified'
+        ],
+        ['artist', 'genre']
+    ),
+    'genres': (
+        'genreid',
+        [
+            'label'
+        ],
+        []
+    ),
+    'songs': (
+        'songid',
+        [
+            'label',
+            'title',
+            'artist',
+            'year',
+            'duration',
+            'rating',
+            'playcount',
+            'musicbrainztrackid',
+            'genre',
+            'albumid',
+            'track',
+            'dateadded',
+            'lastmodified',
+            'lastplayed',
+            'rating_en',
+            'playcount_en'
+        ],
+        ['artist', 'genre']
+    )
+}
+
+# columns stored as JSON lists
+LIST_COLUMNS = ('artist', 'genre', 'genreid')
+
+# columns with values repeated across records, shared in memory
+SHARED_COLUMNS = ('dateadded', 'lastmodified')
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS albums (
+    albumid INTEGER PRIMARY KEY,
+    label TEXT,
+    title TEXT,
+    artist TEXT,
+    year INTEGER,
+    rating NUMERIC,
+    musicbrainzalbumid TEXT,
+    genreid TEXT,
+    genre TEXT,
+    dateadded TEXT,
+    lastmodified TEXT
+);
+CREATE INDEX IF NOT EXISTS albums_title ON albums (title);
+CREATE TABLE IF NOT EXISTS albums_artist (albumid INTEGER, artist TEXT);
+CREATE INDEX IF NOT EXISTS albums_artist_albumid ON albums_artist (albumid);
+CREATE INDEX IF NOT EXISTS albums_artist_artist ON albums_artist (artist);
+CREATE TABLE IF NOT EXISTS albums_genre (albumid INTEGER, genre TEXT);
+CREATE INDEX IF NOT EXISTS albums_genre_albumid ON albums_genre (albumid);
+CREATE INDEX IF NOT EXISTS albums_genre_genre ON albums_genre (genre);
+CREATE TABLE IF NOT EXISTS genres (
+    genreid INTEGER PRIMARY KEY,
+    label TEXT
+);
+CREATE INDEX IF NOT EXISTS genres_label ON genres (label);
+CREATE TABLE IF NOT EXISTS songs (
+    songid INTEGER PRIMARY KEY,
+    label TEXT,
+    title TEXT,
+    artist TEXT,
+    year INTEGER,
+    duration INTEGER,
+    rating NUMERIC,
+    playcount INTEGER,
+    musicbrainztrackid TEXT,
+    genre TEXT,
+    albumid INTEGER,
+    track INTEGER,
+    dateadded TEXT,
+    lastmodified TEXT,
+    lastplayed TEXT,
+    rating_en NUMERIC,
+    playcount_en INTEGER
+);
+CREATE INDEX IF NOT EXISTS songs_title ON songs (title);
+CREATE INDEX IF NOT EXISTS songs_albumid ON songs (albumid);
+CREATE TABLE IF NOT EXISTS songs_artist (songid INTEGER, artist TEXT);
+CREATE INDEX IF NOT EXISTS songs_artist_songid ON songs_artist (songid);
+CREATE INDEX IF NOT EXISTS songs_artist_artist ON songs_artist (artist);
+CREATE TABLE IF NOT EXISTS songs_genre (songid INTEGER, genre TEXT);
+CREATE INDEX IF NOT EXISTS songs_genre_songid ON songs_genre (songid);
+CREATE INDEX IF NOT EXISTS songs_genre_genre ON songs_genre (genre);
+CREATE TABLE IF NOT EXISTS albums_keys (
+    albumid INTEGER PRIMARY KEY,
+    keys TEXT,
+    keys_folded TEXT
+);
+CREATE TABLE IF NOT EXISTS songs_keys (
+    songid INTEGER PRIMARY KEY,
+    keys TEXT,
+    keys_folded TEXT
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS songs_ids (
+    songid INTEGER PRIMARY KEY,
+    mbid TEXT,
+    foreign_id TEXT
+);
+CREATE INDEX IF NOT EXISTS songs_ids_mbid ON songs_ids (mbid);
+CREATE INDEX IF NOT EXISTS songs_ids_foreign_id ON songs_ids (foreign_id);
+CREATE TABLE IF NOT EXISTS songs_dirty (
+    songid INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS feedback (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    songid INTEGER,
+    action TEXT,
+    time REAL,
+    attempts INTEGER DEFAULT 0
+);
+"""
+
+# ids per statement, below the SQLite variables limit
+ID_CHUNK_SIZE = 500
+
+# global variable
+logger = logging.getLogger(__name__)
+local = threading.local()
+strings = {}
+
+# connection
+
+def connect(fname):
+    """Return the connection of this thread to the library file"""
+    connections = getattr(local, 'connections', None)
+    if connections is None:
+        connections = local.connections = {}
+    if not fname in connections:
+        logger.debug('open library file %s', fname)
+        connection = sqlite3.connect(fname)
+        connection.executescript(SCHEMA)
+        connections[fname] = connection
+    return connections[fname]
+
+def close(fname):
+    """Close the connection of this thread to the library file
+
+    The shared strings are dropped, the records keep their copies.
+    """
+    connections = getattr(local, 'connections', {})
+    if fname in connections:
+        connections.pop(fname).close()
+    strings.clear()
+
+def id_chunks(ids):
+    """Split a list of ids for the IN clauses"""
+    ids = list(ids)
+    for start in range(0, len(ids), ID_CHUNK_SIZE):
+        yield ids[start:start + ID_CHUNK_SIZE]
+
+# records
+
+def string_intern(value):
+    """Return the shared copy of a value repeated across records"""
+    return strings.setdefault(value, value)
+
+def strings_prune():
+    """Drop the shared strings no record uses any more"""
+    logger.debug('call function strings_prune')
+    # the references of an unused string: the table key and value, the
+    # keys list, the loop variable and the getrefcount argument
+    for value in strings.keys():
+        if sys.getrefcount(value) <= 5:
+            del strings[value]
+
+class Record(object):
+    """Library record stored in slots, with the dict access of the items
+
+    The elements of the list columns are shared strings, the artists and
+    genres being repeated across the library, as are the dates of the
+    shared columns. The label is usually the title and shares it.
+    Subclasses declare the table columns as slots.
+    """
+    __slots__ = ()
+    names = frozenset()
+
+    def __init__(self, item=None):
+        if item is not None:
+            self.update(item)
+
+    def __getitem__(self, name):
+        if not name in self.names:
+            raise KeyError(name)
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        if not name in self.names:
+            raise KeyError(name)
+        if name in LIST_COLUMNS and value is not None:
+            value = [string_intern(element) for element in value]
+        elif name in SHARED_COLUMNS and value is not None:
+            value = string_intern(value)
+        elif name == 'label' and value == getattr(self, 'title', None):
+            value = self.title
+        elif name == 'title' and value == getattr(self, 'label', None):
+            self.label = value
+        setattr(self, name, value)
+
+    def __contains__(self, name):
+        return name in self.names and hasattr(self, name)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, dict(self.items()))
+
+    def get(self, name, default=None):
+        if not name in self.names:
+            return default
+        return getattr(self, name, default)
+
+    def keys(self):
+        return [name for name in self.__slots__ if hasattr(self, name)]
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in self.keys()]
+
+    def iteritems(self):
+        return iter(self.items())
+
+    def update(self, item):
+        """Set the columns of the record from a dict, other keys ignored"""
+        for name, value in item.iteritems():
+            if name in self.names:
+                self[name] = value
+
+    def copy(self):
+        return type(self)(self)
+
+    def load(self, columns, values):
+        """Set the columns of the record from a table row"""
+        for name, value in zip(columns, values):
+            if value is not None:
+                if name in LIST_COLUMNS:
+                    value = [string_intern(element) for element in json.loads(value)]
+                elif name in SHARED_COLUMNS:
+                    value = string_intern(value)
+            setattr(self, name, value)
+        if self.label == self.title:
+            self.label = self.title
+
+class Album(Record):
+    """Album record"""
+    __slots__ = tuple(TABLES['albums'][1])
+    names = frozenset(__slots__)
+
+class Song(Record):
+    """Song record"""
+    __slots__ = tuple(TABLES['songs'][1])
+    names = frozenset(__slots__)
+
+# record class of each table, the other tables are read as dicts
+RECORD_CLASSES = {
+    'albums': Album,
+    'songs': Song
+}
+
+def record_row(record_id, record, columns):
+    """Convert a record dict to a table row"""
+    row = [record_id]
+    for column in columns:
+        value = record.get(column)
+        if column in LIST_COLUMNS and value is not None:
+            value = json.dumps(value)
+        row.append(value)
+    return row
+
+def row_record(row, columns, record_class=dict):
+    """Convert a table row to a record"""
+    record = record_class()
+    if isinstance(record, Record):
+        record.load(columns, row[1:])
+        return record
+    for column, value in zip(columns, row[1:]):
+        if column in LIST_COLUMNS and value is not None:
+            value = json.loads(value)
+        record[column] = value
+    return record
+
+def records_count(fname, table):
+    """Return the number of records in a table"""
+    cursor = connect(fname).execute('SELECT COUNT(*) FROM ' + table)
+    return cursor.fetchone()[0]
+
+def records_ids(fname, table):
+    """Return the set of record ids in a table"""
+    id_column = TABLES[table][0]
+    cursor = connect(fname).execute(
+        'SELECT ' + id_column + ' FROM ' + table)
+    return set(row[0] for row in cursor)
+
+def records_read(fname, table, ids=None):
+    """Read the records of a table as a dict, all of them or only ids"""
+    logger.debug('call function records_read')
+    id_column, columns, links = TABLES[table]
+    record_class = RECORD_CLASSES.get(table, dict)
+    connection = connect(fname)
+    select = 'SELECT ' + ', '.join([id_column] + columns) + ' FROM ' + table
+    records = {}
+    if ids is None:
+        for row in connection.execute(select):
+            records[row[0]] = row_record(row, columns, record_class)
+        return records
+    for chunk in id_chunks(ids):
+        cursor = connection.execute(
+            select + ' WHERE ' + id_column + ' IN (' +
+            ', '.join('?' * len(chunk)) + ')',
+            chunk)
+        for row in cursor:
+            records[row[0]] = row_record(row, columns, record_class)
+    return records
+
+def records_delete(fname, table, ids):
+    """Delete records by ids"""
+    logger.debug('call function records_delete')
+    id_column, columns, links = TABLES[table]
+    connection = connect(fname)
+    with connection:
+        for chunk in id_chunks(ids):
+            where = ' WHERE ' + id_column + ' IN (' + \
+                ', '.join('?' * len(chunk)) + ')'
+            connection.execute('DELETE FROM ' + table + where, chunk)
+            for link in links:
+                connection.execute(
+                    'DELETE FROM ' + table + '_' + link + where, chunk)
+
+def records_upsert(fname, table, records, ids):
+    """Insert or update the given ids, delete the ones not in records"""
+    logger.debug('call function records_upsert')
+    id_column, columns, links = TABLES[table]
+    ids = list(ids)
+    removed_ids = [record_id for record_id in ids if not record_id in records]
+    ids = [record_id for record_id in ids if record_id in records]
+    records_delete(fname, table, removed_ids)
+    connection = connect(fname)
+    with connection:
+        connection.executemany(
+            'INSERT OR REPLACE INTO ' + table + ' VALUES (' +
+            ', '.join('?' * (len(columns) + 1)) + ')',
+            (record_row(record_id, records[record_id], columns)
+                for record_id in ids))
+        for link in links:
+            link_table = table + '_' + link
+            for chunk in id_chunks(ids):
+                connection.execute(
+                    'DELETE FROM ' + link_table + ' WHERE ' + id_column +
+                    ' IN (' + ', '.join('?' * len(chunk)) + ')',
+                    chunk)
+            connection.executemany(
+                'INSERT INTO ' + link_table + ' VALUES (?, ?)',
+                ((record_id, value) for record_id in ids
+                    for value in records[record_id].get(link) or []))
+    # the strings of the records removed or replaced since the last save
+    strings_prune()
+
+def records_save(fname, table, records):
+    """Save all the records of a table, delete the others"""
+    logger.debug('call function records_save')
+    removed_ids = records_ids(fname, table).difference(records)
+    records_upsert(fname, table, records, list(records) + list(removed_ids))
+
+# search keys
+
+def keys_read(fname, table, ids=None, folded=False):
+    """Read the search keys of a table, all of them or only ids"""
+    logger.debug('call function keys_read')
+    id_column = TABLES[table][0]
+    connection = connect(fname)
+    select = 'SELECT ' + id_column + ', ' + \
+        ('keys_folded' if folded else 'keys') + ' FROM ' + table + '_keys'
+    if ids is None:
+        return dict((row[0], json.loads(row[1]))
+            for row in connection.execute(select))
+    keys = {}
+    for chunk in id_chunks(ids):
+        cursor = connection.execute(
+            select + ' WHERE ' + id_column + ' IN (' +
+            ', '.join('?' * len(chunk)) + ')',
+            chunk)
+        for row in cursor:
+            keys[row[0]] = json.loads(row[1])
+    return keys
+
+def keys_save(fname, table, keys, ids=None):
+    """Save the search keys of the given ids, all of them if None
+
+    keys holds the (keys, folded keys) pair of each id, the ids not in
+    keys are deleted.
+    """
+    logger.debug('call function keys_save')
+    id_column = TABLES[table][0]
+    keys_table = table + '_keys'
+    connection = connect(fname)
+    with connection:
+        if ids is None:
+            connection.execute('DELETE FROM ' + keys_table)
+            ids = keys.keys()
+        else:
+            for chunk in id_chunks(
+                    [record_id for record_id in ids if not record_id in keys]):
+                connection.execute(
+                    'DELETE FROM ' + keys_table + ' WHERE ' + id_column +
+                    ' IN (' + ', '.join('?' * len(chunk)) + ')',
+                    chunk)
+        connection.executemany(
+            'INSERT OR REPLACE INTO ' + keys_table + ' VALUES (?, ?, ?)',
+            ((record_id, json.dumps(keys[record_id][0]),
+                json.dumps(keys[record_id][1]))
+                for record_id in ids if record_id in keys))
+
+# meta data
+
+def meta_read(fname, name, default=None):
+    """Read a meta data value"""
+    cursor = connect(fname).execute(
+        'SELECT value FROM meta WHERE name = ?', (name,))
+    row = cursor.fetchone()
+    if row is None:
+        return default
+    return json.loads(row[0])
+
+def meta_save(fname, name, value):
+    """Save a meta data value"""
+    connection = connect(fname)
+    with connection:
+        connection.execute(
+            'INSERT OR REPLACE INTO meta VALUES (?, ?)',
+            (name, json.dumps(value)))
+
+# id maps
+
+def ids_read(fname, ids=None):
+    """Read the (mbid, foreign id) of the songs, all of them or only ids"""
+    logger.debug('call function ids_read')
+    connection = connect(fname)
+    select = 'SELECT songid, mbid, foreign_id FROM songs_ids'
+    if ids is None:
+        return dict((row[0], row[1:]) for row in connection.execute(select))
+    rows = {}
+    for chunk in id_chunks(ids):
+        cursor = connection.execute(
+            select + ' WHERE songid IN (' + ', '.join('?' * len(chunk)) + ')',
+            chunk)
+        for row in cursor:
+            rows[row[0]] = row[1:]
+    return rows
+
+def ids_save(fname, rows, ids=None):
+    """Save the (mbid, foreign id) of the given ids, all of them if None
+
+    The ids not in rows are deleted.
+    """
+    logger.debug('call function ids_save')
+    connection = connect(fname)
+    with connection:
+        if ids is None:
+            connection.execute('DELETE FROM songs_ids')
+            ids = rows.keys()
+        else:
+            for chunk in id_chunks(
+                    [record_id for record_id in ids if not record_id in rows]):
+                connection.execute(
+                    'DELETE FROM songs_ids WHERE songid IN (' +
+                    ', '.join('?' * len(chunk)) + ')',
+                    chunk)
+        connection.executemany(
+            'INSERT OR REPLACE INTO songs_ids VALUES (?, ?, ?)',
+            ((record_id,) + tuple(rows[record_id])
+                for record_id in ids if record_id in rows))
+
+def ids_foreign_clear(fname):
+    """Forget all the foreign ids, e.g. when the profile is deleted"""
+    logger.debug('call function ids_foreign_clear')
+    connection = connect(fname)
+    with connection:
+        connection.execute('UPDATE songs_ids SET foreign_id = NULL')
+
+# echonest journal
+
+def dirty_read(fname):
+    """Read the songids changed since their last echonest upload"""
+    cursor = connect(fname).execute('SELECT songid FROM songs_dirty')
+    return set(row[0] for row in cursor)
+
+def dirty_add(fname, ids):
+    """Journal the given songids as changed"""
+    logger.debug('call function dirty_add')
+    connection = connect(fname)
+    with connection:
+        connection.executemany(
+            'INSERT OR IGNORE INTO songs_dirty VALUES (?)',
+            ((record_id,) for record_id in ids))
+
+def dirty_delete(fname, ids):
+    """Clear the given songids from the journal"""
+    logger.debug('call function dirty_delete')
+    connection = connect(fname)
+    with connection:
+        for chunk in id_chunks(ids):
+            connection.execute(
+                'DELETE FROM songs_dirty WHERE songid IN (' +
+                ', '.join('?' * len(chunk)) + ')',
+                chunk)
+
+# feedback queue
+
+def feedback_add(fname, songid, action):
+    """Queue a feedback action on a song"""
+    logger.debug('call function feedback_add')
+    connection = connect(fname)
+    with connection:
+        connection.execute(
+            'INSERT INTO feedback (songid, action, time) VALUES (?, ?, ?)',
+            (songid, action, time.time()))
+
+def feedback_read(fname):
+    """Read the queued feedback, oldest first"""
+    cursor = connect(fname).execute(
+        'SELECT id, songid, action, time, attempts FROM feedback ORDER BY id')
+    return [dict(zip(('id', 'songid', 'action', 'time', 'attempts'), row))
+        for row in cursor]
+
+def feedback_count(fname):
+    """Return the number of queued feedback"""
+    return records_count(fname, 'feedback')
+
+def feedback_delete(fname, ids):
+    """Delete the given feedback ids"""
+    logger.debug('call function feedback_delete')
+    connection = connect(fname)
+    with connection:
+        for chunk in id_chunks(ids):
+            connection.execute(
+                'DELETE FROM feedback WHERE id IN (' +
+                ', '.join('?' * len(chunk)) + ')',
+                chunk)
+
+def feedback_failed(fname, ids, max_attempts):
+    """Count a failed attempt of the given ids, drop the exhausted ones
+
+    Return the number of feedback dropped after max_attempts.
+    """
+    logger.debug('call function feedback_failed')
+    connection = connect(fname)
+    with connection:
+        for chunk in id_chunks(ids):
+            connection.execute(
+                'UPDATE feedback SET attempts = attempts + 1 WHERE id IN (' +
+                ', '.join('?' * len(chunk)) + ')',
+                chunk)
+        cursor = connection.execute(
+            'DELETE FROM feedback WHERE attempts >= ?', (max_attempts,))
+    return cursor.rowcount
@@ -45,6 +45,33 @@ def set_friendly_name(self):
     friendly_name = pk.get_friendly_name(self.params)
     self.prompt = "(" + friendly_name + ") "
 
+def set_state_listener(self):
+    """Follow the player state from notifications with the TCP transport"""
+    logger.debug('call function set_state_listener')
+    if getattr(self, 'state', None):
+        pk.state_unlisten(self.state)
+    self.state = {}
+    if self.params.get('transport') == 'tcp':
+        pk.state_listen(self.params, self.state)
+
+def set_feedback_worker(self):
+    """Flush the echonest feedback queue in the background
+
+    The worker starts with the cached profile ID, if any, so that the start
+    does not wait for echonest. Otherwise the ID is resolved by the first
+    feedback, the worker thread does not touch the params.
+    """
+    logger.debug('call function set_feedback_worker')
+    if getattr(self, 'feedback_worker', None) is not None:
+        self.feedback_worker.close(0)
+        self.feedback_worker = None
+    cache = self.params.get('echonest_profile', {})
+    profile_id = None
+    if cache.get('api_key') == self.params['echonest_key']:
+        profile_id = cache.get('id')
+    self.feedback_worker = pk.FeedbackWorker(
+        self.params['echonest_key'], profile_id)
+
 # params utility functions
 
 def params_display(params):
@@ -59,6 +86,12 @@ def params_display(params):
         params['user'],
         params['password']
     )
+    print "   Transport:      {}".format(params.get('transport', 'http'))
+    print
+    print "Search accents:    {}".format(
+        'ignored' if params.get('search_fold_accents') else 'matched')
+    print "Playlists backend: {}".format(
+        params.get('playlist_backend', 'echonest'))
     print
     print "Echonest API key:  {}".format(params['echonest_key'])
 
@@ -88,6 +121,9 @@ def params_inputs():
     params['port'] = raw_input("Kodi server port: ")
     params['user'] = raw_input("Kodi server user: ")
     params['password'] = raw_input("Kodi server password: ")
+    params['transport'] = raw_input("Kodi transport (http/tcp): ") or 'http'
+    params['search_fold_accents'] = raw_input("Search ignoring accents (y/n): ") == 'y'
+    params['playlist_backend'] = raw_input("Playlists backend (echonest/local): ") or 'echonest'
     params['echonest_key'] = raw_input("Echonest developer key: ")
     return params
 
@@ -111,6 +147,7 @@ class KodiRemote(cmd.Cmd):
     
     def preloop(self):
         self.log_level = params_get()
+        self.state = {}
         if not pk.is_file('params.pickle'):
             logger.info('no kodi params file')
             display_banner()
@@ -119,16 +156,84 @@ class KodiRemote(cmd.Cmd):
             logger.debug('kodi params file found')
             self.params = params_read()
             set_friendly_name(self)
-        if not pk.is_local_albums():
-            self.albums = {}
-            self.genres = {}
-        else:
+            set_state_listener(self)
+            set_feedback_worker(self)
+        pk.library_migrate()
+
+    def __getattr__(self, name):
+        # the library datasets are loaded on first use
+        if name == 'albums':
             self.albums = pk.albums_read_from_file()
+        elif name == 'genres':
             self.genres = pk.genres_read_from_file()
-        if not pk.is_local_songs():
-            self.songs = {}
-        else:
+        elif name == 'songs':
             self.songs = pk.songs_read_from_file()
+        elif name == 'id_maps':
+            self.id_maps = pk.id_maps_read(self.songs, self.en_profile_id())
+        elif name == 'recommend_model':
+            self.recommend_model = pk.recommend_model(self.songs)
+        elif name == 'similar_index':
+            self.similar_index = pk.similar_index_build(self.songs)
+        elif name == 'songs_columns':
+            self.songs_columns = pk.songs_columns(self.songs)
+        elif name == 'genres_index':
+            self.genres_index = pk.genres_index_build(self.genres, self.fold_accents())
+        elif name == 'albums_index':
+            self.albums_index = pk.albums_index_build(self.albums, self.fold_accents())
+        elif name == 'songs_index':
+            self.songs_index = pk.songs_index_build(self.songs, self.fold_accents())
+        else:
+            raise AttributeError(name)
+        return self.__dict__[name]
+
+    def fold_accents(self):
+        """True if the searches ignore the accents"""
+        return getattr(self, 'params', {}).get(
+            'search_fold_accents', pk.SEARCH_FOLD_ACCENTS)
+
+    def en_profile_id(self):
+        """Return the echonest profile ID, cached with the params
+
+        The feedback worker is given the ID, e.g. when it was started
+        without one.
+        """
+        cache = self.params.setdefault('echonest_profile', {})
+        cached = dict(cache)
+        profile_id = pk.en_profile_id(self.params['echonest_key'], cache)
+        if cache != cached:
+            params_save(self.params)
+        if getattr(self, 'feedback_worker', None) is not None:
+            self.feedback_worker.profile_id = profile_id
+        return profile_id
+
+    def en_feedback(self, songid, action):
+        """Queue an echonest feedback, resolve the profile ID if not known
+
+        If echonest cannot be reached, the feedback stays in the queue.
+        """
+        pk.en_feedback(songid, action, self.feedback_worker)
+        if self.feedback_worker.profile_id is None:
+            try:
+                self.en_profile_id()
+            except (IOError, KeyError, ValueError) as e:
+                logger.info('echonest profile id not available: %s', e)
+
+    def local_backend(self):
+        """True if the playlists are recommended locally, not by echonest"""
+        return getattr(self, 'params', {}).get(
+            'playlist_backend', 'echonest') == 'local'
+
+    def albums_subset(self, albumids):
+        """Return the albums if loaded, otherwise read only albumids"""
+        if 'albums' in self.__dict__:
+            return self.albums
+        return pk.albums_read_from_file(albumids)
+
+    def songs_subset(self, songids):
+        """Return the songs if loaded, otherwise read only songids"""
+        if 'songs' in self.__dict__:
+            return self.songs
+        return pk.songs_read_from_file(songids)
 
     # albums functions
 
@@ -141,7 +246,7 @@ class KodiRemote(cmd.Cmd):
         """
         logger.debug('call function do_albums_display')
         albumid = int(line)
-        pkd.albums_details(albumid, self.albums)
+        pkd.albums_details(albumid, self.albums_subset([albumid]))
         print
 
     def do_albums_info(self, line):
@@ -188,6 +293,18 @@ class KodiRemote(cmd.Cmd):
         pkd.albums_index(albumids, self.albums)
         print
 
+    def do_albums_fuzzy(self, line):
+        """
+        Ranked search into the albums, tolerant to typos
+        Usage: albums_fuzzy string
+            List the albums best matching the words in the title or
+            artist, the best match first.
+        """
+        logger.debug('call function do_albums_fuzzy')
+        albumids = pk.albums_fuzzy(self.albums, line, self.albums_index)
+        pkd.albums_index(albumids, self.albums)
+        print
+
     def do_albums_search(self, line):
         """
         Search into the albums
@@ -196,7 +313,7 @@ class KodiRemote(cmd.Cmd):
         """
         logger.debug('call function do_albums_search')
         search_string = line.lower()
-        albumids = pk.albums_search(self.albums, search_string)
+        albumids = pk.albums_search(self.albums, search_string, self.albums_index)
         pkd.albums_index(albumids, self.albums)
         print
 
@@ -206,8 +323,14 @@ class KodiRemote(cmd.Cmd):
         Usage: album_sync
         """
         print
-        pk.albums_sync(self.params, self.albums, self.log_level == 0)
-        pk.genres_extract(self.albums, self.genres)
+        changes = {}
+        pk.albums_sync(self.params, self.albums, self.log_level == 0, changes)
+        if 'albums_index' in self.__dict__:
+            pk.albums_index_update(self.albums_index, self.albums,
+                set().union(*changes.values()))
+        pk.genres_sync(self.params, self.genres)
+        # the genres index is small, it is rebuilt on the next search
+        self.__dict__.pop('genres_index', None)
         print
 
     # genres function
@@ -221,6 +344,18 @@ class KodiRemote(cmd.Cmd):
         pkd.genres_info(self.genres)
         print
 
+    def do_genres_fuzzy(self, line):
+        """
+        Ranked search into the genres, tolerant to typos
+        Usage: genres_fuzzy string
+            List the genres best matching the words in the description,
+            the best match first.
+        """
+        logger.debug('call function do_genres_fuzzy')
+        genreids = pk.genres_fuzzy(self.genres, line, self.genres_index)
+        pkd.genres_index(genreids, self.genres)
+        print
+
     def do_genres_search(self, line):
         """
         Search into the genres
@@ -229,7 +364,7 @@ class KodiRemote(cmd.Cmd):
         """
         logger.debug('call function do_genres_search')
         search_string = line.lower()
-        genreids = pk.genres_search(self.genres, search_string)
+        genreids = pk.genres_search(self.genres, search_string, self.genres_index)
         pkd.genres_index(genreids, self.genres)
         print
 
@@ -244,7 +379,19 @@ class KodiRemote(cmd.Cmd):
         """
         logger.debug('call function do_songs_display')
         songid = int(line)
-        pkd.songs_details(songid, self.songs)
+        pkd.songs_details(songid, self.songs_subset([songid]))
+        print
+
+    def do_songs_fuzzy(self, line):
+        """
+        Ranked search into the songs, tolerant to typos
+        Usage: songs_fuzzy string
+            List the songs best matching the words in the title or
+            artist, the best match first.
+        """
+        logger.debug('call function do_songs_fuzzy')
+        songids = pk.songs_fuzzy(self.songs, line, self.songs_index)
+        pkd.songs_index(songids, self.songs)
         print
 
     def do_songs_info(self, line):
@@ -289,17 +436,55 @@ class KodiRemote(cmd.Cmd):
         """
         logger.debug('call function do_songs_search')
         search_string = line.lower()
-        songids = pk.songs_search(self.songs, search_string)
+        songids = pk.songs_search(self.songs, search_string, self.songs_index)
         pkd.songs_index(songids, self.songs)
         print
 
+    def do_songs_similar(self, line):
+        """
+        Display the songs most similar to a song
+        Usage: songs_similar id [number]
+            The songs sharing the genre, the artist, the album and
+            the decade, with close ratings and play counts.
+        """
+        logger.debug('call function do_songs_similar')
+        args = [int(arg) for arg in line.split()]
+        # without NumPy, the recommendation model finds the songs
+        model = self.recommend_model if self.similar_index is None else None
+        songids = pk.songs_similar(self.similar_index, model, *args[:2])
+        pkd.songs_index(songids, self.songs_subset(songids))
+        print
+
+    def do_songs_stats(self, line):
+        """
+        Display statistics on the songs library
+        Usage: songs_stats [from_year [to_year]]
+            Display the totals and the songs by decade, rating and
+            genre, optionally for a range of release years.
+        """
+        logger.debug('call function do_songs_stats')
+        years = [int(year) for year in line.split()]
+        stats = pk.library_stats(self.songs_columns, *years[:2])
+        pkd.songs_stats(stats, DISPLAY_NB_LINES)
+        print
+
     def do_songs_sync(self, line):
         """
         Sync the Kodi songs library.
         Usage: library_sync
         """
         print
-        f_scan, ru_songids, pcu_songids = pk.songs_sync(self.params, self.songs, self.log_level == 0)
+        changes = {}
+        f_scan, ru_songids, pcu_songids = pk.songs_sync(self.params, self.songs, self.log_level == 0, changes)
+        self.__dict__.pop('songs_columns', None)
+        self.__dict__.pop('id_maps', None)
+        self.__dict__.pop('recommend_model', None)
+        if 'songs_index' in self.__dict__:
+            pk.songs_index_update(self.songs_index, self.songs,
+                set().union(*changes.values()))
+        if self.__dict__.get('similar_index') is not None:
+            pk.similar_index_update(self.similar_index, self.songs,
+                set().union(*changes.values()))
         pkd.songs_sync(f_scan, ru_songids, pcu_songids)
         print
 
@@ -312,9 +497,12 @@ class KodiRemote(cmd.Cmd):
             All information stored in the profile will be lost.
         """
         logger.debug('call function do_echonest_delete')
-        profile_id = pk.en_profile_id(self.params['echonest_key'])
+        profile_id = self.en_profile_id()
         if pkd.en_sure_delete_tasteprofile(self.params['echonest_key'], profile_id):
-            pk.en_delete(self.params['echonest_key'], profile_id)
+            pk.en_delete(self.params['echonest_key'], profile_id,
+                self.params['echonest_profile'])
+            self.__dict__.pop('id_maps', None)
+            params_save(self.params)
             pkd.en_delete()
         print
 
@@ -325,7 +513,7 @@ class KodiRemote(cmd.Cmd):
         """
         logger.debug('call function do_echonest_display')
         songid = int(line)
-        profile_id = pk.en_profile_id(self.params['echonest_key'])
+        profile_id = self.en_profile_id()
         song_data = pk.en_display(self.params['echonest_key'], profile_id, songid)
         pkd.en_display(song_data)
         print
@@ -336,9 +524,11 @@ class KodiRemote(cmd.Cmd):
         Usage: en_info
         """
         logger.debug('call function do_echonest_info')
-        profile_id = pk.en_profile_id(self.params['echonest_key'])
-        en_info = pk.en_info(self.params['echonest_key'], profile_id)
-        pkd.en_info(en_info)
+        profile_id = self.en_profile_id()
+        en_info = pk.en_info(self.params['echonest_key'], profile_id,
+            self.params['echonest_profile'])
+        params_save(self.params)
+        pkd.en_info(en_info, pk.en_feedback_count())
         print
 
     def do_echonest_status(self, line):
@@ -347,9 +537,11 @@ class KodiRemote(cmd.Cmd):
         Usage: en_status ticket
             Detail status of the update tickets.
         """
-        logger.debug('call function do_echonest_sync')
+        logger.debug('call function do_echonest_status')
         ticket = line
-        pk.en_status(self.params['echonest_key'], ticket)
+        status = pk.en_status(self.params['echonest_key'], ticket)
+        pkd.en_status(status)
+        print
 
     def do_echonest_sync(self, line):
         """
@@ -357,13 +549,17 @@ class KodiRemote(cmd.Cmd):
         Usage: echonest_sync
             If there is no song in the profile, a full sync is
             performed. Otherwise, only the play counts and the
-            ratings are updated.
+            ratings are updated. The songs are marked as synced
+            once their update ticket is complete, the failed ones are
+            retried at the next sync.
         """
         logger.debug('call function do_echonest_sync')
-        profile_id = pk.en_profile_id(self.params['echonest_key'])
+        profile_id = self.en_profile_id()
         print
-        en_songids = pk.en_sync(self.params['echonest_key'], profile_id, self.songs, self.log_level == 0)
-        pkd.en_sync(en_songids)
+        en_songids, failed_songids = pk.en_sync(self.params['echonest_key'], profile_id, self.songs, self.log_level == 0,
+            self.params['echonest_profile'], self.id_maps)
+        params_save(self.params)
+        pkd.en_sync(en_songids, failed_songids)
         print
 
     # Kodi params file
@@ -378,7 +574,25 @@ class KodiRemote(cmd.Cmd):
         self.params = params_inputs()
         print
         params_save(self.params)
+        # the search indexes are built with the accents setting
+        self.__dict__.pop('albums_index', None)
+        self.__dict__.pop('genres_index', None)
+        self.__dict__.pop('songs_index', None)
         set_friendly_name(self)
+        set_state_listener(self)
+        set_feedback_worker(self)
+
+    def do_params_playlist_backend(self, line):
+        """
+        Select the backend of the taste playlists.
+        Usage: params_playlist_backend echonest|local
+            The local backend recommends songs from the ratings,
+            play counts, artists, genres and years of the local
+            library, without network.
+        """
+        logger.debug('call function do_params_playlist_backend')
+        self.params['playlist_backend'] = line
+        params_save(self.params)
 
     def do_params_display(self, line):
         """
@@ -401,7 +615,8 @@ class KodiRemote(cmd.Cmd):
         albumids.append(int(line))
         pk.playback_stop(self.params)
         pk.playlist_clear(self.params)
-        pk.playlist_add_albums(self.params, albumids)
+        failed_ids = pk.playlist_add_albums(self.params, albumids)
+        pkd.playlist_add_failed(failed_ids)
         pk.playback_start(self.params)
 
     def do_play_ban(self, line):
@@ -413,19 +628,22 @@ class KodiRemote(cmd.Cmd):
         logger.debug('call function do_play_ban')
         songid = pk.player_songid(self.params)
         pk.player_next(self.params)
-        profile_id = pk.en_profile_id(self.params['echonest_key'])
-        pk.en_ban(self.params['echonest_key'], profile_id, songid)
-        pkd.play_ban(songid, self.songs)
+        self.en_feedback(songid, 'ban')
+        pkd.play_ban(songid, self.songs_subset([songid]))
         print
 
     def do_play_christmas(self, line):
         """Play seasonal Christmas songs"""
         logger.debug('call function do_play_christmas')
-        profile_id = pk.en_profile_id(self.params['echonest_key'])
-        songids = pk.en_playlist_seed_song_type(self.params['echonest_key'], profile_id, 'christmas')
+        if self.local_backend():
+            songids = pk.local_playlist_seed_song_type(self.recommend_model, 'christmas')
+        else:
+            profile_id = self.en_profile_id()
+            songids = pk.en_playlist_seed_song_type(self.params['echonest_key'], profile_id, 'christmas', self.id_maps)
         pk.playback_stop(self.params)
         pk.playlist_clear(self.params)
-        pk.playlist_add_songs(self.params, songids)
+        failed_ids = pk.playlist_add_songs(self.params, songids)
+        pkd.playlist_add_failed(failed_ids)
         pk.playback_start(self.params)
 
     def do_play_favorite(self, line):
@@ -436,9 +654,8 @@ class KodiRemote(cmd.Cmd):
         """
         logger.debug('call function do_play_favorite')
         songid = pk.player_songid(self.params)
-        profile_id = pk.en_profile_id(self.params['echonest_key'])
-        pk.en_favorite(self.params['echonest_key'], profile_id, songid)
-        pkd.play_favorite(songid, self.songs)
+        self.en_feedback(songid, 'favorite')
+        pkd.play_favorite(songid, self.songs_subset([songid]))
         print
 
     def do_play_genres(self, line):
@@ -451,7 +668,8 @@ class KodiRemote(cmd.Cmd):
         genreids.append(int(line))
         pk.playback_stop(self.params)
         pk.playlist_clear(self.params)
-        pk.playlist_add_albums(self.params, genreids)
+        failed_ids = pk.playlist_add_genres(self.params, genreids)
+        pkd.playlist_add_failed(failed_ids)
         pk.playback_start(self.params)
 
     def do_play_party(self, line):
@@ -479,9 +697,8 @@ class KodiRemote(cmd.Cmd):
         logger.debug('call function do_play_skip')
         songid = pk.player_songid(self.params)
         pk.player_next(self.params)
-        profile_id = pk.en_profile_id(self.params['echonest_key'])
-        pk.en_skip(self.params['echonest_key'], profile_id, songid)
-        pkd.play_skip(songid, self.songs)
+        self.en_feedback(songid, 'skip')
+        pkd.play_skip(songid, self.songs_subset([songid]))
         print
 
     def do_play_songs(self, line):
@@ -494,7 +711,8 @@ class KodiRemote(cmd.Cmd):
         songids.append(int(line))
         pk.playback_stop(self.params)
         pk.playlist_clear(self.params)
-        pk.playlist_add_songs(self.params, songids)
+        failed_ids = pk.playlist_add_songs(self.params, songids)
+        pkd.playlist_add_failed(failed_ids)
         pk.playback_start(self.params)
 
     def do_play_stop(self, line):
@@ -512,9 +730,7 @@ class KodiRemote(cmd.Cmd):
         Usage: play_what
         """
         logger.debug('call function do_play_what')
-        properties = pk.player_properties(self.params)
-        item = pk.player_item(self.params)
-        items = pk.playlist_items(self.params)
+        items, item, properties = pk.player_status(self.params, self.state)
         pkd.playlist_now_playing(items, item, properties)
         print
 
@@ -530,7 +746,8 @@ class KodiRemote(cmd.Cmd):
         logger.debug('call function do_playlist_add_albums')
         albumids = []
         albumids.append(int(line))
-        pk.playlist_add_albums(self.params, albumids)
+        failed_ids = pk.playlist_add_albums(self.params, albumids)
+        pkd.playlist_add_failed(failed_ids)
 
     def do_playlist_add_genres(self, line):
         """
@@ -542,7 +759,8 @@ class KodiRemote(cmd.Cmd):
         logger.debug('call function do_playlist_add_genres')
         genreids = []
         genreids.append(int(line))
-        pk.playlist_add_genres(self.params, genreids)
+        failed_ids = pk.playlist_add_genres(self.params, genreids)
+        pkd.playlist_add_failed(failed_ids)
 
     def do_playlist_add_songs(self, line):
         """
@@ -554,7 +772,8 @@ class KodiRemote(cmd.Cmd):
         logger.debug('call function do_playlist_add_song')
         songids = []
         songids.append(int(line))
-        pk.playlist_add_songs(self.params, songids)
+        failed_ids = pk.playlist_add_songs(self.params, songids)
+        pkd.playlist_add_failed(failed_ids)
 
     def do_playlist_clear(self, line):
         """
@@ -571,9 +790,10 @@ class KodiRemote(cmd.Cmd):
         Usage: playlist_show
         """
         logger.debug('call function do_playlist_show')
-        position = pk.player_position(self.params)
-        songids = pk.playlist_songids(self.params)
-        pkd.playlist_show(position, songids, self.songs)
+        items, item, properties = pk.player_status(self.params, self.state)
+        position = properties['position']
+        songids = [playlist_item['id'] for playlist_item in items]
+        pkd.playlist_show(position, songids, self.songs_subset(songids))
         print
 
     def do_playlist_tasteprofile(self, line):
@@ -584,11 +804,15 @@ class KodiRemote(cmd.Cmd):
             profile. The current playlist is removed before.
         """
         logger.debug('call function do_playlist_tasteprofile')
-        profile_id = pk.en_profile_id(self.params['echonest_key'])
-        songids = pk.en_playlist(self.params['echonest_key'], profile_id)
+        if self.local_backend():
+            songids = pk.local_playlist(self.recommend_model)
+        else:
+            profile_id = self.en_profile_id()
+            songids = pk.en_playlist(self.params['echonest_key'], profile_id, self.id_maps)
         pk.playlist_clear(self.params)
-        pk.playlist_add_songs(self.params, songids)
-        pkd.songs_index(songids, self.songs)
+        failed_ids = pk.playlist_add_songs(self.params, songids)
+        pkd.playlist_add_failed(failed_ids)
+        pkd.songs_index(songids, self.songs_subset(songids))
         print
 
     def do_playlist_taste_seed_song(self, line):
@@ -601,11 +825,15 @@ class KodiRemote(cmd.Cmd):
         """
         logger.debug('call function do_playlist_taste_seed')
         songid = int(line)
-        profile_id = pk.en_profile_id(self.params['echonest_key'])
-        songids = pk.en_playlist_seed_song(self.params['echonest_key'], profile_id, songid)
+        if self.local_backend():
+            songids = pk.local_playlist_seed_song(self.recommend_model, songid)
+        else:
+            profile_id = self.en_profile_id()
+            songids = pk.en_playlist_seed_song(self.params['echonest_key'], profile_id, songid, self.id_maps)
         pk.playlist_clear(self.params)
-        pk.playlist_add_songs(self.params, songids)
-        pkd.songs_index(songids, self.songs)
+        failed_ids = pk.playlist_add_songs(self.params, songids)
+        pkd.playlist_add_failed(failed_ids)
+        pkd.songs_index(songids, self.songs_subset(songids))
         print
 
     def do_playlist_taste_seed_type(self, line):
@@ -618,11 +846,15 @@ class KodiRemote(cmd.Cmd):
         """
         logger.debug('call function do_playlist_taste_seed_type')
         song_type = line
-        profile_id = pk.en_profile_id(self.params['echonest_key'])
-        songids = pk.en_playlist_seed_song_type(self.params['echonest_key'], profile_id, song_type)
+        if self.local_backend():
+            songids = pk.local_playlist_seed_song_type(self.recommend_model, song_type)
+        else:
+            profile_id = self.en_profile_id()
+            songids = pk.en_playlist_seed_song_type(self.params['echonest_key'], profile_id, song_type, self.id_maps)
         pk.playlist_clear(self.params)
-        pk.playlist_add_songs(self.params, songids)
-        pkd.songs_index(songids, self.songs)
+        failed_ids = pk.playlist_add_songs(self.params, songids)
+        pkd.playlist_add_failed(failed_ids)
+        pkd.songs_index(songids, self.songs_subset(songids))
         print
 
     # volume functions
@@ -641,6 +873,9 @@ class KodiRemote(cmd.Cmd):
         """Override end of file"""
         logger.info('Bye!')
         print 'Bye!'
+        if getattr(self, 'feedback_worker', None) is not None:
+            self.feedback_worker.close(0)
+        pk.connections_close()
         return True
 
 def main():
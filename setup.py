@@ -13,7 +13,12 @@ setup(name='pykodi',
         'pykodi.core',
         'pykodi.display',
         'pykodi.echonest',
-        'pykodi.rpc'
+        'pykodi.recommend',
+        'pykodi.rpc',
+        'pykodi.search',
+        'pykodi.similar',
+        'pykodi.stats',
+        'pykodi.store'
       ],
       install_requires=[
         'progressbar'
@@ -0,0 +1,350 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+"""
+Tests of the incremental library sync and of the player state, against
+a fake Kodi library and a fake Kodi TCP interface.
+
+Run from the top-level directory with: python -m unittest discover tests
+"""
+
+import SocketServer
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import pykodi as pk
+from pykodi import rpc
+from pykodi.store import store
+
+# global constants
+
+NB_SONGS = 50
+NB_ALBUMS = 5
+DATE = '2015-01-01 00:00:00'
+LATER = '2016-01-01 00:00:00'
+
+PARAMS = {'ip': '127.0.0.1', 'port': 8080, 'user': 'kodi', 'password': ''}
+
+WAIT = 2.0 # seconds, for the notifications
+
+# helpers
+
+class FakeKodi(object):
+    """Library of a Kodi server, answering the rpc calls of the syncs"""
+
+    def __init__(self):
+        self.songs = [{
+            'songid': songid,
+            'label': 'Song %i' % songid,
+            'title': u'Song %i' % songid,
+            'artist': [u'Artist'],
+            'year': 2000,
+            'duration': 200,
+            'rating': songid % 6,
+            'playcount': 0,
+            'musicbrainztrackid': '',
+            'genre': [u'Rock'],
+            'albumid': songid % NB_ALBUMS + 1,
+            'track': 1,
+            'dateadded': DATE,
+            'lastmodified': DATE,
+            'lastplayed': ''
+        } for songid in range(1, NB_SONGS + 1)]
+        self.albums = [{
+            'albumid': albumid,
+            'label': 'Album %i' % albumid,
+            'title': u'Album %i' % albumid,
+            'artist': [u'Artist'],
+            'year': 2000,
+            'rating': 0,
+            'musicbrainzalbumid': '',
+            'genreid': [1],
+            'genre': [u'Rock'],
+            'dateadded': DATE,
+            'lastmodified': DATE
+        } for albumid in range(1, NB_ALBUMS + 1)]
+        self.calls = []
+
+    def functions(self):
+        """Return the fake rpc functions"""
+        return {
+            'jsonrpc_ping': lambda params: True,
+            'audiolibrary_get_songs_limits': lambda params, start, end:
+                {'total': len(self.songs)},
+            'audiolibrary_get_songs_full': self.songs_full,
+            'audiolibrary_get_songs_changed': self.songs_changed,
+            'audiolibrary_get_songs_delta': self.songs_delta,
+            'audiolibrary_get_songs_details': self.songs_details,
+            'audiolibrary_get_albums_limits': lambda params, start, end:
+                {'total': len(self.albums)},
+            'audiolibrary_get_albums': self.albums_full,
+            'audiolibrary_get_albums_changed': self.albums_changed,
+            'audiolibrary_get_albums_delta': self.albums_delta,
+            'audiolibrary_get_albums_details': lambda params, albumids: []
+        }
+
+    def changed(self, items, watermark):
+        self.calls.append(dict(watermark))
+        return [dict(item) for item in items if any(
+            item.get(field) and item[field] > watermark[field]
+            for field in watermark)]
+
+    def songs_full(self, params, start, end):
+        return [dict(song) for song in self.songs[start:end]]
+
+    def songs_changed(self, params, watermark, start, end):
+        return self.changed(self.songs, watermark)[start:end]
+
+    def songs_delta(self, params, start, end):
+        return [dict((field, song[field])
+            for field in ('songid', 'label', 'rating', 'playcount'))
+            for song in self.songs[start:end]]
+
+    def songs_details(self, params, songids):
+        return [dict(song) for song in self.songs if song['songid'] in songids]
+
+    def albums_full(self, params, start, end):
+        return [dict(album) for album in self.albums[start:end]]
+
+    def albums_changed(self, params, watermark, start, end):
+        return self.changed(self.albums, watermark)[start:end]
+
+    def albums_delta(self, params, start, end):
+        return [dict((field, album[field])
+            for field in ('albumid', 'label', 'rating'))
+            for album in self.albums[start:end]]
+
+class FakeKodiTcpHandler(SocketServer.BaseRequestHandler):
+    """Answer the player status commands of a raw JSON-RPC connection"""
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.connections.append(self.request)
+        stream = rpc.JsonStream()
+        while True:
+            data = self.request.recv(4096)
+            if not data:
+                break
+            for value in stream.feed(data):
+                commands = value if isinstance(value, list) else [value]
+                rets = [self.answer(command) for command in commands]
+                server.send(self.request,
+                    rets if isinstance(value, list) else rets[0])
+        with server.lock:
+            if self.request in server.connections:
+                server.connections.remove(self.request)
+
+    def answer(self, command):
+        self.server.calls.append(command['method'])
+        results = {
+            'Playlist.GetItems': {'items': [{'id': 1, 'type': 'song'}]},
+            'Player.GetItem': {'item': {'id': 1, 'type': 'song'}},
+            'Player.GetProperties': {'position': 0, 'speed': 0}
+        }
+        return {'jsonrpc': '2.0', 'id': command['id'],
+            'result': results.get(command['method'], 'OK')}
+
+class FakeKodiTcp(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Raw JSON-RPC interface of a Kodi server, sending notifications"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        SocketServer.TCPServer.__init__(self, ('127.0.0.1', 0),
+            FakeKodiTcpHandler)
+        self.lock = threading.Lock()
+        self.connections = []
+        self.calls = []
+        self.params = dict(PARAMS, transport='tcp',
+            tcp_port=self.server_address[1])
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def send(self, sock, value):
+        with self.lock:
+            sock.sendall(json.dumps(value))
+
+    def notify(self, method, data=None):
+        """Send a notification to the connected clients"""
+        notification = {'jsonrpc': '2.0', 'method': method,
+            'params': {'sender': 'xbmc', 'data': data}}
+        for sock in list(self.connections):
+            self.send(sock, notification)
+
+    def drop(self):
+        """Close the connections, as a Kodi restart"""
+        with self.lock:
+            for sock in self.connections:
+                sock.shutdown(2)
+                sock.close()
+            del self.connections[:]
+
+    def close(self):
+        self.drop()
+        self.shutdown()
+        self.server_close()
+
+def wait_until(condition):
+    """Wait for a condition set by a notification, return it"""
+    deadline = time.time() + WAIT
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+# tests
+
+class TestSync(unittest.TestCase):
+    """The incremental syncs catch the changes that move no date"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        self.kodi = FakeKodi()
+        self.functions = {}
+        for name, function in self.kodi.functions().items():
+            self.functions[name] = getattr(rpc, name)
+            setattr(rpc, name, function)
+        self.songs = {}
+        pk.songs_sync(PARAMS, self.songs, False)
+        store.dirty_delete(pk.LIBRARY_FILE, store.dirty_read(pk.LIBRARY_FILE))
+
+    def tearDown(self):
+        for name, function in self.functions.items():
+            setattr(rpc, name, function)
+        store.close(pk.LIBRARY_FILE)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def test_watermark_floor(self):
+        watermark = pk.watermark_read('songs')
+        self.assertEqual(sorted(watermark), sorted(pk.SONGS_WATERMARK_FIELDS))
+        self.assertEqual(watermark['lastplayed'], pk.WATERMARK_FLOOR)
+
+    def test_rating(self):
+        self.kodi.songs[2]['rating'] = 5 if self.kodi.songs[2]['rating'] != 5 else 1
+        changes = {}
+        full_scan, rating_up, playcount_up = pk.songs_sync(
+            PARAMS, self.songs, False, changes)
+        self.assertFalse(full_scan)
+        self.assertEqual(rating_up, [3])
+        self.assertEqual(changes['modified'], set([3]))
+        self.assertEqual(self.songs[3]['rating'], self.kodi.songs[2]['rating'])
+        self.assertEqual(pk.songs_read_from_file([3])[3]['rating'],
+            self.kodi.songs[2]['rating'])
+        self.assertEqual(store.dirty_read(pk.LIBRARY_FILE), set([3]))
+
+    def test_first_play(self):
+        self.kodi.songs[5]['playcount'] = 1
+        self.kodi.songs[5]['lastplayed'] = LATER
+        full_scan, rating_up, playcount_up = pk.songs_sync(
+            PARAMS, self.songs, False)
+        self.assertTrue('lastplayed' in self.kodi.calls[-1])
+        self.assertEqual(playcount_up, [6])
+        self.assertEqual(self.songs[6]['playcount'], 1)
+        self.assertEqual(store.dirty_read(pk.LIBRARY_FILE), set([6]))
+        self.assertEqual(pk.watermark_read('songs')['lastplayed'], LATER)
+        # the next play is found by the watermark
+        self.kodi.songs[5]['playcount'] = 2
+        self.kodi.songs[5]['lastplayed'] = '2016-02-01 00:00:00'
+        self.assertEqual(pk.songs_sync(PARAMS, self.songs, False)[2], [6])
+
+    def test_no_change(self):
+        changes = {}
+        self.assertEqual(pk.songs_sync(PARAMS, self.songs, False, changes),
+            (False, [], []))
+        self.assertEqual(changes['modified'], set())
+        self.assertEqual(store.dirty_read(pk.LIBRARY_FILE), set())
+
+    def test_album_rating(self):
+        albums = {}
+        pk.albums_sync(PARAMS, albums, False)
+        self.kodi.albums[1]['rating'] = 4
+        changes = {}
+        pk.albums_sync(PARAMS, albums, False, changes)
+        self.assertEqual(changes['modified'], set([2]))
+        self.assertEqual(pk.albums_read_from_file([2])[2]['rating'], 4)
+
+class TestNotifications(unittest.TestCase):
+    """The player state follows the notifications of a fake Kodi"""
+
+    def setUp(self):
+        self.kodi = FakeKodiTcp()
+        self.params = self.kodi.params
+
+    def tearDown(self):
+        rpc.close_clients()
+        self.kodi.close()
+
+    def test_listen(self):
+        received = []
+        rpc.notifications_listen(self.params,
+            lambda method, data: received.append((method, data)))
+        self.kodi.notify('Player.OnPlay', {'item': {'id': 1}})
+        self.assertTrue(wait_until(lambda: received))
+        self.assertEqual(received[0][0], 'Player.OnPlay')
+        self.assertEqual(received[0][1]['data'], {'item': {'id': 1}})
+
+    def test_unlisten(self):
+        received = []
+        listener = lambda method, data: received.append(method)
+        rpc.notifications_listen(self.params, listener)
+        rpc.notifications_unlisten(self.params, listener)
+        self.assertEqual(rpc.get_client(self.params, rpc.TCP).listeners, [])
+
+    def test_state(self):
+        state = {}
+        pk.state_listen(self.params, state)
+        pk.player_status(self.params, state)
+        pk.player_status(self.params, state)
+        self.assertEqual(self.kodi.calls.count('Player.GetItem'), 1)
+        self.kodi.notify('Playlist.OnClear', {'playlistid': 0})
+        self.assertTrue(wait_until(lambda: state['status'] is None))
+        items, item, properties = pk.player_status(self.params, state)
+        self.assertEqual(item['id'], 1)
+        self.assertEqual(self.kodi.calls.count('Player.GetItem'), 2)
+
+    def test_state_replaced(self):
+        old_state = {}
+        pk.state_listen(self.params, old_state)
+        pk.state_unlisten(old_state)
+        state = {}
+        pk.state_listen(self.params, state)
+        self.assertEqual(len(rpc.get_client(self.params, rpc.TCP).listeners), 1)
+        pk.player_status(self.params, state)
+        generation = old_state['generation']
+        self.kodi.notify('Player.OnStop')
+        self.assertTrue(wait_until(lambda: state['status'] is None))
+        self.assertEqual(old_state['generation'], generation)
+
+    def test_connected(self):
+        state = {}
+        pk.state_listen(self.params, state)
+        self.assertTrue(rpc.notifications_connected(self.params))
+        pk.player_status(self.params, state)
+        self.kodi.drop()
+        client = rpc.get_client(self.params, rpc.TCP)
+        self.assertTrue(wait_until(lambda: client.sock is None))
+        # notifications may have been missed, the state is fetched again
+        pk.player_status(self.params, state)
+        self.assertEqual(self.kodi.calls.count('Player.GetItem'), 2)
+        self.assertTrue(rpc.notifications_connected(self.params))
+        pk.player_status(self.params, state)
+        self.assertEqual(self.kodi.calls.count('Player.GetItem'), 2)
+        self.kodi.notify('Player.OnPause')
+        self.assertTrue(wait_until(lambda: state['status'] is None))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+"""
+Tests of the echonest rate limit, with a fake clock and a local server.
+
+Run from the top-level directory with: python -m unittest discover tests
+"""
+
+import BaseHTTPServer
+import threading
+import time
+import unittest
+
+from pykodi.echonest import echonest
+
+# helpers
+
+class FakeClock(object):
+    """Clock moved by the calls to sleep only, the sleeps are recorded"""
+
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def clock(self):
+        return self.now
+
+    def sleep(self, wait):
+        self.sleeps.append(wait)
+        self.now += wait
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer the next response of the server, the last one repeated"""
+
+    def do_GET(self):
+        server = self.server
+        server.requests += 1
+        time.sleep(server.delay)
+        status, headers = server.responses[
+            min(server.requests, len(server.responses)) - 1]
+        body = '{"response": {"status": {"code": 0}}}'
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+# tests
+
+class TestTokenBucket(unittest.TestCase):
+
+    def setUp(self):
+        self.fake = FakeClock()
+        self.bucket = echonest.TokenBucket(limit=120, period=60.0, burst=10,
+            clock=self.fake.clock, sleep=self.fake.sleep)
+
+    def test_burst(self):
+        for i in range(10):
+            self.bucket.acquire()
+        self.assertEqual(self.fake.sleeps, [])
+        self.bucket.acquire()
+        self.assertEqual(len(self.fake.sleeps), 1)
+        self.assertAlmostEqual(self.fake.sleeps[0], 0.5)
+
+    def test_rate(self):
+        for i in range(10 + 60):
+            self.bucket.acquire()
+        # the calls after the burst are spaced at 2 per second
+        self.assertAlmostEqual(self.fake.now - 1000.0, 30.0)
+        self.assertEqual(len(self.fake.sleeps), 60)
+
+    def test_refill(self):
+        for i in range(10):
+            self.bucket.acquire()
+        self.fake.now += 2.0
+        for i in range(4):
+            self.bucket.acquire()
+        self.assertEqual(self.fake.sleeps, [])
+        self.bucket.acquire()
+        self.assertAlmostEqual(self.fake.sleeps[0], 0.5)
+
+    def test_refill_burst(self):
+        self.fake.now += 3600.0
+        for i in range(10):
+            self.bucket.acquire()
+        self.assertEqual(self.fake.sleeps, [])
+        self.bucket.acquire()
+        self.assertEqual(len(self.fake.sleeps), 1)
+
+    def test_adapt(self):
+        self.bucket.adapt(limit=60, remaining=1)
+        self.bucket.acquire()
+        self.assertEqual(self.fake.sleeps, [])
+        self.bucket.acquire()
+        self.assertAlmostEqual(self.fake.sleeps[0], 1.0)
+
+    def test_window_end(self):
+        # the server window starts with its first response
+        self.bucket.adapt(remaining=20)
+        self.fake.now += 20.0
+        self.bucket.adapt(remaining=0)
+        self.bucket.acquire()
+        self.assertAlmostEqual(self.fake.sleeps[0], 40.0)
+        # a new window
+        self.bucket.adapt(remaining=119)
+        self.bucket.acquire()
+        self.assertEqual(len(self.fake.sleeps), 1)
+
+    def test_sleep_unlocked(self):
+        # the bucket stays usable by the other threads during a wait
+        def sleep(wait):
+            thread = threading.Thread(target=self.bucket.empty)
+            thread.start()
+            thread.join(1.0)
+            unlocked.append(not thread.is_alive())
+            self.fake.sleep(wait)
+        unlocked = []
+        self.bucket.sleep = sleep
+        for i in range(11):
+            self.bucket.acquire()
+        self.assertEqual(unlocked, [True])
+
+    def test_empty(self):
+        self.bucket.empty()
+        self.bucket.acquire()
+        self.assertAlmostEqual(self.fake.sleeps[0], 0.5)
+
+class TestApiRequest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), StubHandler)
+        self.server.requests = 0
+        self.server.responses = [(200, {})]
+        self.server.delay = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%i/' % self.server.server_port
+        self.fake = FakeClock()
+        self.bucket = echonest.bucket
+        self.timeout = echonest.API_TIMEOUT
+        echonest.bucket = echonest.TokenBucket(
+            clock=self.fake.clock, sleep=self.fake.sleep)
+
+    def tearDown(self):
+        echonest.bucket = self.bucket
+        echonest.API_TIMEOUT = self.timeout
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_ok(self):
+        r = echonest.api_request('GET', self.url)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.server.requests, 1)
+        self.assertEqual(self.fake.sleeps, [])
+
+    def test_timeout(self):
+        self.server.delay = 0.5
+        echonest.API_TIMEOUT = 0.1
+        self.assertRaises(IOError, echonest.api_request, 'GET', self.url)
+
+    def test_retry_after(self):
+        self.server.responses = [
+            (429, {'Retry-After': '7'}),
+            (429, {'Retry-After': '3'}),
+            (200, {})]
+        r = echonest.api_request('GET', self.url)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.server.requests, 3)
+        self.assertEqual(self.fake.sleeps, [7, 3])
+
+    def test_retry_default_wait(self):
+        self.server.responses = [(429, {}), (200, {})]
+        r = echonest.api_request('GET', self.url)
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(self.fake.sleeps, [echonest.RATE_RETRY_WAIT])
+
+    def test_retries_exhausted(self):
+        self.server.responses = [(429, {'Retry-After': '1'})]
+        r = echonest.api_request('GET', self.url)
+        self.assertEqual(r.status_code, 429)
+        self.assertEqual(self.server.requests, echonest.RATE_RETRIES + 1)
+        self.assertEqual(self.fake.sleeps, [1] * echonest.RATE_RETRIES)
+
+    def test_rate_limit_headers(self):
+        self.server.responses = [
+            (200, {'X-RateLimit-Limit': '60', 'X-RateLimit-Remaining': '0'})]
+        echonest.api_request('GET', self.url)
+        self.assertEqual(self.fake.sleeps, [])
+        echonest.api_request('GET', self.url)
+        # no call left, wait for the end of the server window
+        self.assertEqual(len(self.fake.sleeps), 1)
+        self.assertAlmostEqual(self.fake.sleeps[0], 60.0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+"""
+Tests of the Kodi JSON-RPC clients, against a local server.
+
+Run from the top-level directory with: python -m unittest discover tests
+"""
+
+import BaseHTTPServer
+import SocketServer
+import json
+import threading
+import unittest
+
+from pykodi.rpc import rpc
+
+# helpers
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Answer the JSON-RPC commands with their method, count connections"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections += 1
+
+    def do_POST(self):
+        self.server.requests += 1
+        command = json.loads(self.rfile.read(
+            int(self.headers['Content-Length'])))
+        body = json.dumps(
+            {'jsonrpc': '2.0', 'id': command['id'], 'result': command['method']})
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+# tests
+
+class TestHttpClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StubServer(('127.0.0.1', 0), StubHandler)
+        self.server.connections = 0
+        self.server.requests = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.params = {
+            'ip': '127.0.0.1',
+            'port': self.server.server_port,
+            'user': 'kodi',
+            'password': ''
+        }
+
+    def tearDown(self):
+        rpc.close_clients()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def command(self, method):
+        return {'jsonrpc': '2.0', 'method': method, 'id': 1}
+
+    def test_connection_reuse(self):
+        for i in range(10):
+            ret = rpc.call_api(self.params, self.command('JSONRPC.Ping'))
+            self.assertEqual(ret['result'], 'JSONRPC.Ping')
+        self.assertEqual(self.server.requests, 10)
+        self.assertEqual(self.server.connections, 1)
+
+    def test_client_cache(self):
+        client = rpc.get_client(self.params)
+        self.assertTrue(rpc.get_client(dict(self.params)) is client)
+        other = dict(self.params, password='other')
+        self.assertFalse(rpc.get_client(other) is client)
+
+    def test_close_clients(self):
+        client = rpc.get_client(self.params)
+        rpc.call_api(self.params, self.command('JSONRPC.Ping'))
+        rpc.close_clients()
+        self.assertEqual(rpc.clients, {})
+        self.assertFalse(rpc.get_client(self.params) is client)
+        rpc.call_api(self.params, self.command('JSONRPC.Ping'))
+        self.assertEqual(self.server.connections, 2)
+
+if __name__ == '__main__':
+    unittest.main()
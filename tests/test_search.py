@@ -0,0 +1,195 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+"""
+Tests of the search indexes against the linear searches.
+
+Run from the top-level directory with: python -m unittest discover tests
+"""
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import pykodi as pk
+from pykodi.store import store
+
+# global constants
+
+WORDS = [
+    u'Love', u'love', u'LOVE', u'night', u'Night', u'day', u'the', u'The',
+    u'a', u'of', u'in', u'on', u'rock', u'blues', u'jazz', u'live',
+    u'christmas', u'song', u'songs', u'Song', u'beat', u'it', u'me',
+    u'you', u'lovely', u'nightingale', u'café', u'Café', u'CAFÉ', u'noël',
+    u'Noël', u'björk', u'Björk', u'été', u'ÉTÉ', u'Été', u'straße',
+    u'señor', u'SEÑOR', u'żółw', u'ŻÓŁW', u'éternité', u'Éternité',
+    u'東京', u'音楽', u'музыка', u'Музыка', u'déjà', u'DÉJÀ', u'vu',
+    u'1999', u'21', u'r&b', u'ac/dc', u"don't", u'-', u'.'
+]
+
+LIBRARY_SIZE = 300
+QUERIES = 300
+SEEDS = range(5)
+
+# helpers
+
+def random_text(rand, max_words):
+    """Return a random text of words of the vocabulary"""
+    return u' '.join(rand.choice(WORDS)
+        for i in range(rand.randint(1, max_words)))
+
+def random_library(rand):
+    """Return random records, used as albums or songs, and genres"""
+    records = {}
+    for record_id in range(1, LIBRARY_SIZE + 1):
+        records[record_id] = {
+            'title': random_text(rand, 5),
+            'artist': [random_text(rand, 2)
+                for i in range(rand.randint(0, 2))]
+        }
+    genres = dict((genreid, random_text(rand, 2))
+        for genreid in range(1, LIBRARY_SIZE // 10 + 1))
+    return records, genres
+
+def random_query(rand, texts):
+    """Return a random search string, UTF-8 encoded as read from the CLI
+
+    Most queries are parts of the texts, cut anywhere, some of several
+    words, the others random words likely to miss.
+    """
+    choice = rand.random()
+    if choice < 0.7:
+        text = rand.choice(texts)
+        start = rand.randint(0, len(text) - 1)
+        end = rand.randint(start + 1, min(len(text), start + 20))
+        query = text[start:end]
+    elif choice < 0.9:
+        query = random_text(rand, 3)
+    else:
+        query = rand.choice([u' ', u'  ', u'/', u'-', u'zzz', u'é', u'lo ve'])
+    return query.encode('utf-8')
+
+class SearchTestCase(unittest.TestCase):
+    """Run in a temporary directory, for the library file"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+
+    def tearDown(self):
+        store.close(pk.LIBRARY_FILE)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+# tests
+
+class TestIndexSearch(SearchTestCase):
+    """The indexes return the same ids as the linear searches"""
+
+    def assert_same(self, search, records, index, texts, rand):
+        for i in range(QUERIES):
+            query = random_query(rand, texts)
+            self.assertEqual(
+                search(records, query, index),
+                search(records, query),
+                'query %r' % query)
+
+    def test_songs(self):
+        for seed in SEEDS:
+            rand = random.Random(seed)
+            songs, genres = random_library(rand)
+            pk.songs_save(songs)
+            index = pk.songs_index_build(songs)
+            texts = [song['title'] for song in songs.values()] + \
+                [u'/'.join(song['artist']) for song in songs.values()
+                    if song['artist']]
+            self.assert_same(pk.songs_search, songs, index, texts, rand)
+
+    def test_albums(self):
+        for seed in SEEDS:
+            rand = random.Random(seed)
+            albums, genres = random_library(rand)
+            pk.albums_save(albums)
+            index = pk.albums_index_build(albums)
+            texts = [album['title'] for album in albums.values()] + \
+                [u'/'.join(album['artist']) for album in albums.values()
+                    if album['artist']]
+            self.assert_same(pk.albums_search, albums, index, texts, rand)
+
+    def test_genres(self):
+        for seed in SEEDS:
+            rand = random.Random(seed)
+            records, genres = random_library(rand)
+            index = pk.genres_index_build(genres)
+            self.assert_same(pk.genres_search, genres, index,
+                genres.values(), rand)
+
+    def test_fold_accents(self):
+        for seed in SEEDS:
+            rand = random.Random(seed)
+            songs, genres = random_library(rand)
+            pk.songs_save(songs)
+            index = pk.songs_index_build(songs, True)
+            genres_index = pk.genres_index_build(genres, True)
+            texts = [song['title'] for song in songs.values()]
+            for i in range(QUERIES):
+                query = random_query(rand, texts)
+                self.assertEqual(pk.songs_search(songs, query, index),
+                    pk.songs_search(songs, query, fold_accents=True),
+                    'query %r' % query)
+                self.assertEqual(pk.genres_search(genres, query, genres_index),
+                    pk.genres_search(genres, query, fold_accents=True),
+                    'query %r' % query)
+        songs = {1: {'title': u'Été', 'artist': []}}
+        self.assertEqual(pk.songs_search(songs, 'ete', fold_accents=True), [1])
+
+    def test_case(self):
+        songs = {
+            1: {'title': u'ÉTÉ', 'artist': []},
+            2: {'title': u'été', 'artist': [u'Björk']},
+            3: {'title': u'Summer', 'artist': [u'BJÖRK']}
+        }
+        pk.songs_save(songs)
+        index = pk.songs_index_build(songs)
+        for query, songids in [('\xc3\xa9t\xc3\xa9', [1, 2]),
+                ('\xc3\x89T\xc3\x89', [1, 2]), ('bj\xc3\xb6rk', [2, 3])]:
+            self.assertEqual(pk.songs_search(songs, query, index), songids)
+            self.assertEqual(pk.songs_search(songs, query), songids)
+
+    def test_invalid_utf8(self):
+        rand = random.Random(0)
+        songs, genres = random_library(rand)
+        pk.songs_save(songs)
+        index = pk.songs_index_build(songs)
+        genres_index = pk.genres_index_build(genres)
+        for query in ['\xff', 'love\xfe', '\xc0\xafsong', 'caf\xe9 ']:
+            self.assertEqual(pk.songs_search(songs, query, index),
+                pk.songs_search(songs, query), 'query %r' % query)
+            self.assertEqual(pk.genres_search(genres, query, genres_index),
+                pk.genres_search(genres, query), 'query %r' % query)
+            pk.songs_fuzzy(songs, query, index)
+
+    def test_update(self):
+        rand = random.Random(0)
+        songs, genres = random_library(rand)
+        pk.songs_save(songs)
+        index = pk.songs_index_build(songs)
+        songids = rand.sample(sorted(songs), 50)
+        for songid in songids[:25]:
+            del songs[songid]
+        for songid in songids[25:]:
+            songs[songid]['title'] = random_text(rand, 5)
+        pk.songs_save(songs)
+        pk.songs_index_update(index, songs, songids)
+        texts = [song['title'] for song in songs.values()]
+        self.assert_same(pk.songs_search, songs, index, texts, rand)
+
+if __name__ == '__main__':
+    unittest.main()
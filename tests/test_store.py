@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright 2015 Arn-O. See the LICENSE file at the top-level directory of this
+# distribution and at
+# https://github.com/Arn-O/py-kodi-remote-controller/blob/master/LICENSE.
+
+"""
+Tests of the local library storage.
+
+Run from the top-level directory with: python -m unittest discover tests
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pykodi.store import store
+
+# global constants
+
+LIBRARY_FILE = 'library.db'
+
+# helpers
+
+def song(songid):
+    """Return a song record with an artist and a date of its own"""
+    return store.Song({
+        'label': u'Song %i' % songid,
+        'title': u'Song %i' % songid,
+        'artist': [u'Artist %i' % songid, u'Band'],
+        'rating': 0,
+        'playcount': 0,
+        'dateadded': u'2015-01-%02i 00:00:00' % songid,
+        'lastmodified': u'2015-01-01 00:00:00'
+    })
+
+# tests
+
+class TestStrings(unittest.TestCase):
+    """The shared strings of the removed records are dropped"""
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.mkdtemp()
+        os.chdir(self.tmp)
+        store.strings.clear()
+
+    def tearDown(self):
+        store.close(LIBRARY_FILE)
+        os.chdir(self.cwd)
+        shutil.rmtree(self.tmp)
+
+    def test_shared(self):
+        songs = dict((songid, song(songid)) for songid in range(1, 11))
+        store.records_save(LIBRARY_FILE, 'songs', songs)
+        songs = store.records_read(LIBRARY_FILE, 'songs')
+        self.assertTrue(songs[1]['artist'][1] is songs[2]['artist'][1])
+        self.assertTrue(songs[1]['lastmodified'] is songs[2]['lastmodified'])
+
+    def test_prune(self):
+        songs = dict((songid, song(songid)) for songid in range(1, 11))
+        store.records_save(LIBRARY_FILE, 'songs', songs)
+        self.assertTrue(u'Artist 3' in store.strings)
+        for songid in range(1, 6):
+            del songs[songid]
+        songs[6] = song(6)
+        songs[6]['artist'] = [u'Other']
+        store.records_save(LIBRARY_FILE, 'songs', songs)
+        self.assertFalse(u'Artist 3' in store.strings)
+        self.assertFalse(u'Artist 6' in store.strings)
+        self.assertFalse(u'2015-01-03 00:00:00' in store.strings)
+        self.assertTrue(u'Artist 7' in store.strings)
+        self.assertTrue(u'Band' in store.strings)
+        self.assertTrue(u'2015-01-01 00:00:00' in store.strings)
+        # the strings in use are still shared
+        self.assertTrue(store.string_intern(u'Band') is songs[7]['artist'][1])
+
+    def test_close(self):
+        songs = dict((songid, song(songid)) for songid in range(1, 11))
+        store.records_save(LIBRARY_FILE, 'songs', songs)
+        store.close(LIBRARY_FILE)
+        self.assertEqual(store.strings, {})
+        self.assertEqual(songs[1]['artist'][0], u'Artist 1')
+
+if __name__ == '__main__':
+    unittest.main()